@@ -1,7 +1,16 @@
 import pandas as pd
 import numpy as np
 import os
+import argparse
 from datetime import datetime
+from storage import PROCESSED_FILE, frame_exists, load_frame, save_frame
+from data_loader import (
+    load_and_merge_data, load_sales, merge_property_tables, concat_frames,
+    get_load_stats, DATA_DIR, RAW_CACHE_NAMESPACE
+)
+import cache
+import profiling
+from dtypes import apply_dtype_policy, get_memory_stats
 
 # Configuration
 LEAKAGE_COLUMNS = [
@@ -9,91 +18,14 @@ LEAKAGE_COLUMNS = [
     'STXBL', 'NSTXBL', 'COTXBL', 'CITXBL',
     'SASD', 'NSASD', 'MSASD', 'MSTXBL', 'OITXBL'
 ]
-OUTPUT_FILE = 'processed_data.csv'
+OUTPUT_FILE = PROCESSED_FILE
+# A sale is identified by parcel + sale date + price (used by --incremental)
+SALE_KEY = ['PARID', 'SALEDT', 'PRICE']
+# Keys of every sale a run has considered, including those dropped by the joins or the
+# cleaning: --incremental only processes sales not in here
+PROCESSED_KEYS_FILE = 'processed_sale_keys.parquet'
 STATS_FILE = 'data_stats.md'
 
-# Data Directory
-BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-DATA_DIR = os.path.join(BASE_DIR, 'data')
-
-def load_and_merge_data(data_dir=DATA_DIR):
-    """
-    Loads Sales, Residential Building, and Parcel data, and merges them.
-    Returns a consolidated DataFrame.
-    """
-    print("Loading and merging data sets...")
-    
-    # 1. Load Sales Data
-    sales_path = os.path.join(data_dir, 'VCPA_CAMA_SALES.csv')
-    if not os.path.exists(sales_path):
-        print(f"Sales file not found: {sales_path}")
-        return None
-    
-    print(f"Loading Sales from {sales_path}...")
-    df_sales = pd.read_csv(sales_path, low_memory=False)
-    
-    # Identify Price column
-    price_col = next((c for c in df_sales.columns if 'PRICE' in c.upper()), None)
-    if not price_col:
-        print("Could not find Price column in Sales.")
-        return None
-    
-    df_sales = df_sales.dropna(subset=['PARID', price_col])
-    # Filter out zero/low prices
-    df_sales = df_sales[df_sales[price_col] > 1000] 
-            
-    print(f"Sales records loaded: {len(df_sales)}")
-
-    # 2. Load Residential Building Data (Characteristics)
-    bldg_path = os.path.join(data_dir, 'VCPA_CAMA_RES_BLDG.csv')
-    if os.path.exists(bldg_path):
-        print(f"Loading Building Data from {bldg_path}...")
-        use_cols = ['PARID', 'YRBLT', 'RMBED', 'FIXBATH', 'SFLA', 'TOTAL_AREA', 'STORIES', 'EXTWALL_DESC', 'ROOF_COVER_DESC']
-        try:
-            df_bldg = pd.read_csv(bldg_path, usecols=lambda c: c in use_cols or c == 'PARID', low_memory=False)
-            
-            # Deduplicate Building data: One parcel might have multiple buildings. 
-            if 'SFLA' in df_bldg.columns:
-                df_bldg = df_bldg.sort_values('SFLA', ascending=False).drop_duplicates('PARID')
-            else:
-                df_bldg = df_bldg.drop_duplicates('PARID')
-                
-            print(f"Building records loaded: {len(df_bldg)}")
-            
-            # Merge
-            df_sales = pd.merge(df_sales, df_bldg, on='PARID', how='inner')
-            print(f"Merged Sales + Bldg: {len(df_sales)}")
-            
-        except ValueError as e:
-            print(f"Error loading Building data columns: {e}")
-    else:
-        print("Warning: VCPA_CAMA_RES_BLDG.csv not found. Skipping building features.")
-
-    # 3. Load Parcel Data (Location/Nbhd + Tax Values)
-    # We need to load them to merge, even if we drop leakage later.
-    parcel_path = os.path.join(data_dir, 'VCPA_CAMA_PARCEL.csv')
-    if os.path.exists(parcel_path):
-        print(f"Loading Parcel Data from {parcel_path}...")
-        use_cols = ['PARID', 'NBHD', 'NBHD_DESC', 'LUC', 'LUC_DESC', 
-                    'APRLAND', 'APRBLDG', 'APRTOT', 
-                    'SASD', 'NSASD', 'STXBL', 'NSTXBL', 'COTXBL', 'CITXBL']
-        try:
-            df_parcel = pd.read_csv(parcel_path, usecols=lambda c: c in use_cols or c == 'PARID', low_memory=False)
-            df_parcel = df_parcel.drop_duplicates('PARID')
-            
-            print(f"Parcel records loaded: {len(df_parcel)}")
-            
-            # Merge
-            df_sales = pd.merge(df_sales, df_parcel, on='PARID', how='inner')
-            print(f"Merged Sales + Parcel: {len(df_sales)}")
-            
-        except ValueError as e:
-            print(f"Error loading Parcel data columns: {e}")
-    else:
-        print("Warning: VCPA_CAMA_PARCEL.csv not found. Skipping parcel features.")
-
-    return df_sales
-
 def log_stats(text, mode='a'):
     """Appends stats to the markdown file."""
     timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
@@ -107,57 +39,155 @@ def get_basic_stats(df, label="Dataset"):
     if 'PRICE' in df.columns:
         stats += f"- Price Mean: ${df['PRICE'].mean():,.2f}\n"
         stats += f"- Price Median: ${df['PRICE'].median():,.2f}\n"
+    stats += get_memory_stats(df)
     return stats
 
-def main():
-    print("--- 01_PREPROCESS_DATA ---")
-    
-    # 1. Load Data
-    df = load_and_merge_data()
-    
-    if df is None or df.empty:
-        print("Error: No data loaded.")
-        return
+def clean_data(df):
+    """Drops leakage columns and applies basic cleaning. Row-local, so it can run on new rows only."""
+    # 2. Drop Leakage Columns
+    print("Dropping Leakage Columns (2026 Tax Values)...")
+    with profiling.step('drop_leakage', rows=len(df)):
+        cols_to_drop = []
+        for col in df.columns:
+            upper_col = col.upper()
+            # Check if any leakage keyword is in the column name
+            if any(leak in upper_col for leak in LEAKAGE_COLUMNS):
+                cols_to_drop.append(col)
+
+        print(f"Dropping {len(cols_to_drop)} columns: {cols_to_drop}")
+        df = df.drop(columns=cols_to_drop)
 
+    # 3. Basic Cleaning
+    with profiling.step('fill_missing', rows=len(df)):
+        # Remove Price < 1000 (Already done in loader usually, but safety check)
+        if 'PRICE' in df.columns:
+             df = df[df['PRICE'] > 1000]
+
+        # Fill NaNs for numericals (simple strategy for now)
+        # Categorical codes/descriptions are not numeric, so they keep their NaNs.
+        numeric_cols = df.select_dtypes(include=[np.number]).columns
+        df[numeric_cols] = df[numeric_cols].fillna(0)
+
+    # 4. Compact dtypes (categoricals, downcast integers, float32)
+    with profiling.step('dtypes', rows=len(df)):
+        return apply_dtype_policy(df)
+
+def _init_stats_file():
     # Initialize stats file if not exists
     if not os.path.exists(STATS_FILE):
         with open(STATS_FILE, 'w') as f:
             f.write("# Data Statistics Log\n")
 
-    raw_stats = get_basic_stats(df, "Raw Merged Data")
+def _sale_index(keys):
+    return pd.MultiIndex.from_frame(keys[SALE_KEY].astype(str))
 
-    # 2. Drop Leakage Columns
-    print("Dropping Leakage Columns (2026 Tax Values)...")
-    cols_to_drop = []
-    for col in df.columns:
-        upper_col = col.upper()
-        # Check if any leakage keyword is in the column name
-        if any(leak in upper_col for leak in LEAKAGE_COLUMNS):
-            cols_to_drop.append(col)
-            
-    print(f"Dropping {len(cols_to_drop)} columns: {cols_to_drop}")
-    df = df.drop(columns=cols_to_drop)
+def main(export_csv=False, use_cache=True, data_dir=DATA_DIR):
+    print("--- 01_PREPROCESS_DATA ---")
+    
+    with profiling.Profiler('01_preprocess_data') as profiler:
+        # 1. Load Data
+        load_stats = {}
+        sale_keys = []
+        with profiling.step('load') as record:
+            df = load_and_merge_data(data_dir, stats=load_stats, use_cache=use_cache,
+                                     on_sales=lambda sales: sale_keys.append(sales[SALE_KEY]))
+            record['rows'] = len(df) if df is not None else None
 
-    # 3. Basic Cleaning
-    # Remove Price < 1000 (Already done in loader usually, but safety check)
-    if 'PRICE' in df.columns:
-         df = df[df['PRICE'] > 1000]
+        if df is None or df.empty:
+            print("Error: No data loaded.")
+            return
 
-    # Fill NaNs for numericals (simple strategy for now)
-    numeric_cols = df.select_dtypes(include=[np.number]).columns
-    df[numeric_cols] = df[numeric_cols].fillna(0)
-    
-    # 4. Save
-    print(f"Saving processed data to {OUTPUT_FILE}...")
-    df.to_csv(OUTPUT_FILE, index=False)
-    
-    # 5. Log Stats
+        _init_stats_file()
+        raw_stats = get_load_stats(load_stats) + "\n" + get_basic_stats(df, "Raw Merged Data")
+
+        with profiling.step('clean', rows=len(df)):
+            df = clean_data(df)
+
+        # 5. Save
+        print(f"Saving processed data to {OUTPUT_FILE}...")
+        with profiling.step('save', rows=len(df)):
+            save_frame(df, OUTPUT_FILE, export_csv=export_csv)
+            save_frame(sale_keys[0], PROCESSED_KEYS_FILE)
+
+    # 6. Log Stats
+    profiler.write()
     processed_stats = get_basic_stats(df, "Processed Data (Leakage Removed)")
-    log_stats(raw_stats + "\n" + processed_stats)
+    log_stats(raw_stats + "\n" + processed_stats + "\n" + profiler.markdown())
     
     print("Done.")
     print(raw_stats)
     print(processed_stats)
 
+def main_incremental(export_csv=False, use_cache=True, data_dir=DATA_DIR):
+    """
+    Processes only sales not yet considered by an earlier run (matched on PARID + SALEDT +
+    PRICE against PROCESSED_KEYS_FILE) and appends them. Sales an earlier run dropped (no
+    building or parcel row, or removed by cleaning) are not retried. A run without new
+    sales writes nothing. Falls back to a full run if there is no processed data yet.
+    """
+    print("--- 01_PREPROCESS_DATA (incremental) ---")
+    if not frame_exists(OUTPUT_FILE):
+        print(f"{OUTPUT_FILE} not found, running full preprocessing.")
+        return main(export_csv=export_csv, use_cache=use_cache, data_dir=data_dir)
+
+    with profiling.Profiler('01_preprocess_data') as profiler:
+        # Processed data written before the keys file existed: its own keys are the best known
+        keys_file = PROCESSED_KEYS_FILE if frame_exists(PROCESSED_KEYS_FILE) else OUTPUT_FILE
+        known_keys = load_frame(keys_file, columns=SALE_KEY)
+        print(f"Sales already processed: {len(known_keys)} (from {keys_file})")
+
+        # 1. Find new sales (anti-join on the sale key)
+        load_stats = {}
+        with profiling.step('load:Sales') as record:
+            df_sales, rows_read = load_sales(data_dir, use_cache=use_cache)
+            record.update(rows=len(df_sales), rows_read=rows_read)
+        with profiling.step('find_new', rows=len(df_sales)):
+            df_new = df_sales[~_sale_index(df_sales).isin(_sale_index(known_keys))]
+        load_stats['Sales'] = {'rows_read': rows_read, 'rows_kept': len(df_new)}
+        print(f"New sales: {len(df_new)} of {len(df_sales)}")
+
+        if df_new.empty:
+            print("Processed data is up to date.")
+            return
+        new_keys = df_new[SALE_KEY]
+
+        # 2. Merge + clean the new rows only
+        df_new = merge_property_tables(df_new, data_dir, stats=load_stats, use_cache=use_cache)
+        _init_stats_file()
+        raw_stats = get_load_stats(load_stats) + "\n" + get_basic_stats(df_new, "New Raw Merged Data")
+        with profiling.step('clean', rows=len(df_new)):
+            df_new = clean_data(df_new)
+
+        # 3. Append (the processed data is only rewritten if a new sale made it through)
+        with profiling.step('append', rows=len(df_new)):
+            if df_new.empty:
+                df = None
+                print(f"None of the {len(new_keys)} new sales made it through the joins and cleaning.")
+            else:
+                df = concat_frames([load_frame(OUTPUT_FILE), df_new])
+                print(f"Appending {len(df_new)} records, saving {len(df)} to {OUTPUT_FILE}...")
+                save_frame(df, OUTPUT_FILE, export_csv=export_csv)
+            save_frame(concat_frames([known_keys, new_keys]).reset_index(drop=True), PROCESSED_KEYS_FILE)
+
+    profiler.write()
+    processed_stats = get_basic_stats(df_new, "New Processed Rows (Leakage Removed)")
+    if df is not None:
+        processed_stats += "\n" + get_basic_stats(df, "Processed Data (After Append)")
+    log_stats(raw_stats + "\n" + processed_stats + "\n" + profiler.markdown())
+
+    print("Done.")
+    print(processed_stats)
+
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Load, merge and clean the raw VCPA tables.")
+    parser.add_argument('--csv', action='store_true', help="Also export a CSV copy of the processed data.")
+    parser.add_argument('--incremental', action='store_true', help="Only process sales no earlier run has processed and append them.")
+    parser.add_argument('--no-cache', action='store_true', help="Parse the raw tables without using the raw-table cache.")
+    parser.add_argument('--clear-cache', action='store_true', help="Invalidate the raw-table cache before loading.")
+    args = parser.parse_args()
+    if args.clear_cache:
+        cache.clear(RAW_CACHE_NAMESPACE)
+    if args.incremental:
+        main_incremental(export_csv=args.csv, use_cache=not args.no_cache)
+    else:
+        main(export_csv=args.csv, use_cache=not args.no_cache)
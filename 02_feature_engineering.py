@@ -1,12 +1,28 @@
 import pandas as pd
 import numpy as np
 import os
+import argparse
 from datetime import datetime
+from storage import PROCESSED_FILE, ENGINEERED_FILE, frame_exists, load_frame, save_frame
+from data_loader import concat_frames
+from dtypes import apply_dtype_policy, get_memory_stats
+from features import ALL_FEATURES, ASOF_FEATURES, compute_features, row_features
+import profiling
 
-INPUT_FILE = 'processed_data.csv'
-OUTPUT_FILE = 'engineered_features.csv'
+INPUT_FILE = PROCESSED_FILE
+OUTPUT_FILE = ENGINEERED_FILE
+# Per-NBHD SFLA histogram backing NBHD_Median_Size (for --incremental)
+NBHD_SIZE_COUNTS_FILE = 'nbhd_size_counts.parquet'
+# A sale is identified by parcel + sale date + price
+SALE_KEY = ['PARID', 'SALEDT', 'PRICE']
 STATS_FILE = 'data_stats.md'
 
+# Every registered feature is written to the engineered file (see features.py).
+# Row features only depend on the row; aggregates use the per-NBHD medians;
+# as-of aggregates use the NBHD's earlier sales (one pass over all rows).
+ROW_FEATURES = row_features(ALL_FEATURES)
+AGGREGATE_FEATURES = [f for f in ALL_FEATURES if f not in ROW_FEATURES and f not in ASOF_FEATURES]
+
 def log_stats(text, mode='a'):
     """Appends stats to the markdown file."""
     timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
@@ -18,79 +34,165 @@ def get_basic_stats(df, label="Dataset"):
     stats = f"**{label}**\n"
     stats += f"- Shape: {df.shape}\n"
     stats += f"- Columns: {', '.join(df.columns)}\n"
+    stats += get_memory_stats(df)
     return stats
 
-def main():
+def add_row_features(df):
+    """Adds the per-row features (date parts, ratios, polynomials). Only depends on the row itself."""
+    return compute_features(df, ROW_FEATURES)
+
+def nbhd_size_counts(df):
+    """
+    Per-neighborhood histogram of SFLA values: (NBHD, SFLA, count).
+    Medians can't be updated from old medians, but they can from these counts,
+    which is what makes --incremental exact.
+    """
+    return (df.dropna(subset=['NBHD', 'SFLA'])
+              .groupby(['NBHD', 'SFLA'], observed=True).size()
+              .rename('count').reset_index())
+
+def merge_size_counts(*counts):
+    combined = pd.concat(counts, ignore_index=True)
+    return combined.groupby(['NBHD', 'SFLA'], observed=True)['count'].sum().reset_index()
+
+def medians_from_counts(counts):
+    """Exact per-NBHD median of SFLA from the (NBHD, SFLA, count) histogram."""
+    counts = counts.sort_values(['NBHD', 'SFLA'])
+    grouped = counts.groupby('NBHD', observed=True)['count']
+    total = grouped.transform('sum')
+    cum = grouped.cumsum()
+    # The median averages the values at (0-based) positions (n-1)//2 and n//2;
+    # the value at position p is the first SFLA whose cumulative count exceeds p.
+    lower = counts['SFLA'].where(cum > (total - 1) // 2).groupby(counts['NBHD'], observed=True).first()
+    upper = counts['SFLA'].where(cum > total // 2).groupby(counts['NBHD'], observed=True).first()
+    return (lower + upper) / 2
+
+def apply_nbhd_aggregates(df, nbhd_median_size):
+    """Adds the neighborhood aggregate features from an NBHD -> median SFLA lookup."""
+    return compute_features(df, AGGREGATE_FEATURES, context={'nbhd_median_size': nbhd_median_size})
+
+def add_asof_features(df):
+    """Adds the as-of neighborhood aggregates (sales of the NBHD before each row's SALEDT)."""
+    if all(col in df.columns for col in ['NBHD', 'SFLA', 'SALEDT', 'PRICE']):
+        print("Calculating As-Of Neighborhood Aggregates...")
+        df = compute_features(df, ASOF_FEATURES)
+    return df
+
+def main(export_csv=False):
     print("--- 02_FEATURE_ENGINEERING ---")
     
-    if not os.path.exists(INPUT_FILE):
+    if not frame_exists(INPUT_FILE):
         print(f"Error: {INPUT_FILE} not found. Run 01_preprocess_data.py first.")
         return
         
     print(f"Loading {INPUT_FILE}...")
-    df = pd.read_csv(INPUT_FILE, low_memory=False) # low_memory=False for safety
-    raw_stats = get_basic_stats(df, "Input Data")
+    with profiling.Profiler('02_feature_engineering') as profiler:
+        with profiling.step('load') as record:
+            df = load_frame(INPUT_FILE)
+            record['rows'] = len(df)
+        raw_stats = get_basic_stats(df, "Input Data")
 
-    print("Adding Features...")
-    
-    # 1. Date Features
-    if 'SALEDT' in df.columns:
-        dt = pd.to_datetime(df['SALEDT'], errors='coerce')
-        df['SaleYear'] = dt.dt.year
-        df['Month'] = dt.dt.month
-        # Drop raw date to save space/confusion (optional, but good practice)
-        # df = df.drop(columns=['SALEDT']) 
-    elif 'TAXYR' in df.columns:
-        df['SaleYear'] = df['TAXYR']
-        df['Month'] = 1
-        
-    # 2. House Age & Polynomials
-    if 'YRBLT' in df.columns and 'SaleYear' in df.columns:
-        df['HouseAge'] = df['SaleYear'] - df['YRBLT']
-        df['HouseAge'] = df['HouseAge'].clip(lower=0) # Fix negatives
-        
-        # Polynomial: Age^2 (Depreciation curve)
-        df['HouseAge_Squared'] = df['HouseAge'] ** 2
+        print("Adding Features...")
+        df = add_row_features(df)
 
-    # 3. Size Ratios & Polynomials
-    if 'SFLA' in df.columns:
-        # Polynomial: Size^2 (Luxury scaling)
-        df['SFLA_Squared'] = df['SFLA'] ** 2
-        
-        if 'TOTAL_AREA' in df.columns:
-            # Efficiency Ratio (Living / Total) - Avoid div by zero
-            df['Efficiency_Ratio'] = df['SFLA'] / df['TOTAL_AREA'].replace(0, np.nan)
-            df['Efficiency_Ratio'] = df['Efficiency_Ratio'].fillna(0)
-            
-    # 4. Bed/Bath Ratio
-    if 'RMBED' in df.columns and 'FIXBATH' in df.columns:
-        df['Bed_Bath_Ratio'] = df['RMBED'] / df['FIXBATH'].replace(0, np.nan)
-        df['Bed_Bath_Ratio'] = df['Bed_Bath_Ratio'].fillna(0)
-
-    # Note: Neighborhood Aggregates (Median Size/Age) could be added here
-    # calculating them on the full dataset technically leaks 'future' test data stats 
-    # into training rows if we don't be careful. 
-    # Ideally, these are calculated inside the CV loop or split. 
-    # For simplicity in this script, we'll skip global aggregates to be strict on leakage,
-    # or we accept that 'Neighborhood Character' is static enough.
-    # Let's add them as they are powerful.
-    if 'NBHD' in df.columns and 'SFLA' in df.columns:
-        print("Calculating Neighborhood Aggregates...")
-        nbhd_median_size = df.groupby('NBHD')['SFLA'].median()
-        df['NBHD_Median_Size'] = df['NBHD'].map(nbhd_median_size)
-        
-        # Is this house larger than neighbors?
-        df['Size_vs_NBHD'] = df['SFLA'] - df['NBHD_Median_Size']
+        # Note: Neighborhood Aggregates (Median Size/Age) could be added here
+        # calculating them on the full dataset technically leaks 'future' test data stats 
+        # into training rows if we don't be careful. 
+        # Ideally, these are calculated inside the CV loop or split. 
+        # For simplicity in this script, we'll skip global aggregates to be strict on leakage,
+        # or we accept that 'Neighborhood Character' is static enough.
+        # Let's add them as they are powerful.
+        if 'NBHD' in df.columns and 'SFLA' in df.columns:
+            print("Calculating Neighborhood Aggregates...")
+            with profiling.step('nbhd_size_counts', rows=len(df)):
+                counts = nbhd_size_counts(df)
+            df = apply_nbhd_aggregates(df, medians_from_counts(counts))
+            # Kept so --incremental can update the medians exactly
+            save_frame(counts, NBHD_SIZE_COUNTS_FILE)
+        df = add_asof_features(df)
 
-    # 5. Save
-    print(f"Saving engineered data to {OUTPUT_FILE}...")
-    df.to_csv(OUTPUT_FILE, index=False)
-    
+        # 5. Save
+        with profiling.step('dtypes', rows=len(df)):
+            df = apply_dtype_policy(df)
+        print(f"Saving engineered data to {OUTPUT_FILE}...")
+        with profiling.step('save', rows=len(df)):
+            save_frame(df, OUTPUT_FILE, export_csv=export_csv)
+
+    profiler.write()
     processed_stats = get_basic_stats(df, "Engineered Data")
-    log_stats(raw_stats + "\n" + processed_stats)
+    log_stats(raw_stats + "\n" + processed_stats + "\n" + profiler.markdown())
     
     print("Done.")
     print(processed_stats)
 
+def main_incremental(export_csv=False):
+    """
+    Engineers features only for processed rows not yet in the engineered data
+    (matched on PARID + SALEDT + PRICE) and appends them. Neighborhood medians are updated
+    from the stored SFLA histogram, and rewritten for every row of an affected NBHD.
+    As-of aggregates are recomputed over all rows, since a late-published older sale
+    changes the values of every later sale in its NBHD.
+    """
+    print("--- 02_FEATURE_ENGINEERING (incremental) ---")
+    if not frame_exists(OUTPUT_FILE) or not frame_exists(NBHD_SIZE_COUNTS_FILE):
+        print("No previous engineered data, running full feature engineering.")
+        return main(export_csv=export_csv)
+
+    with profiling.Profiler('02_feature_engineering') as profiler:
+        with profiling.step('find_new') as record:
+            existing_keys = load_frame(OUTPUT_FILE, columns=SALE_KEY)
+            df_processed = load_frame(INPUT_FILE)
+            is_known = pd.MultiIndex.from_frame(df_processed[SALE_KEY].astype(str)).isin(
+                pd.MultiIndex.from_frame(existing_keys.astype(str))
+            )
+            df_new = df_processed[~is_known].reset_index(drop=True)
+            record['rows'] = len(df_processed)
+            del df_processed
+        print(f"New records: {len(df_new)}")
+
+        if df_new.empty:
+            print("Engineered data is up to date.")
+            return
+
+        raw_stats = get_basic_stats(df_new, "New Input Data")
+        df_new = add_row_features(df_new)
+        with profiling.step('load') as record:
+            df = load_frame(OUTPUT_FILE)
+            record['rows'] = len(df)
+
+        if 'NBHD' in df_new.columns and 'SFLA' in df_new.columns:
+            print("Updating Neighborhood Aggregates...")
+            counts = merge_size_counts(load_frame(NBHD_SIZE_COUNTS_FILE), nbhd_size_counts(df_new))
+            nbhd_median_size = medians_from_counts(counts)
+
+            affected = df['NBHD'].isin(df_new['NBHD'].unique())
+            print(f"Neighborhoods affected: {df_new['NBHD'].nunique()} ({affected.sum()} existing rows updated)")
+            updated = apply_nbhd_aggregates(df.loc[affected, ['NBHD', 'SFLA']].copy(), nbhd_median_size)
+            df.loc[affected, AGGREGATE_FEATURES] = updated[AGGREGATE_FEATURES]
+            df_new = apply_nbhd_aggregates(df_new, nbhd_median_size)
+            save_frame(counts, NBHD_SIZE_COUNTS_FILE)
+
+        df = concat_frames([df, apply_dtype_policy(df_new)])
+        df = add_asof_features(df)
+        with profiling.step('dtypes', rows=len(df)):
+            df = apply_dtype_policy(df)
+        print(f"Saving engineered data to {OUTPUT_FILE}...")
+        with profiling.step('save', rows=len(df)):
+            save_frame(df, OUTPUT_FILE, export_csv=export_csv)
+
+    profiler.write()
+    processed_stats = get_basic_stats(df, "Engineered Data (After Append)")
+    log_stats(raw_stats + "\n" + processed_stats + "\n" + profiler.markdown())
+
+    print("Done.")
+    print(processed_stats)
+
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Generate model features from the processed data.")
+    parser.add_argument('--csv', action='store_true', help="Also export a CSV copy of the engineered features.")
+    parser.add_argument('--incremental', action='store_true', help="Only engineer rows not yet in the engineered data and append them.")
+    args = parser.parse_args()
+    if args.incremental:
+        main_incremental(export_csv=args.csv)
+    else:
+        main(export_csv=args.csv)
@@ -3,23 +3,54 @@ import numpy as np
 import os
 import time
 import hashlib
+import functools
+import argparse
 from datetime import datetime
 from sklearn.model_selection import KFold
 from sklearn.metrics import mean_squared_error, r2_score
 import xgboost as xgb
+import cache
+import profiling
+from storage import ENGINEERED_FILE, csv_path_for, frame_columns, load_frame
+from dtypes import to_model_matrix
+from features import DEFAULT_FEATURES, compute_features, get_feature_hash, load_plan
+from parallel import CPU_BUDGET, run_tasks, split_cpu_budget
+from target_encoding import fold_encodings, out_of_fold
 
 # Configuration
-INPUT_FILE = 'engineered_features.csv'
+INPUT_FILE = ENGINEERED_FILE
 EXPERIMENTS_FILE = 'experiments.csv'
+N_FOLDS = 5
+CV_SEED = 42
+
+# Finished experiments are cached (fold metrics + out-of-fold predictions), keyed by
+# input data, period, features, params and the code of this script and every local module
+# it imports (found by parsing the imports, see cache.local_modules); see experiment_key().
+EXPERIMENT_CACHE_NAMESPACE = 'experiments'
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPT_FILE = '03_train_model.py'
+# Params that change how fast an experiment runs, not its result
+RUNTIME_PARAMS = ['n_jobs']
+
+STAGE1_BINS = 100
+# Smoothing of the NBHD target encoding toward the mean price (0 = plain NBHD mean)
+TE_SMOOTHING = 0.0
+# Params handled by the CV loop itself rather than passed to XGBoost
+NON_BOOSTER_PARAMS = ['n_estimators', 'early_stopping_rounds', 'stage1_bins', 'stage1_oof']
+# Per-fold stage-1 bin predictions are cached here (see run_fold)
+STAGE1_CACHE_NAMESPACE = 'stage1'
+# Early stopping (params['early_stopping_rounds']): share of each fold's training rows held out
+EARLY_STOPPING_FRACTION = 0.1
+DEFAULT_MAX_BIN = 256
+# XGBRegressor param names -> native xgb.train names
+SKLEARN_TO_NATIVE = {'learning_rate': 'eta', 'random_state': 'seed', 'n_jobs': 'nthread'}
+
+# Feature matrix of the running experiment, per worker process (see _init_fold_data)
+_FOLD_DATA = {}
 
 # Default Experiment Settings
 DEFAULT_START_YEAR = 2015
 DEFAULT_END_YEAR = 2019
-DEFAULT_FEATURES = [
-    'SFLA', 'RMBED', 'YRBLT', 'NBHD', 'LUC', 'Month', 
-    'HouseAge_Squared', 'Bed_Bath_Ratio',
-    'NBHD_Median_Size', 'Size_vs_NBHD', 'SFLA_Squared'
-]
 DEFAULT_PARAMS = {
     'n_estimators': 1000,
     'learning_rate': 0.05,
@@ -31,7 +62,7 @@ DEFAULT_PARAMS = {
 def log_experiment(start_year, end_year, features, params, metrics):
     """Logs experiment results to CSV."""
     timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    feature_hash = hashlib.md5(str(sorted(features)).encode()).hexdigest()[:8]
+    feature_hash = get_feature_hash(features)
     
     row = {
         'Timestamp': timestamp,
@@ -43,36 +74,254 @@ def log_experiment(start_year, end_year, features, params, metrics):
         'R2_Std': metrics['r2_std'],
         'RMSE_Mean': metrics['rmse_mean']
     }
+    if 'experiment_key' in metrics:
+        row['Experiment_Key'] = metrics['experiment_key']
+    if 'fold_seconds' in metrics:
+        row['Fold_Seconds'] = str(metrics['fold_seconds'])
+        row['CV_Seconds'] = metrics.get('cv_seconds')
+    if 'search' in metrics:
+        row['Search'] = metrics['search']
+    if 'best_iteration' in metrics:
+        row['Best_Iteration'] = metrics['best_iteration']
+        row['Train_Seconds_Saved'] = metrics['train_seconds_saved']
+    if 'stage2_seconds' in metrics:
+        # Per-step resource totals over the folds (records in profiling.PROFILE_FILE)
+        row['Stage1_Seconds'] = metrics['stage1_seconds']
+        row['Stage2_Seconds'] = metrics['stage2_seconds']
+        row['Predict_Seconds'] = metrics['predict_seconds']
+        row['CPU_Seconds'] = metrics['cpu_seconds']
+        row['Peak_RSS_MB'] = metrics['peak_rss_mb']
+        row['Train_Rows_Per_Second'] = metrics['train_rows_per_second']
+        row['Profile_Run'] = metrics.get('profile_run')
     
     df_row = pd.DataFrame([row])
     
     if not os.path.exists(EXPERIMENTS_FILE):
         df_row.to_csv(EXPERIMENTS_FILE, index=False)
     else:
-        df_row.to_csv(EXPERIMENTS_FILE, mode='a', header=False, index=False)
+        header = pd.read_csv(EXPERIMENTS_FILE, nrows=0).columns.tolist()
+        if set(df_row.columns) - set(header):
+            # New columns: rewrite with the extended header (older rows are left blank)
+            df_all = pd.concat([pd.read_csv(EXPERIMENTS_FILE), df_row], ignore_index=True)
+            df_all.to_csv(EXPERIMENTS_FILE, index=False)
+        else:
+            df_row.reindex(columns=header).to_csv(EXPERIMENTS_FILE, mode='a', header=False, index=False)
     
     print(f"Experiment logged to {EXPERIMENTS_FILE}")
 
-def run_experiment(start_year=DEFAULT_START_YEAR, end_year=DEFAULT_END_YEAR, features=DEFAULT_FEATURES, params=DEFAULT_PARAMS):
-    print(f"\n--- Running Experiment: {start_year}-{end_year} ---")
-    print(f"Features ({len(features)}): {features}")
-    
-    # 1. Load Data
+@functools.lru_cache(maxsize=None)
+def code_version():
+    """Content hash of the code that determines experiment results (the code of this process: computed once)."""
+    hashes = [cache.file_fingerprint(os.path.join(BASE_DIR, name))['content_hash']
+              for name in sorted(cache.local_modules(SCRIPT_FILE, BASE_DIR))]
+    return cache.make_key(*hashes)
+
+def experiment_key(start_year, end_year, features, params):
+    """
+    Cache key of an experiment: input data fingerprint, period, sorted features,
+    result-relevant params, CV setup and code version.
+    """
+    data_path = INPUT_FILE if os.path.exists(INPUT_FILE) else csv_path_for(INPUT_FILE)
+    result_params = {k: v for k, v in params.items() if k not in RUNTIME_PARAMS}
+    return cache.make_key(
+        cache.file_fingerprint(data_path), start_year, end_year, sorted(features),
+        result_params, N_FOLDS, CV_SEED, code_version()
+    )
+
+def booster_params(params, n_jobs):
+    """XGBRegressor-style params -> (native xgb.train params, number of boosting rounds)."""
+    native = {'objective': 'reg:squarederror', 'tree_method': 'hist', 'max_bin': DEFAULT_MAX_BIN}
+    for name, value in params.items():
+        if name not in NON_BOOSTER_PARAMS:
+            native[SKLEARN_TO_NATIVE.get(name, name)] = value
+    # nthread comes from the CPU budget split, not from params
+    native['nthread'] = n_jobs
+    return native, params.get('n_estimators', 100)
+
+def _init_fold_data(datasets):
+    """
+    Runs once per worker process: the experiment matrices ({data_id: data}) are handed over
+    once, not per fold. Their quantile cuts are sketched lazily (see _reference) and reused
+    by every fold and both stages instead of re-sketching per-fold pandas copies.
+    """
+    _FOLD_DATA.clear()
+    _FOLD_DATA.update(datasets)
+    _FOLD_DATA['refs'] = {}
+
+def _reference(data_id, params, n_jobs):
+    """Quantile cuts of an experiment matrix, sketched once per process per (stage-1 bins, max_bin)."""
+    q = params.get('stage1_bins', STAGE1_BINS)
+    max_bin = booster_params(params, n_jobs)[0]['max_bin']
+    refs = _FOLD_DATA['refs']
+    if (data_id, q, max_bin) not in refs:
+        X = _FOLD_DATA[data_id]['X']
+        # Reference values for the Predicted_PriceBin column: an even spread over the bin indices
+        X[:, -1] = np.linspace(0, q - 1, len(X))
+        refs[(data_id, q, max_bin)] = xgb.QuantileDMatrix(X, max_bin=max_bin, nthread=n_jobs)
+    return refs[(data_id, q, max_bin)]
+
+def _fit_stage1(X, y, q, ref, n_jobs):
+    # Create bins based on TRAIN y
+    # 100 bins (params['stage1_bins'])
+    y_bins = pd.qcut(y, q=q, labels=False, duplicates='drop')
+
+    # Train Stage 1 Classifier (Using Regressor on bin index as per paper implication or simplifiction)
+    # Paper likely used Classifier or Regressor on bin ID. Let's use Regressor for speed/simplicity
+    # to predict "Bin Index"
+    stage1_params, stage1_rounds = booster_params({'n_estimators': 100, 'random_state': 42}, n_jobs)
+    dtrain = xgb.QuantileDMatrix(X, label=y_bins, ref=ref, nthread=n_jobs)
+    return xgb.train(stage1_params, dtrain, num_boost_round=stage1_rounds)
+
+def stage1_predictions(X_train, y_train, X_val, q, ref, n_jobs, use_oof=False):
+    """
+    Predicted price bins of a fold's (TRAIN rows, VAL rows); VAL rows come from a stage-1
+    model fitted on all TRAIN rows. With use_oof, every TRAIN row is predicted by an inner
+    K-fold model that did not see it, so stage 2 trains on the same out-of-sample kind of
+    bin prediction it is evaluated on.
+    """
+    stage1_model = _fit_stage1(X_train, y_train, q, ref, n_jobs)
+    bin_pred_val = stage1_model.inplace_predict(X_val)
+    if not use_oof:
+        return stage1_model.inplace_predict(X_train), bin_pred_val
+
+    bin_pred_train = np.empty(len(X_train), dtype=np.float32)
+    inner = KFold(n_splits=N_FOLDS, shuffle=True, random_state=CV_SEED)
+    for inner_train, inner_val in inner.split(X_train):
+        inner_model = _fit_stage1(X_train[inner_train], y_train.iloc[inner_train], q, ref, n_jobs)
+        bin_pred_train[inner_val] = inner_model.inplace_predict(X_train[inner_val])
+    return bin_pred_train, bin_pred_val
+
+def run_fold(data_id, fold, train_index, val_index, params, n_jobs):
+    """
+    Trains and evaluates one CV fold of a data set handed to _init_fold_data. Returns its
+    metrics, plus its step records (result['profile'], see profiling.py).
+    """
+    start = time.perf_counter()
+    with profiling.Profiler('03_train_model') as profiler, profiling.step(f"fold_{fold}", rows=len(train_index)):
+        result = _run_fold(data_id, fold, train_index, val_index, params, n_jobs)
+    result.update(seconds=time.perf_counter() - start, profile=profiler.records, profile_started=profiler.started)
+    return result
+
+def _run_fold(data_id, fold, train_index, val_index, params, n_jobs):
+    """run_fold's work; its steps are named fold_<n>/<step>."""
+    data = _FOLD_DATA[data_id]
+    X, y = data['X'], data['y']
+    with profiling.step('quantile_sketch'):
+        ref = _reference(data_id, params, n_jobs)
+
+    # One float32 row copy per split, shared by both stages
+    X_train, X_val = X[train_index], X[val_index]
+    y_train, y_val = y.iloc[train_index], y.iloc[val_index]
+
+    # --- Preprocessing INSIDE Fold (Avoid Leakage) ---
+
+    # A. Target Encoding for NBHD (second to last column), from this fold's TRAIN means
+    if data['encodings'] is not None:
+        encoded = data['encodings'][fold - 1]
+        X_train[:, -2] = encoded[train_index]
+        X_val[:, -2] = encoded[val_index]
+
+    # --- Stage 1: Binning (Paper Strategy) ---
+    # The Predicted_PriceBin column (last) is all-missing while stage 1 trains, so no split can use it
+    X_train[:, -1] = np.nan
+    X_val[:, -1] = np.nan
+    # Stage-1 predictions only depend on the fold's stage-1 inputs, not on the stage-2 params,
+    # so they are cached per fold: sweeps over stage-2 params skip stage 1 entirely.
+    q = params.get('stage1_bins', STAGE1_BINS)
+    use_oof = bool(params.get('stage1_oof'))
+    max_bin = booster_params(params, n_jobs)[0]['max_bin']
+    stage1_key = cache.make_key(data['stage1_key'], fold, q, max_bin, use_oof)
+    cached, _ = cache.get_frame(STAGE1_CACHE_NAMESPACE, stage1_key)
+    if cached is not None:
+        bin_pred = cached['pred'].to_numpy()
+        X_train[:, -1] = bin_pred[train_index]
+        X_val[:, -1] = bin_pred[val_index]
+    else:
+        try:
+            with profiling.step('stage1_fit', rows=len(X_train)):
+                bin_pred_train, bin_pred_val = stage1_predictions(X_train, y_train, X_val, q, ref, n_jobs, use_oof)
+
+            # Add as Feature
+            X_train[:, -1] = bin_pred_train
+            X_val[:, -1] = bin_pred_val
+
+            bin_pred = np.full(len(X), np.nan, dtype=np.float32)
+            bin_pred[train_index] = bin_pred_train
+            bin_pred[val_index] = bin_pred_val
+            cache.put_frame(STAGE1_CACHE_NAMESPACE, stage1_key, pd.DataFrame({'pred': bin_pred}))
+
+        except Exception as e:
+            print(f"Stage 1 failed: {e}. Skipping to Stage 2.")
+
+    # --- Stage 2: Final Regressor ---
+    stage2_params, stage2_rounds = booster_params(params, n_jobs)
+    early_stopping_rounds = params.get('early_stopping_rounds')
+    train_start = time.perf_counter()
+    with profiling.step('stage2_fit', rows=len(X_train)):
+        if early_stopping_rounds:
+            # Early stopping on an inner validation split of the fold's training rows
+            # (the fold's own validation rows stay unseen)
+            inner = np.random.default_rng(CV_SEED + fold).random(len(X_train)) < EARLY_STOPPING_FRACTION
+            y_values = y_train.to_numpy()
+            dtrain = xgb.QuantileDMatrix(X_train[~inner], label=y_values[~inner], ref=ref, nthread=n_jobs)
+            dinner = xgb.QuantileDMatrix(X_train[inner], label=y_values[inner], ref=dtrain, nthread=n_jobs)
+            model = xgb.train(stage2_params, dtrain, num_boost_round=stage2_rounds, evals=[(dinner, 'inner_val')],
+                              early_stopping_rounds=early_stopping_rounds, verbose_eval=False)
+            best_rounds = model.best_iteration + 1
+        else:
+            dtrain = xgb.QuantileDMatrix(X_train, label=y_train, ref=ref, nthread=n_jobs)
+            model = xgb.train(stage2_params, dtrain, num_boost_round=stage2_rounds)
+            best_rounds = stage2_rounds
+    train_seconds = time.perf_counter() - train_start
+    # Rounds not trained, at this fold's measured time per round
+    rounds_trained = model.num_boosted_rounds()
+    seconds_saved = train_seconds / rounds_trained * (stage2_rounds - rounds_trained)
+
+    # Evaluate
+    with profiling.step('predict', rows=len(X_val)):
+        preds = model.inplace_predict(X_val, iteration_range=(0, best_rounds))
+
+    return {
+        'fold': fold,
+        'r2': r2_score(y_val, preds),
+        'rmse': np.sqrt(mean_squared_error(y_val, preds)),
+        'val_index': val_index,
+        'preds': preds,
+        'best_rounds': best_rounds,
+        'seconds_saved': seconds_saved
+    }
+
+def load_period_frame(start_year, end_year, features):
+    """
+    Loads the rows of a period with the columns needed for `features` (plus NBHD, PRICE
+    and the period column). Returns (df, period column).
+    """
+    # 1. Load Data (only the needed columns) + 2. Filter Time Period
+    # The period filter is pushed down into the Parquet read, so other years are never materialized.
+    # Features not stored in the engineered file are computed from their registered inputs.
     print("Loading data...")
-    df = pd.read_csv(INPUT_FILE, low_memory=False)
-    
-    # 2. Filter Time Period
-    if 'SaleYear' in df.columns:
-        df = df[(df['SaleYear'] >= start_year) & (df['SaleYear'] <= end_year)]
-    elif 'TAXYR' in df.columns: # Fallback if SaleYear missing
-         df = df[(df['TAXYR'] >= start_year) & (df['TAXYR'] <= end_year)]
+    file_columns = frame_columns(INPUT_FILE)
+    period_col = 'SaleYear' if 'SaleYear' in file_columns else 'TAXYR' # Fallback if SaleYear missing
+    df = load_frame(
+        INPUT_FILE,
+        columns=load_plan(list(features) + ['NBHD', 'PRICE'], file_columns) + [period_col],
+        filters=[(period_col, '>=', start_year), (period_col, '<=', end_year)]
+    )
+    missing = [f for f in features if f not in file_columns]
+    if missing:
+        print(f"Computing features not in {INPUT_FILE}: {missing}")
+        df = compute_features(df, missing)
          
     print(f"Data for {start_year}-{end_year}: {len(df)} records")
-    
-    if len(df) == 0:
-        print("No data found for this period.")
-        return
+    return df, period_col
 
+def build_experiment_data(df, features, splits=None, encodings=None, smoothing=TE_SMOOTHING):
+    """
+    Builds everything the folds of one experiment share from loaded rows: the experiment
+    matrix, the target, the fold splits and the fold NBHD target encodings (all folds in
+    one pass, see target_encoding.fold_encodings). `splits` and `encodings` only depend
+    on the rows, so they can be passed in from another feature set on the same rows.
+    """
     # 3. Prepare X and y
     target_col = 'PRICE'
     # Ensure all features exist
@@ -84,91 +333,211 @@ def run_experiment(start_year=DEFAULT_START_YEAR, end_year=DEFAULT_END_YEAR, fea
     if 'NBHD' not in valid_features and 'NBHD' in df.columns:
         valid_features.append('NBHD')
         
-    X = df[valid_features].copy()
-    y = df[target_col].copy()
-    
-    # 4. 5-Fold CV
-    kf = KFold(n_splits=5, shuffle=True, random_state=42)
-    
-    r2_scores = []
-    rmse_scores = []
-    
-    fold = 1
-    for train_index, val_index in kf.split(X):
-        print(f"  Fold {fold}/5...", end='\r')
-        
-        X_train, X_val = X.iloc[train_index].copy(), X.iloc[val_index].copy()
-        y_train, y_val = y.iloc[train_index], y.iloc[val_index]
-        
-        # --- Preprocessing INSIDE Fold (Avoid Leakage) ---
-        
-        # A. Target Encoding for NBHD
-        if 'NBHD' in X_train.columns:
-            # Calculate means on TRAIN
-            nbhd_means = y_train.groupby(X_train['NBHD']).mean()
-            global_mean = y_train.mean()
-            
-            # Map to TRAIN and VAL
-            X_train['NBHD_Encoded'] = X_train['NBHD'].map(nbhd_means).fillna(global_mean)
-            X_val['NBHD_Encoded'] = X_val['NBHD'].map(nbhd_means).fillna(global_mean)
-            
-            # Drop original NBHD (categorical) unless handled by model
-            X_train = X_train.drop(columns=['NBHD'])
-            X_val = X_val.drop(columns=['NBHD'])
-            
-        # --- Stage 1: Binning (Paper Strategy) ---
-        # Create bins based on TRAIN y
-        try:
-            # 100 bins
-            y_train_bins, bin_edges = pd.qcut(y_train, q=100, labels=False, retbins=True, duplicates='drop')
-            
-            # Train Stage 1 Classifier (Using Regressor on bin index as per paper implication or simplifiction)
-            # Paper likely used Classifier or Regressor on bin ID. Let's use Regressor for speed/simplicity
-            # to predict "Bin Index"
-            stage1_model = xgb.XGBRegressor(n_estimators=100, n_jobs=-1, random_state=42)
-            stage1_model.fit(X_train, y_train_bins)
-            
-            # Predict Bins
-            bin_pred_train = stage1_model.predict(X_train)
-            bin_pred_val = stage1_model.predict(X_val)
-            
-            # Add as Feature
-            X_train['Predicted_PriceBin'] = bin_pred_train
-            X_val['Predicted_PriceBin'] = bin_pred_val
-            
-        except Exception as e:
-            print(f"Stage 1 failed: {e}. Skipping to Stage 2.")
-            
-        # --- Stage 2: Final Regressor ---
-        model = xgb.XGBRegressor(**params)
-        model.fit(X_train, y_train)
-        
-        # Evaluate
-        preds = model.predict(X_val)
-        
-        r2 = r2_score(y_val, preds)
-        rmse = np.sqrt(mean_squared_error(y_val, preds))
-        
-        r2_scores.append(r2)
-        rmse_scores.append(rmse)
-        
-        fold += 1
-        
+    # Experiment matrix: one float32 array [model features..., (NBHD_Encoded), Predicted_PriceBin]
+    # for the whole period, quantized once (see _init_fold_data); folds take row copies of it.
+    model_cols = [f for f in valid_features if f != 'NBHD']
+    y = df[target_col].reset_index(drop=True)
+    nbhd = df['NBHD'].reset_index(drop=True) if 'NBHD' in valid_features else None
+    extra_cols = (['NBHD_Encoded'] if nbhd is not None else []) + ['Predicted_PriceBin']
+    X = np.empty((len(df), len(model_cols) + len(extra_cols)), dtype=np.float32)
+    X[:, :len(model_cols)] = to_model_matrix(df[model_cols]).to_numpy()
+    print(f"Feature matrix: {X.nbytes / 1024 ** 2:,.1f} MB ({len(model_cols)} features + {extra_cols})")
+
+    if splits is None:
+        kf = KFold(n_splits=N_FOLDS, shuffle=True, random_state=CV_SEED)
+        splits = list(kf.split(X))
+
+    # The NBHD_Encoded column holds reference values that only place the bin boundaries:
+    # the out-of-fold encoding (same distribution as the per-fold encodings, no row sees
+    # its own price). Predicted_PriceBin is filled per stage-1 bin count in _reference.
+    if nbhd is not None:
+        if encodings is None:
+            encodings = fold_encodings(nbhd, y, splits, smoothing)
+        X[:, -2] = out_of_fold(encodings, splits)
+    else:
+        encodings = None
+
+    return {'X': X, 'y': y, 'splits': splits, 'encodings': encodings, 'features': valid_features,
+            'stage1_key': stage1_data_key(X, y, splits, encodings)}
+
+def stage1_data_key(X, y, splits, encodings):
+    """
+    Content hash of everything stage 1 sees (matrix minus the Predicted_PriceBin column,
+    target, splits, fold encodings) plus the code version; run_fold adds fold and bin params.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    h.update(np.ascontiguousarray(X[:, :-1]).data)
+    h.update(y.to_numpy(dtype='float64').data)
+    for _, val_index in splits:
+        h.update(np.ascontiguousarray(val_index).data)
+    if encodings is not None:
+        h.update(encodings.data)
+    return cache.make_key(h.hexdigest(), list(X.shape), code_version())
+
+def load_experiment_data(start_year, end_year, features):
+    """Loads one period and builds its experiment data. Returns None if the period is empty."""
+    df, _ = load_period_frame(start_year, end_year, features)
+    if len(df) == 0:
+        print("No data found for this period.")
+        return None
+    return build_experiment_data(df, features)
+
+def cross_validate_runs(runs, cpu_budget=CPU_BUDGET, fold_jobs=None, n_folds=N_FOLDS, on_result=None):
+    """
+    Runs every fold of every (data, params) run in one process pool. The CPU budget is
+    split between concurrent folds and XGBoost threads per fold (workers * threads <= budget);
+    XGBoost results don't depend on the thread count, so metrics match a serial run.
+    Runs may share a data set (e.g. several param sets) or use different ones (e.g. feature
+    sets); each data set is handed to a worker once. `n_folds` < N_FOLDS evaluates only the
+    first folds. Returns, per run, its fold results in fold order.
+    """
+    datasets = {}
+    tasks = []
+    for data, params in runs:
+        data_id = next((i for i, d in datasets.items() if d is data), len(datasets))
+        datasets[data_id] = data
+        tasks.extend((data_id, fold, train_index, val_index, params)
+                     for fold, (train_index, val_index) in enumerate(data['splits'][:n_folds], start=1))
+    workers, n_jobs = split_cpu_budget(len(tasks), cpu_budget, max_workers=fold_jobs)
+    print(f"Running {len(tasks)} fold(s): {workers} at a time, {n_jobs} XGBoost thread(s) each")
+    results = run_tasks(run_fold, [task + (n_jobs,) for task in tasks], workers,
+                        initializer=_init_fold_data, initargs=(datasets,), on_result=on_result)
+    per_run = min(n_folds, N_FOLDS)
+    return [results[i:i + per_run] for i in range(0, len(results), per_run)]
+
+def cross_validate(data, trials, cpu_budget=CPU_BUDGET, fold_jobs=None, n_folds=N_FOLDS, on_result=None):
+    """cross_validate_runs for several param dicts (`trials`) on one data set."""
+    return cross_validate_runs([(data, params) for params in trials], cpu_budget, fold_jobs, n_folds, on_result)
+
+def summarize_folds(results, params):
+    """Aggregates fold results into (metrics dict, out-of-fold predictions)."""
+    # Results are in fold order, so the aggregates are exactly the serial ones
+    r2_scores = [float(r['r2']) for r in results]
+    rmse_scores = [float(r['rmse']) for r in results]
+    oof = pd.DataFrame({
+        'row': np.concatenate([r['val_index'] for r in results]),
+        'fold': np.concatenate([np.full(len(r['val_index']), r['fold']) for r in results]),
+        'pred': np.concatenate([r['preds'] for r in results])
+    }).sort_values('row', ignore_index=True)
+
+    metrics = {
+        'r2_mean': np.mean(r2_scores),
+        'r2_std': np.std(r2_scores),
+        'rmse_mean': np.mean(rmse_scores),
+        'fold_r2': r2_scores,
+        'fold_rmse': rmse_scores,
+        'fold_seconds': [round(r['seconds'], 2) for r in results]
+    }
+    if params.get('early_stopping_rounds'):
+        best_rounds = [r['best_rounds'] for r in results]
+        # Number of trees for a model trained without a validation split (see 04_export_model.py)
+        metrics['best_iteration'] = int(round(np.mean(best_rounds)))
+        metrics['fold_best_iterations'] = best_rounds
+        metrics['train_seconds_saved'] = round(sum(r['seconds_saved'] for r in results), 2)
+    metrics.update(resource_metrics([record for r in results for record in r.get('profile', [])]))
+    return metrics, oof
+
+def resource_metrics(records):
+    """Totals over the folds' step records (see run_fold) for the experiments.csv columns."""
+    if not records:
+        return {}
+    stage2_seconds = profiling.total(records, 'fold_*/stage2_fit')
+    return {
+        'stage1_seconds': round(profiling.total(records, 'fold_*/stage1_fit'), 2),
+        'stage2_seconds': round(stage2_seconds, 2),
+        'predict_seconds': round(profiling.total(records, 'fold_*/predict'), 3),
+        # Fold steps are top-level in their worker, so this is the folds' CPU time across processes
+        'cpu_seconds': round(profiling.total(records, 'fold_*', 'cpu_s'), 2),
+        'peak_rss_mb': profiling.peak(records),
+        'train_rows_per_second': round(profiling.total(records, 'fold_*/stage2_fit', 'rows') / stage2_seconds)
+                                 if stage2_seconds > 0 else None,
+    }
+
+def run_experiment(start_year=DEFAULT_START_YEAR, end_year=DEFAULT_END_YEAR, features=DEFAULT_FEATURES, params=DEFAULT_PARAMS,
+                   cpu_budget=CPU_BUDGET, fold_jobs=None, force=False, return_predictions=False):
+    """
+    Cross-validates the 2-stage model and logs the result. Returns the metrics dict
+    (per-fold metrics included); with return_predictions, metrics['oof_predictions']
+    holds the out-of-fold predictions (row, fold, pred) of the loaded period.
+    An experiment that already ran on the same data and code is served from the cache
+    (and not logged again) unless force=True.
+    """
+    print(f"\n--- Running Experiment: {start_year}-{end_year} ---")
+    print(f"Features ({len(features)}): {features}")
+
+    key = experiment_key(start_year, end_year, features, params)
+    if not force:
+        oof, cached = cache.get_frame(EXPERIMENT_CACHE_NAMESPACE, key)
+        if cached is not None:
+            metrics = cached['metrics']
+            print(f"Cached result (key {key}, run {cached['timestamp']}); use force=True / --force to re-run.")
+            print(f"Results: R2 = {metrics['r2_mean']:.4f} (+/- {metrics['r2_std']:.4f}), RMSE = {metrics['rmse_mean']:,.0f}")
+            if return_predictions:
+                metrics['oof_predictions'] = oof
+            return metrics
+
+    with profiling.Profiler('03_train_model') as profiler:
+        with profiling.step('load') as record:
+            data = load_experiment_data(start_year, end_year, features)
+            record['rows'] = len(data['y']) if data is not None else 0
+        if data is None:
+            return
+
+        # 4. 5-Fold CV
+        # Folds run concurrently in a process pool within the CPU budget (see cross_validate)
+        def report(result):
+            print(f"  Fold {result['fold']}/{N_FOLDS}: R2 = {result['r2']:.4f}, {result['seconds']:.1f}s")
+
+        cv_start = time.perf_counter()
+        with profiling.step('cv', rows=len(data['y'])):
+            results = cross_validate(data, [params], cpu_budget, fold_jobs, on_result=report)[0]
+        cv_seconds = time.perf_counter() - cv_start
+    for result in results:
+        profiler.extend(result['profile'], prefix='cv', started=result['profile_started'])
+    profiler.write()
+    metrics, oof = summarize_folds(results, params)
+    # Peak of the worker folds and of this process (data load)
+    metrics['peak_rss_mb'] = profiling.peak(profiler.records)
+    metrics['profile_run'] = profiler.run_id
+
     print(f"\nExperiment Complete.")
-    mean_r2 = np.mean(r2_scores)
-    std_r2 = np.std(r2_scores)
-    mean_rmse = np.mean(rmse_scores)
-    
-    print(f"Results: R2 = {mean_r2:.4f} (+/- {std_r2:.4f}), RMSE = {mean_rmse:,.0f}")
+    print(f"Results: R2 = {metrics['r2_mean']:.4f} (+/- {metrics['r2_std']:.4f}), RMSE = {metrics['rmse_mean']:,.0f}")
+    print(f"CV wall time: {cv_seconds:.1f}s (folds: {metrics['fold_seconds']})")
+    print(f"Stage 1: {metrics['stage1_seconds']:.1f}s, stage 2: {metrics['stage2_seconds']:.1f}s "
+          f"({metrics['train_rows_per_second'] or 0:,} rows/s), predict: {metrics['predict_seconds']:.2f}s, "
+          f"CPU: {metrics['cpu_seconds']:.1f}s, peak RSS: {metrics['peak_rss_mb']:,.0f} MB")
+    if 'best_iteration' in metrics:
+        print(f"Early stopping: best iterations {metrics['fold_best_iterations']} (of {params.get('n_estimators', 100)}), "
+              f"~{metrics['train_seconds_saved']:.1f}s training saved")
     
     # 5. Log
-    metrics = {
-        'r2_mean': mean_r2,
-        'r2_std': std_r2,
-        'rmse_mean': mean_rmse
-    }
-    log_experiment(start_year, end_year, valid_features, params, metrics)
+    metrics['cv_seconds'] = round(cv_seconds, 2)
+    metrics['experiment_key'] = key
+    log_experiment(start_year, end_year, data['features'], params, metrics)
+    store_experiment(key, metrics, oof)
+    if return_predictions:
+        metrics['oof_predictions'] = oof
+    return metrics
+
+def store_experiment(key, metrics, oof):
+    """Caches a finished experiment's metrics and out-of-fold predictions under its key."""
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    cache.put_frame(EXPERIMENT_CACHE_NAMESPACE, key, oof, meta={'metrics': metrics, 'timestamp': timestamp})
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cross-validate the 2-stage model and log the result to experiments.csv.")
+    parser.add_argument('--cpu-budget', type=int, default=CPU_BUDGET, help="Cores shared by concurrent folds and XGBoost threads (default: all).")
+    parser.add_argument('--fold-jobs', type=int, default=None, help="Max folds run at once (1 = serial; default: as many as the budget allows).")
+    parser.add_argument('--force', action='store_true', help="Re-run even if this experiment is cached.")
+    parser.add_argument('--early-stopping', type=int, default=None, metavar='ROUNDS',
+                        help="Stop stage 2 after ROUNDS rounds without improvement on an inner validation split.")
+    parser.add_argument('--stage1-oof', action='store_true',
+                        help="Feed stage 2 out-of-fold stage-1 bin predictions for its training rows.")
+    args = parser.parse_args()
+    params = DEFAULT_PARAMS
+    if args.early_stopping:
+        params = {**params, 'early_stopping_rounds': args.early_stopping}
+    if args.stage1_oof:
+        params = {**params, 'stage1_oof': True}
     # Example Run
-    run_experiment()
+    run_experiment(params=params, cpu_budget=args.cpu_budget, fold_jobs=args.fold_jobs, force=args.force)
@@ -3,100 +3,187 @@ import numpy as np
 import xgboost as xgb
 import pickle
 import os
+import argparse
+from storage import ENGINEERED_FILE, frame_columns, frame_exists, load_frame
+from dtypes import to_model_matrix, memory_mb
+from target_encoding import fit_table
+from nbhd_history import NbhdHistory
+from artifacts import save_bundle
+from tree_arrays import flatten_booster
+from external_memory import MEMORY_LIMIT_MB, MemoryLimitError, train_external, training_rows
+from features import DEFAULT_FEATURES, compute_features, load_plan, required_inputs
+import profiling
 
 # Define paths
-INPUT_FILE = 'engineered_features.csv'
+INPUT_FILE = ENGINEERED_FILE
 # Target the new project folder we created
 OUTPUT_DIR = '../volusia_property_app'
+# Versioned bundle (see artifacts.py); the pickle is only written with --pickle, for apps not yet on load_bundle()
+BUNDLE_PATH = os.path.join(OUTPUT_DIR, 'model_bundle')
 ARTIFACT_PATH = os.path.join(OUTPUT_DIR, 'model_artifacts.pkl')
 
-# Feature config (Must match what the app expects to be able to generate)
-FEATURES = [
-    'SFLA', 'RMBED', 'YRBLT', 'NBHD', 'LUC', 'Month', 
-    'HouseAge_Squared', 'Bed_Bath_Ratio',
-    'NBHD_Median_Size', 'Size_vs_NBHD', 'SFLA_Squared'
-]
+# Feature config (shared with 03_train_model.py; the app computes them with features.compute_features)
+FEATURES = DEFAULT_FEATURES
 
-def train_and_export():
+MODEL_PARAMS = {
+    'n_estimators': 1000,
+    'learning_rate': 0.05,
+    'max_depth': 6,
+    'n_jobs': -1,
+    'random_state': 42
+}
+# Smoothing of the NBHD target encoding toward the global mean price (0 = plain NBHD mean)
+TE_SMOOTHING = 0.0
+# --early-stopping: share of the rows held out to find the number of trees (then trained on all)
+EARLY_STOPPING_FRACTION = 0.1
+EARLY_STOPPING_SEED = 42
+# Bundle lookup tables (NBHD -> value)
+BUNDLE_TABLES = ['nbhd_price_map', 'nbhd_size_map', 'nbhd_asof_median_size', 'nbhd_trailing_median_price',
+                 'nbhd_name_map', 'nbhd_luc_map']
+# compute_features context key -> bundle table (ModelBundle.context())
+FEATURE_CONTEXT = {
+    'nbhd_median_size': 'nbhd_size_map',
+    'nbhd_asof_median_size': 'nbhd_asof_median_size',
+    'nbhd_trailing_median_price': 'nbhd_trailing_median_price',
+}
+# Columns the lookup tables and UI stats need; the only ones loaded whole with --external-memory
+TABLE_COLUMNS = ['NBHD', 'PRICE', 'SFLA', 'SALEDT', 'NBHD_DESC', 'LUC', 'YRBLT', 'RMBED', 'NBHD_Median_Size']
+
+def early_stopped_rounds(X, y, params, early_stopping_rounds):
+    """
+    Number of trees for the model trained on all of X: fits it on a random
+    (1 - EARLY_STOPPING_FRACTION) of the rows, stops once the held-out loss hasn't improved
+    for `early_stopping_rounds` rounds, and scales the best iteration up to the full row count
+    (capped at params['n_estimators']).
+    """
+    held_out = np.random.default_rng(EARLY_STOPPING_SEED).random(len(X)) < EARLY_STOPPING_FRACTION
+    model = xgb.XGBRegressor(**params, early_stopping_rounds=early_stopping_rounds)
+    model.fit(X[~held_out], y[~held_out], eval_set=[(X[held_out], y[held_out])], verbose=False)
+    best_rounds = model.best_iteration + 1
+    rounds = min(int(round(best_rounds * len(X) / (~held_out).sum())), params['n_estimators'])
+    print(f"Early stopping: best iteration {best_rounds} of {params['n_estimators']} on "
+          f"{(~held_out).sum():,} rows -> {rounds} trees on {len(X):,}")
+    return rounds
+
+def train_and_export(write_pickle=False, external_memory=False, memory_limit_mb=MEMORY_LIMIT_MB,
+                     early_stopping_rounds=None):
+    """
+    Trains the model on all data and exports it. With external_memory, the model trains
+    out-of-core from chunks of INPUT_FILE (external_memory.py) within memory_limit_mb, and
+    only TABLE_COLUMNS are loaded whole, for the lookup tables. With early_stopping_rounds
+    (in-memory only), the number of trees comes from early_stopped_rounds().
+    """
     print("Loading data...")
-    if not os.path.exists(INPUT_FILE):
+    if not frame_exists(INPUT_FILE):
         print(f"Error: {INPUT_FILE} not found!")
         return
 
-    df = pd.read_csv(INPUT_FILE, low_memory=False)
-    
-    # 0. Basic Filtering
-    # Remove rows with missing critical features if any
-    # Assuming engineered_features.csv is mostly clean, but let's be safe
-    df = df.dropna(subset=['PRICE', 'SFLA', 'NBHD'])
-    df = df[df['PRICE'] > 1000] # Remove placeholders or corrupt low values
+    with profiling.step('load') as record:
+        file_columns = frame_columns(INPUT_FILE)
+        if external_memory:
+            df = load_frame(INPUT_FILE, columns=TABLE_COLUMNS)
+        else:
+            df = load_frame(INPUT_FILE, columns=load_plan(FEATURES + ['PRICE', 'NBHD_DESC', 'SALEDT'], file_columns))
+            missing = [f for f in FEATURES if f not in file_columns]
+            if missing:
+                print(f"Computing features not in {INPUT_FILE}: {missing}")
+                df = compute_features(df, missing)
     
+        # 0. Basic Filtering
+        # Remove rows with missing critical features if any
+        # Assuming engineered_features.csv is mostly clean, but let's be safe
+        # (price, size and NBHD known; placeholders or corrupt low prices removed)
+        df = training_rows(df)
+        record['rows'] = len(df)
+
     target_col = 'PRICE'
     
-    # 1. NBHD Target Encoding for Price
-    print("Creating Neighborhood Encodings...")
-    # Map: NBHD -> Mean Price
-    nbhd_price_map = df.groupby('NBHD')[target_col].mean().to_dict()
-    global_mean_price = df[target_col].mean()
+    with profiling.step('lookup_tables', rows=len(df)):
+        # 1. NBHD Target Encoding for Price
+        print("Creating Neighborhood Encodings...")
+        # NBHD -> Mean Price (smoothed toward the global mean), as an array-backed lookup table
+        global_mean_price = df[target_col].mean()
+        nbhd_table = fit_table(df['NBHD'], df[target_col], smoothing=TE_SMOOTHING, prior=global_mean_price)
     
-    # Apply encoding to data so we can train
-    df['NBHD_Encoded'] = df['NBHD'].map(nbhd_price_map).fillna(global_mean_price)
+        # Apply encoding to data so we can train
+        df['NBHD_Encoded'] = nbhd_table.lookup(df['NBHD'])
     
-    # 2. NBHD Median Size Map (for Feature Engineering in App)
-    # We need to recreate logic: df['Size_vs_NBHD'] = df['SFLA'] - df['NBHD_Median_Size']
-    # So we need to assist the app in getting 'NBHD_Median_Size' for a new input.
-    if 'NBHD_Median_Size' in df.columns:
-         # Since it's already calculated, we can just grab unique values
-         nbhd_size_map = df.groupby('NBHD')['NBHD_Median_Size'].first().to_dict()
-    else:
-         # Calculate it if missing
-         nbhd_size_map = df.groupby('NBHD')['SFLA'].median().to_dict()
-
-    # NBHD Name Map (Code -> Name) for UI
-    if 'NBHD_DESC' in df.columns:
-        # Create a map, assuming one description per code
-        # If multiple, take first or most frequent.
-        nbhd_name_map = df.groupby('NBHD')['NBHD_DESC'].first().to_dict()
-    else:
-        print("Warning: NBHD_DESC not found, using codes as names.")
-        nbhd_name_map = {nbhd: str(nbhd) for nbhd in df['NBHD'].unique()}
-
-    # LUC Map (NBHD -> Most Frequent LUC)
-    if 'LUC' in df.columns:
-        # Get the most common LUC for each neighborhood
-        nbhd_luc_map = df.groupby('NBHD')['LUC'].agg(lambda x: x.mode().iloc[0] if not x.mode().empty else x.iloc[0]).to_dict()
-        # Top 5 LUCs for the dropdown
-        top_lucs = df['LUC'].value_counts().head(5).index.tolist()
-    else:
-        nbhd_luc_map = {}
-        top_lucs = [99]
-
-    global_median_size = df['SFLA'].median()
+        # 2. NBHD Median Size Map (for Feature Engineering in App)
+        # We need to recreate logic: df['Size_vs_NBHD'] = df['SFLA'] - df['NBHD_Median_Size']
+        # So we need to assist the app in getting 'NBHD_Median_Size' for a new input.
+        if 'NBHD_Median_Size' in df.columns:
+             # Since it's already calculated, we can just grab unique values
+             nbhd_size_map = df.groupby('NBHD', observed=True)['NBHD_Median_Size'].first().to_dict()
+        else:
+             # Calculate it if missing
+             nbhd_size_map = df.groupby('NBHD', observed=True)['SFLA'].median().to_dict()
+
+        # As-of NBHD aggregates for a sale after all known ones (context lookups of the as-of
+        # features: nbhd_asof_median_size / nbhd_trailing_median_price)
+        if 'SALEDT' in df.columns:
+            nbhd_asof = NbhdHistory(df['NBHD'], df['SALEDT'], df['SFLA'], df[target_col]).latest()
+            nbhd_asof_size_map = nbhd_asof['NBHD_AsOf_Median_Size'].dropna().to_dict()
+            nbhd_trailing_price_map = nbhd_asof['NBHD_Trailing_Median_Price'].dropna().to_dict()
+        else:
+            nbhd_asof_size_map, nbhd_trailing_price_map = {}, {}
+
+        # NBHD Name Map (Code -> Name) for UI
+        if 'NBHD_DESC' in df.columns:
+            # Create a map, assuming one description per code
+            # If multiple, take first or most frequent.
+            nbhd_name_map = df.groupby('NBHD', observed=True)['NBHD_DESC'].first().to_dict()
+        else:
+            print("Warning: NBHD_DESC not found, using codes as names.")
+            nbhd_name_map = {nbhd: str(nbhd) for nbhd in df['NBHD'].unique()}
+
+        # LUC Map (NBHD -> Most Frequent LUC)
+        if 'LUC' in df.columns:
+            # Get the most common LUC for each neighborhood
+            nbhd_luc_map = df.groupby('NBHD', observed=True)['LUC'].agg(lambda x: x.mode().iloc[0] if not x.mode().empty else x.iloc[0]).to_dict()
+            # Top 5 LUCs for the dropdown
+            top_lucs = df['LUC'].value_counts().head(5).index.tolist()
+        else:
+            nbhd_luc_map = {}
+            top_lucs = [99]
+
+        global_median_size = df['SFLA'].median()
 
     # 3. Prepare Training Data
     # 'NBHD' is in FEATURES list, but effectively replaced by 'NBHD_Encoded' for the model
     # We remove 'NBHD' (and 'NBHD_DESC' if present) from the training columns list
     train_cols = [f for f in FEATURES if f != 'NBHD'] + ['NBHD_Encoded']
     
-    # Validation check
-    missing_cols = [c for c in train_cols if c not in df.columns]
-    if missing_cols:
-        print(f"Error: Missing columns: {missing_cols}")
-        return
-
-    X = df[train_cols]
-    y = df[target_col]
-    
-    print(f"Training XGBoost Model on {len(X)} records...")
     # Using robust settings
-    model = xgb.XGBRegressor(
-        n_estimators=1000,
-        learning_rate=0.05,
-        max_depth=6,
-        n_jobs=-1,
-        random_state=42
-    )
-    model.fit(X, y)
+    params = dict(MODEL_PARAMS)
+    model = xgb.XGBRegressor(**params)
+
+    with profiling.step('train', rows=len(df)):
+        if external_memory:
+            # Chunks get the features and the encoding fitted above; the matrix is never built whole
+            print(f"Training XGBoost Model on {len(df)} records (external memory)...")
+            booster, _, train_stats = train_external(INPUT_FILE, FEATURES, params, memory_limit_mb, encoding=nbhd_table)
+            print(f"Trained in {train_stats['seconds']:.1f}s, peak RSS {train_stats['peak_rss_mb']:,.0f} MB (limit {memory_limit_mb:,} MB)")
+            model.load_model(bytearray(booster.save_raw()))
+        else:
+            # Validation check
+            missing_cols = [c for c in train_cols if c not in df.columns]
+            if missing_cols:
+                print(f"Error: Missing columns: {missing_cols}")
+                return
+
+            # float32 matrix, categorical codes (LUC) as their numeric values
+            X = to_model_matrix(df[train_cols])
+            y = df[target_col]
+            print(f"Feature matrix: {memory_mb(X):,.1f} MB")
+
+            if early_stopping_rounds:
+                # The NBHD encoding was fitted on all rows, held-out ones included: the
+                # held-out loss is slightly optimistic, which errs toward more trees
+                params['n_estimators'] = early_stopped_rounds(X.to_numpy(), y.to_numpy(), params, early_stopping_rounds)
+                model = xgb.XGBRegressor(**params)
+
+            print(f"Training XGBoost Model on {len(X)} records ({params['n_estimators']} trees)...")
+            model.fit(X, y)
     
     # 4. Gather Metadata/Stats for UI
     # Min/Max for sliders
@@ -113,9 +200,13 @@ def train_and_export():
     artifacts = {
         'model': model,
         'features': train_cols, # The exact columns the model expects (order matters)
-        'nbhd_price_map': nbhd_price_map,
+        'raw_inputs': required_inputs(FEATURES), # Columns the app must collect for compute_features
+        'nbhd_price_map': nbhd_table.to_dict(), # Dict form for the current app
+        'nbhd_encoding': nbhd_table.to_arrays(), # target_encoding.EncodingTable.from_arrays()
         'global_mean_price': global_mean_price,
         'nbhd_size_map': nbhd_size_map,
+        'nbhd_asof_median_size': nbhd_asof_size_map,
+        'nbhd_trailing_median_price': nbhd_trailing_price_map,
         'nbhd_name_map': nbhd_name_map,
         'nbhd_luc_map': nbhd_luc_map, # New
         'top_lucs': top_lucs, # New
@@ -125,12 +216,49 @@ def train_and_export():
     if not os.path.exists(OUTPUT_DIR):
         print(f"Creating output directory: {OUTPUT_DIR}")
         os.makedirs(OUTPUT_DIR)
-        
-    print(f"Saving artifacts to {ARTIFACT_PATH}...")
-    with open(ARTIFACT_PATH, 'wb') as f:
-        pickle.dump(artifacts, f)
+
+    with profiling.step('export'):
+        print(f"Saving model bundle to {BUNDLE_PATH}...")
+        manifest = save_bundle(
+            BUNDLE_PATH, model.get_booster(), train_cols,
+            tables={name: artifacts[name] for name in BUNDLE_TABLES},
+            meta={
+                'raw_inputs': artifacts['raw_inputs'],
+                'global_mean_price': global_mean_price,
+                'top_lucs': top_lucs,
+                'ui_stats': stats,
+                'params': params,
+                'feature_context': FEATURE_CONTEXT,
+            },
+            # Flattened trees for the low-latency single-row evaluator (tree_arrays.TreeEnsemble)
+            arrays=flatten_booster(model.get_booster()),
+        )
+        print(f"Bundle content hash: {manifest['content_hash']}")
+
+    if write_pickle:
+        print(f"Saving artifacts to {ARTIFACT_PATH}...")
+        with open(ARTIFACT_PATH, 'wb') as f:
+            pickle.dump(artifacts, f)
         
     print("Export Complete.")
 
 if __name__ == "__main__":
-    train_and_export()
+    parser = argparse.ArgumentParser(description="Train the single-stage model on all data and export it for the app.")
+    parser.add_argument('--pickle', action='store_true', help=f"Also write the legacy {ARTIFACT_PATH}.")
+    parser.add_argument('--external-memory', action='store_true',
+                        help="Train out-of-core from chunks of the input file instead of one in-memory matrix.")
+    parser.add_argument('--memory-limit-mb', type=int, default=MEMORY_LIMIT_MB,
+                        help="Peak RSS the external-memory chunk size is chosen for (best-effort).")
+    parser.add_argument('--early-stopping', type=int, default=None, metavar='ROUNDS',
+                        help=f"Choose the number of trees (at most {MODEL_PARAMS['n_estimators']}) by early stopping "
+                             f"on {EARLY_STOPPING_FRACTION:.0%} held-out rows, then train on all rows.")
+    args = parser.parse_args()
+    if args.early_stopping and args.external_memory:
+        parser.error("--early-stopping is not supported with --external-memory")
+    with profiling.Profiler('04_export_model') as profiler:
+        try:
+            train_and_export(write_pickle=args.pickle, external_memory=args.external_memory, memory_limit_mb=args.memory_limit_mb,
+                             early_stopping_rounds=args.early_stopping)
+        except MemoryLimitError as e:
+            parser.error(str(e))
+    profiler.write()
@@ -1,8 +1,9 @@
 import pandas as pd
 import numpy as np
+from storage import ENGINEERED_FILE, load_frame
 
 # Load data
-df = pd.read_csv('engineered_features.csv', low_memory=False)
+df = load_frame(ENGINEERED_FILE, columns=['SFLA', 'PRICE', 'Efficiency_Ratio'])
 
 print("--- Data Analysis ---")
 print(f"Total Rows: {len(df)}")
@@ -0,0 +1,247 @@
+import os
+import json
+import shutil
+import hashlib
+import argparse
+from datetime import datetime
+import numpy as np
+import pandas as pd
+import xgboost as xgb
+
+# Model bundle: the exported model as a directory of files the app can map instead of unpickle.
+#   manifest.json        format version, feature order, file hashes, content hash, small metadata
+#   model.ubj            booster in XGBoost's native (UBJSON) format
+#   tables/<name>.keys.npy, tables/<name>.values.npy
+#                        lookup tables (NBHD -> value), keys sorted, loaded with mmap_mode='r'
+#   trees/<name>.npy     optional flattened tree arrays (tree_arrays.flatten_booster), mapped too
+# Loading reads the manifest and the booster and maps the tables; the OS page cache shares
+# the mapped pages between app processes. The content hash identifies a bundle's contents.
+
+FORMAT_VERSION = 1
+MANIFEST_FILE = 'manifest.json'
+MODEL_FILE = 'model.ubj'
+TABLES_DIR = 'tables'
+ARRAYS_DIR = 'trees'
+
+def _file_hash(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(8 * 1024 * 1024), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def _jsonable(value):
+    """NumPy scalars/arrays -> plain Python, for the manifest."""
+    if isinstance(value, dict):
+        return {str(k): _jsonable(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return [_jsonable(v) for v in value]
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+def _table_arrays(mapping):
+    """(sorted keys, values) arrays of a dict or Series lookup."""
+    if isinstance(mapping, dict):
+        mapping = pd.Series(mapping)
+    keys = mapping.index.to_numpy()
+    values = mapping.to_numpy()
+    # Text is stored as fixed-width unicode: object arrays can't be memory-mapped
+    if keys.dtype == object:
+        keys = keys.astype(str)
+    if values.dtype == object:
+        values = values.astype(str)
+    order = np.argsort(keys, kind='stable')
+    return keys[order], values[order]
+
+class ArrayMap:
+    """Read-only key -> value lookup over sorted key/value arrays (e.g. memory-mapped)."""
+    def __init__(self, keys, values):
+        self.keys = keys
+        self.values = values
+
+    def lookup(self, keys, default=np.nan):
+        """Values of an array of keys (binary search); unknown keys get `default`."""
+        keys = np.asarray(keys)
+        if len(self.keys) == 0:
+            return np.full(keys.shape, default)
+        pos = np.searchsorted(self.keys, keys).clip(0, len(self.keys) - 1)
+        return np.where(self.keys[pos] == keys, self.values[pos], default)
+
+    def get(self, key, default=None):
+        pos = np.searchsorted(self.keys, key)
+        if pos < len(self.keys) and self.keys[pos] == key:
+            return self.values[pos].item()
+        return default
+
+    def to_series(self):
+        """pandas view (no copy) for Series.map / features.compute_features contexts."""
+        return pd.Series(self.values, index=self.keys, copy=False)
+
+    def to_dict(self):
+        return dict(zip(self.keys.tolist(), self.values.tolist()))
+
+    def __len__(self):
+        return len(self.keys)
+
+def content_hash(manifest):
+    """Hash of a bundle's feature order and file contents (independent of export time)."""
+    payload = json.dumps({'features': manifest['features'], 'files': manifest['files']}, sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()[:16]
+
+def save_bundle(path, booster, features, tables, meta=None, arrays=None):
+    """
+    Writes a bundle directory: `booster` (xgb.Booster), the model's feature order, `tables`
+    ({name: dict or Series}), small JSON-able `meta` and optional `arrays` ({name: ndarray},
+    e.g. the flattened trees). The bundle is built next to `path`
+    and swapped in at the end, so a reader never sees a half-written bundle.
+    Returns the manifest.
+    """
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(os.path.join(tmp_path, TABLES_DIR))
+
+    booster.save_model(os.path.join(tmp_path, MODEL_FILE))
+    table_files = {}
+    for name, mapping in tables.items():
+        keys, values = _table_arrays(mapping)
+        table_files[name] = {}
+        for part, array in (('keys', keys), ('values', values)):
+            rel_path = os.path.join(TABLES_DIR, f"{name}.{part}.npy")
+            np.save(os.path.join(tmp_path, rel_path), array, allow_pickle=False)
+            table_files[name][part] = rel_path
+
+    array_files = {}
+    if arrays:
+        os.makedirs(os.path.join(tmp_path, ARRAYS_DIR))
+        for name, array in arrays.items():
+            array_files[name] = os.path.join(ARRAYS_DIR, f"{name}.npy")
+            np.save(os.path.join(tmp_path, array_files[name]), np.ascontiguousarray(array), allow_pickle=False)
+
+    files = ([MODEL_FILE] + [rel for parts in table_files.values() for rel in parts.values()]
+             + list(array_files.values()))
+    manifest = {
+        'format_version': FORMAT_VERSION,
+        'created': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        'xgboost_version': xgb.__version__,
+        'features': list(features),
+        'model': MODEL_FILE,
+        'tables': table_files,
+        'arrays': array_files,
+        'files': {rel: _file_hash(os.path.join(tmp_path, rel)) for rel in files},
+        'meta': _jsonable(meta or {}),
+    }
+    manifest['content_hash'] = content_hash(manifest)
+    with open(os.path.join(tmp_path, MANIFEST_FILE), 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+    # Swap: the old bundle is moved aside first since directories can't be replaced atomically
+    old_path = f"{path}.{os.getpid()}.old"
+    if os.path.exists(path):
+        os.replace(path, old_path)
+    os.replace(tmp_path, path)
+    shutil.rmtree(old_path, ignore_errors=True)
+    return manifest
+
+def add_arrays(path, arrays):
+    """
+    Adds (or replaces) arrays in an existing bundle, e.g. summaries computed after export,
+    and rewrites its manifest, file hashes and content hash. The new manifest is swapped in
+    last, so readers see either the old or the new set of arrays. Returns the manifest.
+    """
+    with open(os.path.join(path, MANIFEST_FILE)) as f:
+        manifest = json.load(f)
+    os.makedirs(os.path.join(path, ARRAYS_DIR), exist_ok=True)
+    manifest.setdefault('arrays', {})
+    for name, array in arrays.items():
+        rel_path = os.path.join(ARRAYS_DIR, f"{name}.npy")
+        tmp_file = os.path.join(path, f"{rel_path}.{os.getpid()}.tmp")
+        with open(tmp_file, 'wb') as f:
+            np.save(f, np.ascontiguousarray(array), allow_pickle=False)
+        os.replace(tmp_file, os.path.join(path, rel_path))
+        manifest['arrays'][name] = rel_path
+        manifest['files'][rel_path] = _file_hash(os.path.join(path, rel_path))
+    manifest['content_hash'] = content_hash(manifest)
+
+    tmp_manifest = os.path.join(path, f"{MANIFEST_FILE}.{os.getpid()}.tmp")
+    with open(tmp_manifest, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_manifest, os.path.join(path, MANIFEST_FILE))
+    return manifest
+
+class ModelBundle:
+    """A loaded bundle: manifest, booster, feature order, metadata, memory-mapped tables and arrays."""
+    def __init__(self, path, manifest, booster, tables, arrays=None):
+        self.path = path
+        self.manifest = manifest
+        self.booster = booster
+        self.tables = tables
+        self.arrays = arrays or {}
+
+    @property
+    def features(self):
+        return self.manifest['features']
+
+    @property
+    def meta(self):
+        return self.manifest['meta']
+
+    @property
+    def content_hash(self):
+        return self.manifest['content_hash']
+
+    def context(self):
+        """
+        features.compute_features context for the aggregate features, from the tables named in
+        meta['feature_context'] ({context key: table name}).
+        """
+        return {key: self.tables[name].to_series() for key, name in self.meta.get('feature_context', {}).items()}
+
+def verify_bundle(path, manifest=None):
+    """Re-hashes every file of a bundle. Returns the files whose contents don't match the manifest."""
+    if manifest is None:
+        with open(os.path.join(path, MANIFEST_FILE)) as f:
+            manifest = json.load(f)
+    return [rel for rel, digest in manifest['files'].items() if _file_hash(os.path.join(path, rel)) != digest]
+
+def load_bundle(path, mmap=True, verify=False):
+    """
+    Loads a bundle. Tables are memory-mapped (mmap=False reads them into memory); with
+    verify=True every file is re-hashed against the manifest first, which reads all of it.
+    """
+    with open(os.path.join(path, MANIFEST_FILE)) as f:
+        manifest = json.load(f)
+    if manifest.get('format_version') != FORMAT_VERSION:
+        raise ValueError(f"{path}: bundle format {manifest.get('format_version')}, expected {FORMAT_VERSION}")
+    if verify:
+        corrupt = verify_bundle(path, manifest)
+        if corrupt:
+            raise ValueError(f"{path}: contents don't match the manifest: {corrupt}")
+
+    booster = xgb.Booster(model_file=os.path.join(path, manifest['model']))
+    mmap_mode = 'r' if mmap else None
+    tables = {
+        name: ArrayMap(np.load(os.path.join(path, parts['keys']), mmap_mode=mmap_mode),
+                       np.load(os.path.join(path, parts['values']), mmap_mode=mmap_mode))
+        for name, parts in manifest['tables'].items()
+    }
+    # Bundles exported before the flattened trees were added have no 'arrays'
+    arrays = {name: np.load(os.path.join(path, rel), mmap_mode=mmap_mode)
+              for name, rel in manifest.get('arrays', {}).items()}
+    return ModelBundle(path, manifest, booster, tables, arrays)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect or verify an exported model bundle.")
+    parser.add_argument('path', help="Bundle directory (e.g. ../volusia_property_app/model_bundle).")
+    parser.add_argument('--verify', action='store_true', help="Re-hash every file against the manifest.")
+    args = parser.parse_args()
+    bundle = load_bundle(args.path, verify=args.verify)
+    print(f"Bundle {args.path}: format {bundle.manifest['format_version']}, content hash {bundle.content_hash}, "
+          f"created {bundle.manifest['created']}")
+    print(f"Features ({len(bundle.features)}): {bundle.features}")
+    for name, table in bundle.tables.items():
+        print(f"  {name}: {len(table)} entries")
+    if bundle.arrays:
+        print(f"Arrays: " + ", ".join(f"{name} {array.shape}" for name, array in bundle.arrays.items()))
+    if args.verify:
+        print("All files match the manifest.")
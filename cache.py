@@ -0,0 +1,182 @@
+import os
+import ast
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import threading
+import pandas as pd
+
+# Local, content-addressed cache for expensive intermediate results.
+# Entries live in .cache/<namespace>/<key>.<ext>; keys are hashes of everything
+# the entry depends on (input file fingerprints, column lists, parameters).
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+CACHE_DIR = os.environ.get('HPP_CACHE_DIR', os.path.join(BASE_DIR, '.cache'))
+MAX_CACHE_BYTES = int(os.environ.get('HPP_CACHE_MAX_BYTES', 5 * 1024 ** 3))  # 5 GB
+
+FINGERPRINT_INDEX = 'fingerprints.json'
+# Subdirectories of CACHE_DIR holding state rather than cache entries, never evicted:
+# the pipeline's last successful stage keys, sampled profiles, XGBoost external-memory
+# pages of a running training
+UNEVICTABLE_DIRS = ['pipeline', 'profiles', 'xgb_extmem']
+HASH_BLOCK_SIZE = 8 * 1024 * 1024
+
+# Tables may be loaded from several threads at once (see data_loader)
+_LOCK = threading.Lock()
+
+def _load_fingerprint_index():
+    path = os.path.join(CACHE_DIR, FINGERPRINT_INDEX)
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _save_fingerprint_index(index):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    tmp_path = os.path.join(CACHE_DIR, f"{FINGERPRINT_INDEX}.{os.getpid()}.tmp")
+    with open(tmp_path, 'w') as f:
+        json.dump(index, f)
+    os.replace(tmp_path, os.path.join(CACHE_DIR, FINGERPRINT_INDEX))
+
+def file_fingerprint(path):
+    """
+    Returns {'size', 'content_hash'} for a file.
+    The content hash is only recomputed when size or mtime changed since the last call,
+    so fingerprinting an unchanged multi-GB CSV is instant.
+    """
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    index = _load_fingerprint_index()
+    known = index.get(path)
+    if known and known['size'] == st.st_size and known['mtime'] == st.st_mtime:
+        return {'size': st.st_size, 'content_hash': known['content_hash']}
+
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            h.update(block)
+
+    with _LOCK:
+        index = _load_fingerprint_index()
+        index[path] = {'size': st.st_size, 'mtime': st.st_mtime, 'content_hash': h.hexdigest()}
+        _save_fingerprint_index(index)
+    return {'size': st.st_size, 'content_hash': h.hexdigest()}
+
+def local_modules(script, base_dir=BASE_DIR, seen=None):
+    """File names of the script and every module of this repo it imports, directly or indirectly."""
+    seen = set() if seen is None else seen
+    if script in seen:
+        return seen
+    seen.add(script)
+    with open(os.path.join(base_dir, script)) as f:
+        tree = ast.parse(f.read())
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names.update(alias.name.split('.')[0] for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.module and node.level == 0:
+            names.add(node.module.split('.')[0])
+        elif (isinstance(node, ast.Call) and getattr(node.func, 'attr', None) == 'import_module'
+              and node.args and isinstance(node.args[0], ast.Constant)):
+            # importlib.import_module('03_train_model')
+            names.add(node.args[0].value)
+    for name in names:
+        if os.path.exists(os.path.join(base_dir, f"{name}.py")):
+            local_modules(f"{name}.py", base_dir, seen)
+    return seen
+
+def make_key(*parts):
+    """Hashes arbitrary JSON-serializable parts into a short cache key."""
+    payload = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()[:24]
+
+def entry_path(namespace, key, ext):
+    return os.path.join(CACHE_DIR, namespace, f"{key}{ext}")
+
+def _touch(path):
+    # mtime doubles as "last used" for LRU eviction
+    now = time.time()
+    os.utime(path, (now, now))
+
+def get_frame(namespace, key):
+    """Returns (DataFrame, meta dict) for a cached entry, or (None, None)."""
+    path = entry_path(namespace, key, '.parquet')
+    meta_path = entry_path(namespace, key, '.json')
+    if not os.path.exists(path) or not os.path.exists(meta_path):
+        return None, None
+    try:
+        df = pd.read_parquet(path)
+        with open(meta_path) as f:
+            meta = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Ignoring unreadable cache entry {path}: {e}")
+        return None, None
+    _touch(path)
+    _touch(meta_path)
+    return df, meta
+
+def put_frame(namespace, key, df, meta=None):
+    """Stores a DataFrame (Parquet) plus a small JSON meta dict, then enforces the size limit."""
+    os.makedirs(os.path.join(CACHE_DIR, namespace), exist_ok=True)
+    path = entry_path(namespace, key, '.parquet')
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    df.to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, path)
+    with open(entry_path(namespace, key, '.json'), 'w') as f:
+        json.dump(meta or {}, f)
+    evict()
+
+def _entries():
+    """Yields (path, size, mtime) for every cache file except the fingerprint index and UNEVICTABLE_DIRS."""
+    if not os.path.exists(CACHE_DIR):
+        return
+    for root, dirs, files in os.walk(CACHE_DIR):
+        if root == CACHE_DIR:
+            dirs[:] = [d for d in dirs if d not in UNEVICTABLE_DIRS]
+        for name in files:
+            if name == FINGERPRINT_INDEX:
+                continue
+            path = os.path.join(root, name)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:  # Removed concurrently
+                continue
+            yield path, st.st_size, st.st_mtime
+
+def cache_size():
+    return sum(size for _, size, _ in _entries())
+
+def evict(max_bytes=MAX_CACHE_BYTES):
+    """Removes least recently used files until the cache fits in max_bytes."""
+    with _LOCK:
+        entries = sorted(_entries(), key=lambda e: e[2])
+        total = sum(size for _, size, _ in entries)
+        for path, size, _ in entries:
+            if total <= max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            print(f"Evicted cache file {path}")
+
+def clear(namespace=None):
+    """Deletes one namespace, or the whole cache (including file fingerprints)."""
+    target = os.path.join(CACHE_DIR, namespace) if namespace else CACHE_DIR
+    if os.path.exists(target):
+        shutil.rmtree(target)
+        print(f"Cleared cache: {target}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect or invalidate the local pipeline cache.")
+    parser.add_argument('--clear', nargs='?', const='', metavar='NAMESPACE',
+                        help="Clear the whole cache, or only NAMESPACE (e.g. raw_tables).")
+    args = parser.parse_args()
+    if args.clear is not None:
+        clear(args.clear or None)
+    print(f"Cache dir: {CACHE_DIR} ({cache_size() / 1024 ** 2:,.1f} MB, limit {MAX_CACHE_BYTES / 1024 ** 2:,.0f} MB)")
@@ -0,0 +1,447 @@
+import pandas as pd
+import numpy as np
+from pandas.api.types import union_categoricals
+import os
+import json
+import time
+import shutil
+import argparse
+from concurrent.futures import Future, ThreadPoolExecutor
+import cache
+import profiling
+
+# Data Directory
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DATA_DIR = os.path.join(BASE_DIR, 'data')
+
+SALES_FILE = 'VCPA_CAMA_SALES.csv'
+BLDG_FILE = 'VCPA_CAMA_RES_BLDG.csv'
+PARCEL_FILE = 'VCPA_CAMA_PARCEL.csv'
+
+# Optional date-partitioned copy of the sales table (see partition_sales):
+# data/sales_by_year/SaleYear=YYYY/part-NNNNN.parquet
+PARTITION_DIR = 'sales_by_year'
+PARTITION_SOURCE_FILE = '_source.json'
+UNKNOWN_YEAR = 'unknown'
+
+# Rows per chunk when streaming the raw tables
+CHUNK_SIZE = 200_000
+
+# Parsed + deduplicated raw tables are cached under this namespace (see cache.py).
+# Bump the version when parsing, filtering or dedup logic changes.
+RAW_CACHE_NAMESPACE = 'raw_tables'
+RAW_CACHE_VERSION = 2
+
+# Explicit read schemas: only these columns are read from the raw files.
+# Descriptions are categoricals, measurements float32. PRICE stays float64 (target).
+# Leakage columns (2026 tax values) are never read.
+SALES_SCHEMA = {
+    'PARID': str, 'TAXYR': 'Int16', 'SALEDT': str, 'PRICE': 'float64',
+    'SALETYPE': 'category', 'INSTRTYP': 'category', 'INSTRTYP_DESC': 'category',
+    'STEB': 'category', 'STEB_DESC': 'category'
+}
+BLDG_SCHEMA = {
+    'PARID': str, 'YRBLT': 'float32', 'RMBED': 'float32', 'FIXBATH': 'float32',
+    'SFLA': 'float32', 'TOTAL_AREA': 'float32', 'STORIES': 'float32',
+    'EXTWALL_DESC': 'category', 'ROOF_COVER_DESC': 'category'
+}
+PARCEL_SCHEMA = {
+    'PARID': str, 'NBHD': None, 'NBHD_DESC': 'category', 'LUC': None, 'LUC_DESC': 'category'
+}
+
+def concat_frames(chunks):
+    """Concatenates frames, unifying categories so categoricals don't fall back to object."""
+    if not chunks:
+        return None
+    cat_cols = [c for c, dtype in chunks[0].dtypes.items() if isinstance(dtype, pd.CategoricalDtype)]
+    unified = {col: pd.CategoricalDtype(union_categoricals([chunk[col] for chunk in chunks]).categories)
+               for col in cat_cols}
+    if unified:
+        chunks = [chunk.astype(unified) for chunk in chunks]
+    return pd.concat(chunks, ignore_index=True)
+
+def _read_plan(path, schema):
+    """(columns to read, explicit dtypes) of a raw CSV for a schema."""
+    header = pd.read_csv(path, nrows=0).columns
+    usecols = [c for c in schema if c in header]
+    return usecols, {c: schema[c] for c in usecols if schema[c] is not None}
+
+def iter_table_chunks(path, schema, chunksize=CHUNK_SIZE):
+    """Yields a raw CSV as DataFrame chunks of the schema columns, with explicit dtypes."""
+    usecols, dtypes = _read_plan(path, schema)
+    yield from pd.read_csv(path, usecols=usecols, dtype=dtypes, chunksize=chunksize)
+
+def read_table_chunked(path, schema, chunk_filter=None, chunksize=CHUNK_SIZE):
+    """
+    Streams a raw CSV in chunks, reading only the schema columns with explicit dtypes.
+    `chunk_filter` is applied to every chunk, so only kept rows stay in memory.
+    Returns (DataFrame, rows_read).
+    """
+    chunks = []
+    rows_read = 0
+    for chunk in iter_table_chunks(path, schema, chunksize):
+        rows_read += len(chunk)
+        if chunk_filter is not None:
+            chunk = chunk_filter(chunk)
+        chunks.append(chunk)
+
+    df = concat_frames(chunks)
+    if df is None:
+        df = pd.DataFrame(columns=_read_plan(path, schema)[0])
+    return df, rows_read
+
+def _sale_dates(chunk):
+    return pd.to_datetime(chunk['SALEDT'], errors='coerce')
+
+def _date_window(start_date=None, end_date=None):
+    """Returns (start, end_exclusive) Timestamps. end_date is inclusive of the whole day."""
+    start = pd.Timestamp(start_date) if start_date is not None else None
+    end = pd.Timestamp(end_date).normalize() + pd.Timedelta(days=1) if end_date is not None else None
+    return start, end
+
+def _in_window(dates, start, end):
+    mask = pd.Series(True, index=dates.index)
+    if start is not None:
+        mask &= dates >= start
+    if end is not None:
+        mask &= dates < end
+    return mask
+
+def _valid_sales(chunk):
+    chunk = chunk.dropna(subset=['PARID', 'PRICE'])
+    # Filter out zero/low prices
+    return chunk[chunk['PRICE'] > 1000]
+
+def _source_signature(path):
+    st = os.stat(path)
+    return {'size': st.st_size, 'mtime': st.st_mtime}
+
+def _partitions_are_fresh(data_dir):
+    """True if the partitioned sales copy exists and was built from the current CSV."""
+    marker = os.path.join(data_dir, PARTITION_DIR, PARTITION_SOURCE_FILE)
+    if not os.path.exists(marker):
+        return False
+    with open(marker) as f:
+        recorded = json.load(f)
+    return recorded == _source_signature(os.path.join(data_dir, SALES_FILE))
+
+def partition_sales(data_dir=DATA_DIR, chunksize=CHUNK_SIZE):
+    """
+    Writes a year-partitioned Parquet copy of the (valid) sales table, so date-windowed
+    loads only touch the years they need. Re-run after the county publishes new sales.
+    """
+    sales_path = os.path.join(data_dir, SALES_FILE)
+    out_dir = os.path.join(data_dir, PARTITION_DIR)
+    print(f"Partitioning {sales_path} by sale year into {out_dir}...")
+
+    if os.path.exists(out_dir):
+        shutil.rmtree(out_dir)
+
+    header = pd.read_csv(sales_path, nrows=0).columns
+    usecols = [c for c in SALES_SCHEMA if c in header]
+    dtypes = {c: SALES_SCHEMA[c] for c in usecols}
+
+    rows_written = 0
+    for part, chunk in enumerate(pd.read_csv(sales_path, usecols=usecols, dtype=dtypes, chunksize=chunksize)):
+        chunk = _valid_sales(chunk)
+        years = _sale_dates(chunk).dt.year
+        for year, group in chunk.groupby(years.fillna(-1).astype(int)):
+            year_name = UNKNOWN_YEAR if year == -1 else str(year)
+            year_dir = os.path.join(out_dir, f"SaleYear={year_name}")
+            os.makedirs(year_dir, exist_ok=True)
+            group.to_parquet(os.path.join(year_dir, f"part-{part:05d}.parquet"), index=False)
+            rows_written += len(group)
+
+    with open(os.path.join(out_dir, PARTITION_SOURCE_FILE), 'w') as f:
+        json.dump(_source_signature(sales_path), f)
+    print(f"Wrote {rows_written} sales rows.")
+
+def _read_sales_partitions(data_dir, start, end):
+    """Reads only the year partitions overlapping [start, end)."""
+    base = os.path.join(data_dir, PARTITION_DIR)
+    frames = []
+    for name in sorted(os.listdir(base)):
+        if not name.startswith('SaleYear='):
+            continue
+        year_name = name.split('=', 1)[1]
+        if year_name == UNKNOWN_YEAR:
+            # Undated sales can only match an unbounded window
+            if start is not None or end is not None:
+                continue
+        else:
+            year = int(year_name)
+            if start is not None and year < start.year:
+                continue
+            if end is not None and pd.Timestamp(year=year, month=1, day=1) >= end:
+                continue
+        frames.append(pd.read_parquet(os.path.join(base, name)))
+
+    df = concat_frames(frames)
+    if df is None:
+        return pd.DataFrame(columns=list(SALES_SCHEMA)), 0
+    rows_read = len(df)
+    if start is not None or end is not None:
+        df = df[_in_window(_sale_dates(df), start, end)].reset_index(drop=True)
+    return df, rows_read
+
+def _read_table_cached(name, path, schema, chunk_filter, finalize, chunksize):
+    """
+    Like read_table_chunked + finalize, but served from the raw-table cache when the file
+    (size + content hash) and the read schema are unchanged.
+    """
+    header = pd.read_csv(path, nrows=0).columns
+    key = cache.make_key(
+        RAW_CACHE_VERSION, name, cache.file_fingerprint(path),
+        [c for c in schema if c in header], {c: str(t) for c, t in schema.items()}
+    )
+    df, meta = cache.get_frame(RAW_CACHE_NAMESPACE, key)
+    if df is not None:
+        print(f"{name}: loaded parsed table from cache.")
+        return df, meta['rows_read']
+
+    df, rows_read = read_table_chunked(path, schema, chunk_filter, chunksize)
+    df = finalize(df)
+    cache.put_frame(RAW_CACHE_NAMESPACE, key, df, meta={'rows_read': rows_read, 'source': path})
+    return df, rows_read
+
+def load_sales(data_dir=DATA_DIR, start_date=None, end_date=None, chunksize=CHUNK_SIZE, use_cache=True):
+    """
+    Loads valid sales (PARID present, PRICE > 1000), optionally restricted to a sale-date
+    window. Uses the year-partitioned copy when it is up to date, then the raw-table cache,
+    else streams the CSV and drops out-of-window rows per chunk. Returns (DataFrame, rows_read).
+    """
+    start, end = _date_window(start_date, end_date)
+    sales_path = os.path.join(data_dir, SALES_FILE)
+
+    if _partitions_are_fresh(data_dir):
+        print("Reading year-partitioned sales...")
+        return _read_sales_partitions(data_dir, start, end)
+
+    if use_cache:
+        # The cache holds all valid sales; the date window is applied afterwards
+        df, rows_read = _read_table_cached('Sales', sales_path, SALES_SCHEMA, _valid_sales, lambda df: df, chunksize)
+        if start is not None or end is not None:
+            df = df[_in_window(_sale_dates(df), start, end)].reset_index(drop=True)
+        return df, rows_read
+
+    def sales_filter(chunk):
+        chunk = _valid_sales(chunk)
+        if start is not None or end is not None:
+            chunk = chunk[_in_window(_sale_dates(chunk), start, end)]
+        return chunk
+
+    return read_table_chunked(sales_path, SALES_SCHEMA, sales_filter, chunksize)
+
+def _dedup_buildings(df):
+    # One parcel might have multiple buildings: keep the largest one.
+    # A hash groupby picks the max-SFLA row per parcel without sorting the whole table.
+    if 'SFLA' in df.columns:
+        sfla = df['SFLA'].fillna(-np.inf)  # Buildings without SFLA only win if alone
+        return df.loc[sfla.groupby(df['PARID'], sort=False).idxmax()]
+    return df.drop_duplicates('PARID')
+
+def _resolve_parids(parids):
+    # A Future while the sales are still loading concurrently (see load_and_merge_data)
+    return parids.result() if isinstance(parids, Future) else parids
+
+def _load_parcel_table(name, path, schema, dedup, parids, chunksize, use_cache):
+    """
+    Loads a per-parcel table deduplicated to one row per PARID, restricted to `parids`
+    (a set, a Future of one, or None for all parcels). Without the cache the PARID filter
+    runs per chunk; the cached copy holds every parcel so it can be reused for any set of sales.
+    """
+    if use_cache:
+        df, rows_read = _read_table_cached(name, path, schema, dedup, dedup, chunksize)
+        wanted = _resolve_parids(parids)
+        if wanted is not None:
+            df = df[df['PARID'].isin(wanted)]
+        return df, rows_read
+
+    def chunk_filter(chunk):
+        # Waits for a pending PARID set at the first chunk, which stays the only unfiltered one
+        wanted = _resolve_parids(parids)
+        if wanted is not None:
+            chunk = chunk[chunk['PARID'].isin(wanted)]
+        return dedup(chunk)
+
+    df, rows_read = read_table_chunked(path, schema, chunk_filter, chunksize)
+    # Parcels can span chunks, so deduplicate once more
+    return dedup(df), rows_read
+
+def _dedup_parcels(df):
+    return df.drop_duplicates('PARID')
+
+def load_buildings(data_dir=DATA_DIR, parids=None, chunksize=CHUNK_SIZE, use_cache=True):
+    """Loads residential buildings, one (the largest) per parcel. Returns (DataFrame, rows_read)."""
+    path = os.path.join(data_dir, BLDG_FILE)
+    return _load_parcel_table('Building', path, BLDG_SCHEMA, _dedup_buildings, parids, chunksize, use_cache)
+
+def load_parcels(data_dir=DATA_DIR, parids=None, chunksize=CHUNK_SIZE, use_cache=True):
+    """Loads parcel location/land-use data, one row per parcel. Returns (DataFrame, rows_read)."""
+    path = os.path.join(data_dir, PARCEL_FILE)
+    return _load_parcel_table('Parcel', path, PARCEL_SCHEMA, _dedup_parcels, parids, chunksize, use_cache)
+
+def _load_sales_and_parids(sold_parids, *args):
+    """load_sales(*args), publishing the loaded PARIDs to the `sold_parids` Future for the property loads."""
+    try:
+        df, rows_read = load_sales(*args)
+    except BaseException as e:
+        sold_parids.set_exception(e)
+        raise
+    sold_parids.set_result(set(df['PARID'].unique()))
+    return df, rows_read
+
+def _timed(table, func, *args):
+    """Runs func(*args) (a table loader) as profiling step 'load:<table>'. Returns (result, seconds)."""
+    start = time.perf_counter()
+    with profiling.step(f"load:{table}") as record:
+        result = func(*args)
+        df, rows_read = result
+        record.update(rows=len(df), rows_read=rows_read)
+    return result, time.perf_counter() - start
+
+def _submit_property_loads(pool, data_dir, parids, chunksize, use_cache):
+    """Starts the building and parcel loads on `pool`. Returns {table: future or None}."""
+    futures = {}
+    for table, filename, loader in [('Building', BLDG_FILE, load_buildings), ('Parcel', PARCEL_FILE, load_parcels)]:
+        path = os.path.join(data_dir, filename)
+        if os.path.exists(path):
+            print(f"Loading {table} Data from {path}...")
+            futures[table] = pool.submit(_timed, table, loader, data_dir, parids, chunksize, use_cache)
+        else:
+            print(f"Warning: {filename} not found. Skipping {table.lower()} features.")
+            futures[table] = None
+    return futures
+
+def _collect_property_tables(futures, stats):
+    """Waits for the building/parcel loads. Returns {table: DataFrame} for the ones that loaded."""
+    tables = {}
+    for table, future in futures.items():
+        if future is None:
+            continue
+        try:
+            (df, rows_read), seconds = future.result()
+        except ValueError as e:
+            print(f"Error loading {table} data columns: {e}")
+            continue
+        stats[table] = {'rows_read': rows_read, 'rows_kept': len(df), 'seconds': seconds}
+        print(f"{table} records loaded: {len(df)} (read {rows_read}, {seconds:.2f}s)")
+        tables[table] = df
+    return tables
+
+def join_on_parid(df_sales, tables):
+    """
+    Inner-joins per-parcel tables onto sales. Each table is indexed on PARID once
+    (it is already unique per parcel), so the join is a hash lookup per sale row.
+    """
+    with profiling.step('merge', rows=len(df_sales)):
+        for table, df in tables.items():
+            df_sales = df_sales.join(df.set_index('PARID'), on='PARID', how='inner')
+            print(f"Merged Sales + {table}: {len(df_sales)}")
+        return df_sales.reset_index(drop=True)
+
+def load_and_merge_data(data_dir=DATA_DIR, start_date=None, end_date=None, chunksize=CHUNK_SIZE, stats=None, use_cache=True,
+                        on_sales=None):
+    """
+    Loads Sales, Residential Building, and Parcel data, and merges them.
+    The three tables are loaded concurrently; filters are applied per chunk.
+    If start_date/end_date are given (inclusive), out-of-range sales are skipped
+    at read time, before the building and parcel joins.
+    Parsed tables are cached (see cache.py) unless use_cache=False.
+    If a `stats` dict is passed, it is filled with rows read/kept and seconds per table,
+    plus a 'Timing' entry with the load (wall) and join times.
+    `on_sales` is called with the loaded sales frame, before the joins drop any sale.
+    Returns a consolidated DataFrame.
+    """
+    print("Loading and merging data sets...")
+    if stats is None:
+        stats = {}
+
+    sales_path = os.path.join(data_dir, SALES_FILE)
+    if not os.path.exists(sales_path):
+        print(f"Sales file not found: {sales_path}")
+        return None
+
+    if 'PRICE' not in pd.read_csv(sales_path, nrows=0).columns:
+        print("Could not find Price column in Sales.")
+        return None
+
+    if start_date is not None or end_date is not None:
+        print(f"Sale date window: {start_date or 'start'} to {end_date or 'end'}")
+
+    # 1. Load all three tables concurrently. The pandas parser releases the GIL while
+    # tokenizing, so threads overlap without copying frames between processes.
+    # Building/parcel rows for parcels that never sold are dropped per chunk: the sales
+    # thread publishes its PARIDs, which the property threads wait for at their first chunk.
+    load_start = time.perf_counter()
+    sold_parids = Future()
+    with ThreadPoolExecutor(max_workers=3) as pool:
+        print(f"Loading Sales from {sales_path}...")
+        sales_future = pool.submit(_timed, 'Sales', _load_sales_and_parids, sold_parids,
+                                   data_dir, start_date, end_date, chunksize, use_cache)
+        property_futures = _submit_property_loads(pool, data_dir, sold_parids, chunksize, use_cache)
+
+        try:
+            (df_sales, rows_read), seconds = sales_future.result()
+        except ValueError as e:
+            print(f"Error loading Sales data columns: {e}")
+            return None
+        stats['Sales'] = {'rows_read': rows_read, 'rows_kept': len(df_sales), 'seconds': seconds}
+        print(f"Sales records loaded: {len(df_sales)} (read {rows_read}, {seconds:.2f}s)")
+        if on_sales is not None:
+            on_sales(df_sales)
+
+        tables = _collect_property_tables(property_futures, stats)
+    load_seconds = time.perf_counter() - load_start
+
+    # 2. Join on PARID
+    join_start = time.perf_counter()
+    df = join_on_parid(df_sales, tables)
+    join_seconds = time.perf_counter() - join_start
+
+    stats['Timing'] = {'load_seconds': load_seconds, 'join_seconds': join_seconds}
+    print(f"Load time: {load_seconds:.2f}s (concurrent), join time: {join_seconds:.2f}s")
+    return df
+
+def merge_property_tables(df_sales, data_dir=DATA_DIR, chunksize=CHUNK_SIZE, stats=None, use_cache=True):
+    """
+    Joins building characteristics and parcel location data onto an already loaded
+    sales frame (inner joins on PARID). Returns the merged DataFrame.
+    """
+    if stats is None:
+        stats = {}
+
+    # Sales are known up front, so rows for parcels that never sold are dropped while loading
+    sold_parids = set(df_sales['PARID'].unique())
+
+    load_start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        tables = _collect_property_tables(_submit_property_loads(pool, data_dir, sold_parids, chunksize, use_cache), stats)
+    load_seconds = time.perf_counter() - load_start
+
+    join_start = time.perf_counter()
+    df = join_on_parid(df_sales, tables)
+    stats['Timing'] = {'load_seconds': load_seconds, 'join_seconds': time.perf_counter() - join_start}
+    return df
+
+def get_load_stats(stats):
+    text = "**Raw Table Load**\n"
+    for table in ['Sales', 'Building', 'Parcel']:
+        if table not in stats:
+            continue
+        counts = stats[table]
+        text += f"- {table}: {counts['rows_read']:,} rows read, {counts['rows_kept']:,} kept"
+        text += f" ({counts['seconds']:.2f}s)\n" if 'seconds' in counts else "\n"
+    if 'Timing' in stats:
+        text += f"- Load time: {stats['Timing']['load_seconds']:.2f}s, join time: {stats['Timing']['join_seconds']:.2f}s\n"
+    return text
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Shared loader for the VCPA CAMA raw tables.")
+    parser.add_argument('--partition', action='store_true',
+                        help="Write the year-partitioned copy of the sales table.")
+    args = parser.parse_args()
+    if args.partition:
+        partition_sales()
+    else:
+        parser.print_help()
@@ -0,0 +1,85 @@
+import numpy as np
+import pandas as pd
+
+# One dtype policy from load to export:
+# - codes and descriptions are categoricals
+# - integer-valued numerics are downcast to the smallest integer type
+# - other numerics (features) are float32, which is also what XGBoost uses internally
+# - the target (PRICE) stays float64 so price statistics are exact
+CATEGORICAL_COLUMNS = [
+    'NBHD', 'LUC', 'NBHD_DESC', 'LUC_DESC', 'EXTWALL_DESC', 'ROOF_COVER_DESC',
+    'SALETYPE', 'INSTRTYP', 'INSTRTYP_DESC', 'STEB', 'STEB_DESC'
+]
+TARGET_COLUMNS = ['PRICE']
+
+def restore_categoricals(df):
+    """
+    Parquet only round-trips string categoricals; integer codes (NBHD, LUC) come back
+    as plain integers and are re-categorized here.
+    """
+    missing = [c for c in CATEGORICAL_COLUMNS
+               if c in df.columns and not isinstance(df[c].dtype, pd.CategoricalDtype)]
+    if missing:
+        df = df.astype({c: 'category' for c in missing})
+    return df
+
+def _is_integral(s):
+    values = s.to_numpy(dtype='float64')
+    return bool(np.all(np.isfinite(values)) and np.all(values == np.round(values)))
+
+def apply_dtype_policy(df):
+    """Returns df with the pipeline dtype policy applied (see module comment)."""
+    converted = {}
+    for col in df.columns:
+        s = df[col]
+        if col in CATEGORICAL_COLUMNS:
+            if not isinstance(s.dtype, pd.CategoricalDtype):
+                converted[col] = s.astype('category')
+        elif col in TARGET_COLUMNS or isinstance(s.dtype, pd.CategoricalDtype):
+            continue
+        elif pd.api.types.is_bool_dtype(s.dtype) or not pd.api.types.is_numeric_dtype(s.dtype):
+            continue
+        elif _is_integral(s):
+            converted[col] = pd.to_numeric(s.to_numpy(dtype='int64'), downcast='integer')
+        else:
+            converted[col] = s.astype('float32')
+
+    if not converted:
+        return df
+    df = df.copy()
+    for col, values in converted.items():
+        df[col] = values
+    return df
+
+def category_values(s, dtype='float32'):
+    """
+    Numeric values of a categorical code column (e.g. LUC 100, 101, ...),
+    equivalent to what the column held before it was made categorical.
+    """
+    if not isinstance(s.dtype, pd.CategoricalDtype):
+        return s.astype(dtype)
+    categories = pd.to_numeric(pd.Series(s.cat.categories), errors='coerce').to_numpy(dtype=dtype)
+    codes = s.cat.codes.to_numpy()
+    values = np.where(codes >= 0, categories[codes], np.nan).astype(dtype)
+    return pd.Series(values, index=s.index, name=s.name)
+
+def map_codes(s, mapping, dtype='float64'):
+    """
+    Series.map for code columns that always returns plain numbers
+    (mapping a categorical can otherwise return a categorical result).
+    """
+    return pd.Series(np.asarray(s.map(mapping), dtype=dtype), index=s.index, name=s.name)
+
+def to_model_matrix(X):
+    """
+    Feature frame as passed to XGBoost: every column float32, categorical codes
+    replaced by their numeric values. XGBoost trains on float32, so nothing is upcast.
+    """
+    return pd.DataFrame({col: category_values(X[col]) for col in X.columns}, index=X.index)
+
+def memory_mb(df):
+    return df.memory_usage(deep=True).sum() / 1024 ** 2
+
+def get_memory_stats(df, label=None):
+    suffix = f" ({label})" if label else ""
+    return f"- Memory{suffix}: {memory_mb(df):,.1f} MB\n"
@@ -0,0 +1,100 @@
+import time
+import argparse
+import numpy as np
+import pandas as pd
+import xgboost as xgb
+from artifacts import add_arrays
+from score_parcels import MODEL_PATH, load_scoring_model, prepare_chunk
+from storage import ENGINEERED_FILE, load_frame
+
+# Explanations of the exported model's valuations: per-feature SHAP contributions from
+# XGBoost's native TreeSHAP (Booster.predict(pred_contribs=True)), computed for a whole
+# batch of rows in one call. A row's contributions plus the base value add up to its
+# prediction. serve_model.py batches and caches them per feature vector (POST /explain).
+#
+# The per-NBHD importance summary (mean |contribution| of every feature over a sample of
+# each NBHD's sales) is too slow to compute per request, so precompute_importance() runs
+# it as a background job and stores it in the model bundle as arrays:
+#   nbhd_importance_keys  NBHD codes (sorted)
+#   nbhd_importance       one row per NBHD, one column per model feature
+#   nbhd_importance_rows  sales each NBHD's summary is based on
+
+# Sales per NBHD the importance summary uses (exact TreeSHAP costs ~20 ms/row for 1000 trees)
+IMPORTANCE_SAMPLE_ROWS = 200
+# Rows per pred_contribs call in the summary job
+EXPLAIN_CHUNK_ROWS = 1000
+IMPORTANCE_ARRAYS = ['nbhd_importance_keys', 'nbhd_importance', 'nbhd_importance_rows']
+
+def contributions(booster, X, features, approx=False):
+    """
+    SHAP contributions of a float32 model matrix: (n_rows x n_features array, base values).
+    approx=True uses XGBoost's faster path-based approximation instead of exact TreeSHAP.
+    """
+    contribs = booster.predict(xgb.DMatrix(X, feature_names=features), pred_contribs=True, approx_contribs=approx)
+    # The last column is the bias (the expected prediction)
+    return contribs[:, :-1], contribs[:, -1]
+
+def top_contributions(contribs, features, n=None):
+    """{feature: contribution} of one row, largest absolute contributions first (top n if set)."""
+    order = np.argsort(-np.abs(contribs), kind='stable')[:n]
+    return {features[i]: float(contribs[i]) for i in order}
+
+def nbhd_importance(booster, X, nbhd, features, approx=False, chunk_rows=EXPLAIN_CHUNK_ROWS):
+    """
+    Mean |SHAP contribution| per feature for each NBHD of the rows of X. Returns a DataFrame
+    indexed by NBHD with one column per feature, plus n_rows.
+    """
+    nbhd = np.asarray(nbhd)
+    totals = np.zeros((len(X), len(features)))
+    for start in range(0, len(X), chunk_rows):
+        contribs, _ = contributions(booster, X[start:start + chunk_rows], features, approx)
+        totals[start:start + len(contribs)] = np.abs(contribs)
+    summary = pd.DataFrame(totals, columns=features).groupby(nbhd).mean()
+    summary['n_rows'] = pd.Series(nbhd).value_counts()
+    summary.index.name = 'NBHD'
+    return summary
+
+def sample_per_nbhd(df, max_rows=IMPORTANCE_SAMPLE_ROWS, seed=42):
+    """At most max_rows random rows of every NBHD."""
+    shuffled = df.sample(frac=1, random_state=seed)
+    return shuffled[shuffled.groupby('NBHD').cumcount() < max_rows].sort_index()
+
+def precompute_importance(model_path=MODEL_PATH, data_file=ENGINEERED_FILE, max_rows=IMPORTANCE_SAMPLE_ROWS,
+                          approx=False):
+    """
+    Computes the per-NBHD importance summary over (a sample of) the engineered sales and
+    adds it to the bundle at model_path. Returns the summary.
+    """
+    start = time.perf_counter()
+    model = load_scoring_model(model_path)
+    df = load_frame(data_file)
+    df = sample_per_nbhd(df.dropna(subset=['NBHD']), max_rows).reset_index(drop=True)
+    X = prepare_chunk(df, model)
+    print(f"Explaining {len(X):,} sales of {df['NBHD'].nunique()} NBHDs ({'approximate' if approx else 'exact'} TreeSHAP)...")
+    summary = nbhd_importance(model['booster'], X, df['NBHD'].to_numpy(), model['features'], approx)
+    add_arrays(model_path, {
+        'nbhd_importance_keys': summary.index.to_numpy(),
+        'nbhd_importance': summary[model['features']].to_numpy(),
+        'nbhd_importance_rows': summary['n_rows'].to_numpy(),
+    })
+    print(f"Importance summary for {len(summary)} NBHDs added to {model_path} in {time.perf_counter() - start:.1f}s")
+    return summary
+
+def load_importance(bundle):
+    """The bundle's per-NBHD importance summary as a DataFrame (NBHD x features), or None."""
+    if not all(name in bundle.arrays for name in IMPORTANCE_ARRAYS):
+        return None
+    summary = pd.DataFrame(bundle.arrays['nbhd_importance'], columns=bundle.features,
+                           index=pd.Index(bundle.arrays['nbhd_importance_keys'], name='NBHD'))
+    summary['n_rows'] = bundle.arrays['nbhd_importance_rows']
+    return summary
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Precompute the per-NBHD feature importance summary of an exported model bundle.")
+    parser.add_argument('--model', default=MODEL_PATH, help="Model bundle directory.")
+    parser.add_argument('--data', default=ENGINEERED_FILE, help="Engineered sales to explain.")
+    parser.add_argument('--max-rows', type=int, default=IMPORTANCE_SAMPLE_ROWS, help="Sales sampled per NBHD.")
+    parser.add_argument('--approx', action='store_true', help="Approximate contributions (much faster than exact TreeSHAP).")
+    args = parser.parse_args()
+    summary = precompute_importance(args.model, args.data, args.max_rows, args.approx)
+    print(summary.drop(columns='n_rows').mean().sort_values(ascending=False).to_string())
@@ -0,0 +1,257 @@
+import os
+import time
+import argparse
+import importlib
+import numpy as np
+import xgboost as xgb
+from sklearn.metrics import r2_score
+import profiling
+from cache import CACHE_DIR
+from storage import ENGINEERED_FILE, frame_columns, iter_frame, load_frame
+from dtypes import to_model_matrix
+from features import DEFAULT_FEATURES, compute_features, load_plan, row_features
+from parallel import CPU_BUDGET
+from target_encoding import EncodingAccumulator, fit_table
+
+train_model = importlib.import_module('03_train_model')
+
+# Out-of-core training of the single-stage model for data that doesn't fit in memory
+# (e.g. all years of county sales on a small worker). The engineered file is streamed in
+# row chunks (storage.iter_frame); each chunk gets its missing row-level features and the
+# NBHD target encoding, becomes a float32 matrix and is handed to XGBoost through a
+# DataIter. XGBoost quantizes the chunks into an ExtMemQuantileDMatrix whose pages are
+# cached on disk, so neither the frame nor the training matrix exists in memory as a whole.
+# The NBHD encoding needs the sums/counts of all training rows first: one extra pass over
+# the NBHD and PRICE columns (target_encoding.EncodingAccumulator).
+#
+# The chunk size follows from the memory limit: the budget left above the process's
+# current RSS, a share of it for one chunk (XGBoost's page cache and histograms take the
+# rest), divided by an estimate of the bytes a chunk row costs while it's converted.
+# The limit is best-effort: XGBoost's own allocations aren't bounded by it, so the peak
+# RSS is measured and a warning printed if it went over. A limit at or below the RSS
+# before training starts can't be met by any chunk size and is an error.
+
+MEMORY_LIMIT_MB = 2048
+# Share of the free memory budget one chunk (frame + matrix) may take
+CHUNK_MEMORY_SHARE = 0.25
+# Rough peak bytes per value while a chunk is read, converted and copied to XGBoost
+BYTES_PER_VALUE = 48
+MIN_CHUNK_ROWS = 10_000
+MAX_CHUNK_ROWS = 1_000_000
+EXTMEM_CACHE_DIR = os.path.join(CACHE_DIR, 'xgb_extmem')
+# Holdout evaluation (--compare): share of rows held out, chosen by a hash of the row number
+HOLDOUT_FRACTION = 0.2
+HOLDOUT_SEED = 42
+
+def training_rows(df):
+    """Rows the export model trains on (as in 04_export_model.py): price, size and NBHD known, real prices."""
+    df = df.dropna(subset=['PRICE', 'SFLA', 'NBHD'])
+    return df[df['PRICE'] > 1000]
+
+class MemoryLimitError(ValueError):
+    """The memory limit is at or below the process's RSS before training: no chunk size can meet it."""
+
+def current_rss_mb():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 ** 2
+
+def chunk_rows_for_limit(memory_limit_mb, n_columns):
+    """Rows per chunk that keep one chunk within its share of the memory left under the limit."""
+    rss_mb = current_rss_mb()
+    if memory_limit_mb <= rss_mb:
+        raise MemoryLimitError(f"Memory limit of {memory_limit_mb:,} MB is at or below the {rss_mb:,.0f} MB "
+                               f"this process already uses; no chunk size can stay under it")
+    rows = int((memory_limit_mb - rss_mb) * CHUNK_MEMORY_SHARE * 1024 ** 2 / (n_columns * BYTES_PER_VALUE))
+    if rows < MIN_CHUNK_ROWS:
+        print(f"Warning: the {memory_limit_mb - rss_mb:,.0f} MB left under the limit is less than "
+              f"{MIN_CHUNK_ROWS:,}-row chunks need; the limit will likely be exceeded")
+    return int(np.clip(rows, MIN_CHUNK_ROWS, MAX_CHUNK_ROWS))
+
+def holdout_mask(rows, fraction=HOLDOUT_FRACTION, seed=HOLDOUT_SEED):
+    """
+    True for held-out rows, from a hash of each row's position in the file, so chunked and
+    in-memory readers hold out the same rows.
+    """
+    x = np.asarray(rows, dtype=np.uint64) + np.uint64(seed)
+    # splitmix64 finalizer
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    x ^= x >> np.uint64(31)
+    return (x >> np.uint64(11)).astype(np.float64) / 2.0 ** 53 < fraction
+
+class ChunkSource:
+    """
+    The engineered file as chunks of (model matrix, target): read `columns`, compute the
+    missing row-level `features`, select training rows (optionally only the training or the
+    held-out part of a holdout split) and add NBHD_Encoded from `encoding`.
+    """
+    def __init__(self, path, features, chunk_rows, filters=None, holdout=None, context=None):
+        file_columns = frame_columns(path)
+        missing = [f for f in features if f not in file_columns]
+        # Aggregates (e.g. NBHD medians) need all rows: they must already be in the file
+        not_row_level = [f for f in missing if f not in row_features(missing)]
+        if not_row_level and not context:
+            raise ValueError(f"Features {not_row_level} depend on other rows and aren't stored in {path}; "
+                             f"run 02_feature_engineering.py first")
+        self.path = path
+        self.features = list(features)
+        self.missing = missing
+        self.columns = load_plan(self.features + ['NBHD', 'PRICE'], file_columns)
+        self.chunk_rows = chunk_rows
+        self.filters = filters
+        # None: all rows; 'train' / 'test': the rows outside / inside the holdout split
+        self.holdout = holdout
+        self.context = context
+        self.train_cols = [f for f in self.features if f != 'NBHD'] + ['NBHD_Encoded']
+
+    def frames(self, columns=None):
+        """Training-row chunks of the file (only `columns`, default: what the features need)."""
+        offset = 0
+        for chunk in iter_frame(self.path, columns or self.columns, self.filters, self.chunk_rows):
+            rows = np.arange(offset, offset + len(chunk))
+            offset += len(chunk)
+            if self.holdout is not None:
+                held_out = holdout_mask(rows)
+                chunk = chunk[held_out if self.holdout == 'test' else ~held_out]
+            chunk = training_rows(chunk)
+            if len(chunk):
+                yield chunk
+
+    def fit_encoding(self, smoothing=train_model.TE_SMOOTHING):
+        """NBHD target encoding over all training rows, from one pass over NBHD and PRICE."""
+        accumulator = EncodingAccumulator()
+        for chunk in self.frames(['NBHD', 'PRICE', 'SFLA']):
+            accumulator.update(chunk['NBHD'], chunk['PRICE'])
+        return accumulator.table(smoothing)
+
+    def matrices(self, encoding):
+        """(float32 model matrix, float32 target) per chunk."""
+        for chunk in self.frames():
+            if self.missing:
+                chunk = compute_features(chunk, self.missing, context=self.context)
+            chunk['NBHD_Encoded'] = encoding.lookup(chunk['NBHD'])
+            X = np.ascontiguousarray(to_model_matrix(chunk[self.train_cols]).to_numpy(), dtype=np.float32)
+            yield X, chunk['PRICE'].to_numpy(dtype=np.float32)
+
+class ChunkIter(xgb.DataIter):
+    """XGBoost data iterator over ChunkSource.matrices(); each full pass re-reads the file."""
+    def __init__(self, source, encoding, cache_prefix):
+        self.source = source
+        self.encoding = encoding
+        self.chunks = None
+        self.rows = 0
+        super().__init__(cache_prefix=cache_prefix)
+
+    def next(self, input_data):
+        if self.chunks is None:
+            self.chunks = self.source.matrices(self.encoding)
+            self.rows = 0
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            return False
+        X, y = chunk
+        input_data(data=X, label=y, feature_names=self.source.train_cols)
+        self.rows += len(X)
+        return True
+
+    def reset(self):
+        self.chunks = None
+
+def train_external(path, features, params, memory_limit_mb=MEMORY_LIMIT_MB, encoding=None, holdout=None,
+                   context=None, n_jobs=CPU_BUDGET, cache_dir=EXTMEM_CACHE_DIR):
+    """
+    Trains the single-stage model on `path` through external memory. `params` are
+    XGBRegressor-style; `encoding` (EncodingTable) is fitted from the training rows if not
+    given; holdout='train' trains on the rows outside the holdout split only. Raises
+    MemoryLimitError if the limit is already used up. stats['peak_rss_mb'] is the peak
+    from the start of this call (see profiling.reset_peak; the process peak where the
+    counter can't be reset).
+    Returns (booster, encoding, stats).
+    """
+    start = time.perf_counter()
+    profiling.reset_peak()
+    source = ChunkSource(path, features, chunk_rows=None, holdout=holdout, context=context)
+    source.chunk_rows = chunk_rows_for_limit(memory_limit_mb, len(source.columns))
+    print(f"External memory: chunks of {source.chunk_rows:,} rows for a {memory_limit_mb:,} MB limit")
+    if encoding is None:
+        encoding = source.fit_encoding()
+
+    native, rounds = train_model.booster_params(params, n_jobs)
+    os.makedirs(cache_dir, exist_ok=True)
+    iterator = ChunkIter(source, encoding, cache_prefix=os.path.join(cache_dir, f"train-{os.getpid()}"))
+    dtrain = xgb.ExtMemQuantileDMatrix(iterator, max_bin=native['max_bin'], nthread=n_jobs)
+    print(f"Quantized {dtrain.num_row():,} rows in {time.perf_counter() - start:.1f}s (peak RSS {profiling.rss_peak_mb():,.0f} MB)")
+    booster = xgb.train(native, dtrain, num_boost_round=rounds)
+    # XGBoost deletes the on-disk page cache with the matrix
+    del dtrain
+
+    stats = {
+        'rows': iterator.rows, 'chunk_rows': source.chunk_rows, 'seconds': time.perf_counter() - start,
+        'peak_rss_mb': profiling.rss_peak_mb(), 'memory_limit_mb': memory_limit_mb,
+    }
+    if stats['peak_rss_mb'] > memory_limit_mb:
+        print(f"Warning: peak RSS {stats['peak_rss_mb']:,.0f} MB exceeded the {memory_limit_mb:,} MB limit "
+              f"(lower it, or the chunk share / bytes-per-value estimate, for smaller chunks)")
+    return booster, encoding, stats
+
+def evaluate_external(booster, path, features, encoding, chunk_rows, context=None):
+    """R2 and RMSE of the held-out rows, predicted chunk by chunk."""
+    source = ChunkSource(path, features, chunk_rows, holdout='test', context=context)
+    y, preds = [], []
+    for X, y_chunk in source.matrices(encoding):
+        y.append(y_chunk)
+        preds.append(booster.inplace_predict(X))
+    y, preds = np.concatenate(y).astype(np.float64), np.concatenate(preds)
+    return {'r2': r2_score(y, preds), 'rmse': float(np.sqrt(np.mean((y - preds) ** 2))), 'rows': len(y)}
+
+def train_in_memory(path, features, params, n_jobs=CPU_BUDGET):
+    """The in-memory reference for the same holdout split: whole frame, one matrix. Returns (booster, R2, seconds)."""
+    start = time.perf_counter()
+    columns = load_plan(list(features) + ['NBHD', 'PRICE'], frame_columns(path))
+    df = load_frame(path, columns=columns)
+    held_out = holdout_mask(np.arange(len(df)))
+    missing = [f for f in features if f not in df.columns]
+    if missing:
+        df = compute_features(df, missing)
+    train, test = training_rows(df[~held_out]).copy(), training_rows(df[held_out]).copy()
+    table = fit_table(train['NBHD'], train['PRICE'], smoothing=train_model.TE_SMOOTHING)
+    train_cols = [f for f in features if f != 'NBHD'] + ['NBHD_Encoded']
+    for part in (train, test):
+        part['NBHD_Encoded'] = table.lookup(part['NBHD'])
+    native, rounds = train_model.booster_params(params, n_jobs)
+    dtrain = xgb.QuantileDMatrix(to_model_matrix(train[train_cols]), label=train['PRICE'], max_bin=native['max_bin'], nthread=n_jobs)
+    booster = xgb.train(native, dtrain, num_boost_round=rounds)
+    preds = booster.inplace_predict(to_model_matrix(test[train_cols]))
+    return booster, r2_score(test['PRICE'], preds), time.perf_counter() - start
+
+def compare(path=ENGINEERED_FILE, features=DEFAULT_FEATURES, params=None, memory_limit_mb=MEMORY_LIMIT_MB,
+            in_memory=True, n_jobs=CPU_BUDGET):
+    """
+    Trains on the same holdout split out-of-core and (optionally) in memory and prints
+    both holdout R2s and the peak RSS of each run (the peak counter is reset before each).
+    """
+    params = params or train_model.DEFAULT_PARAMS
+    booster, encoding, stats = train_external(path, features, params, memory_limit_mb, holdout='train', n_jobs=n_jobs)
+    metrics = evaluate_external(booster, path, features, encoding, stats['chunk_rows'])
+    print(f"External memory: R2 = {metrics['r2']:.4f} on {metrics['rows']:,} held-out rows, "
+          f"trained on {stats['rows']:,} rows in {stats['seconds']:.1f}s, peak RSS {stats['peak_rss_mb']:,.0f} MB "
+          f"(limit {memory_limit_mb:,} MB)")
+    if in_memory:
+        # Without a resettable counter the process peak includes the out-of-core run
+        note = '' if profiling.reset_peak() else ' (process peak, both runs)'
+        _, r2, seconds = train_in_memory(path, features, params, n_jobs)
+        print(f"In memory:       R2 = {r2:.4f} in {seconds:.1f}s, peak RSS {profiling.rss_peak_mb():,.0f} MB{note}")
+        print(f"R2 difference: {metrics['r2'] - r2:+.4f}")
+    return metrics, stats
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Out-of-core training on a holdout split, compared with the in-memory path.")
+    parser.add_argument('--input', default=ENGINEERED_FILE, help="Engineered features file.")
+    parser.add_argument('--memory-limit-mb', type=int, default=MEMORY_LIMIT_MB, help="Peak RSS the chunk size is chosen for (best-effort).")
+    parser.add_argument('--no-in-memory', action='store_true', help="Skip the in-memory reference run.")
+    parser.add_argument('--cpu-budget', type=int, default=CPU_BUDGET, help="XGBoost threads.")
+    args = parser.parse_args()
+    try:
+        compare(args.input, memory_limit_mb=args.memory_limit_mb, in_memory=not args.no_in_memory, n_jobs=args.cpu_budget)
+    except MemoryLimitError as e:
+        parser.error(str(e))
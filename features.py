@@ -0,0 +1,234 @@
+import hashlib
+import numpy as np
+import pandas as pd
+from dtypes import map_codes
+from nbhd_history import asof_aggregates
+import profiling
+
+# Feature registry: every derived feature declares the columns it is computed from.
+# compute_features() resolves the dependency graph for a requested feature list and
+# only computes what is needed, so training, export and inference share one definition.
+#
+# A feature can be registered more than once; the first definition whose inputs are
+# available wins (e.g. SaleYear from SALEDT, falling back to TAXYR).
+
+REGISTRY = {}
+
+# Model feature set shared by 03_train_model.py and 04_export_model.py
+DEFAULT_FEATURES = [
+    'SFLA', 'RMBED', 'YRBLT', 'NBHD', 'LUC', 'Month',
+    'HouseAge_Squared', 'Bed_Bath_Ratio',
+    'NBHD_Median_Size', 'Size_vs_NBHD', 'SFLA_Squared'
+]
+
+def get_feature_hash(features):
+    """Short, order-independent id of a feature set (Feature_Hash in experiments.csv)."""
+    return hashlib.md5(str(sorted(features)).encode()).hexdigest()[:8]
+
+class Feature:
+    def __init__(self, name, inputs, compute, aggregate=False):
+        self.name = name
+        self.inputs = list(inputs)
+        self.compute = compute
+        # Aggregates depend on other rows (whole dataset or a lookup table in the context)
+        self.aggregate = aggregate
+
+    def __repr__(self):
+        return f"Feature({self.name!r}, inputs={self.inputs})"
+
+def feature(name, inputs, aggregate=False):
+    """Decorator registering `func(df, context) -> Series` as feature `name`."""
+    def register(func):
+        REGISTRY.setdefault(name, []).append(Feature(name, inputs, func, aggregate))
+        return func
+    return register
+
+# --- Date Features ---
+
+def _sale_dates(df, context):
+    # Parsed once per compute_features call, shared by SaleYear and Month
+    if '_sale_dates' not in context:
+        context['_sale_dates'] = pd.to_datetime(df['SALEDT'], errors='coerce')
+    return context['_sale_dates']
+
+@feature('SaleYear', inputs=['SALEDT'])
+def _sale_year(df, context):
+    return _sale_dates(df, context).dt.year
+
+@feature('SaleYear', inputs=['TAXYR'])
+def _sale_year_from_taxyr(df, context):
+    return df['TAXYR']
+
+@feature('Month', inputs=['SALEDT'])
+def _month(df, context):
+    return _sale_dates(df, context).dt.month
+
+@feature('Month', inputs=['TAXYR'])
+def _month_from_taxyr(df, context):
+    return pd.Series(1, index=df.index)
+
+# --- House Age & Polynomials ---
+# (computed in float64: inputs may be stored as small integer types)
+
+@feature('HouseAge', inputs=['SaleYear', 'YRBLT'])
+def _house_age(df, context):
+    return (df['SaleYear'].astype('float64') - df['YRBLT']).clip(lower=0) # Fix negatives
+
+@feature('HouseAge_Squared', inputs=['HouseAge'])
+def _house_age_squared(df, context):
+    # Polynomial: Age^2 (Depreciation curve)
+    return df['HouseAge'].astype('float64') ** 2
+
+# --- Size Ratios & Polynomials ---
+
+@feature('SFLA_Squared', inputs=['SFLA'])
+def _sfla_squared(df, context):
+    # Polynomial: Size^2 (Luxury scaling)
+    return df['SFLA'].astype('float64') ** 2
+
+@feature('Efficiency_Ratio', inputs=['SFLA', 'TOTAL_AREA'])
+def _efficiency_ratio(df, context):
+    # Efficiency Ratio (Living / Total) - Avoid div by zero
+    return (df['SFLA'] / df['TOTAL_AREA'].replace(0, np.nan)).fillna(0)
+
+@feature('Bed_Bath_Ratio', inputs=['RMBED', 'FIXBATH'])
+def _bed_bath_ratio(df, context):
+    return (df['RMBED'] / df['FIXBATH'].replace(0, np.nan)).fillna(0)
+
+# --- Neighborhood Aggregates ---
+
+@feature('NBHD_Median_Size', inputs=['NBHD', 'SFLA'], aggregate=True)
+def _nbhd_median_size(df, context):
+    # At inference time (or for --incremental) the medians come from a lookup
+    # (context['nbhd_median_size']: NBHD -> median SFLA); otherwise from df itself.
+    medians = context.get('nbhd_median_size')
+    if medians is None:
+        medians = df.groupby('NBHD', observed=True)['SFLA'].median()
+    return map_codes(df['NBHD'], medians, dtype='float32')
+
+@feature('Size_vs_NBHD', inputs=['SFLA', 'NBHD_Median_Size'])
+def _size_vs_nbhd(df, context):
+    # Is this house larger than neighbors?
+    return df['SFLA'] - df['NBHD_Median_Size']
+
+# --- As-of Neighborhood Aggregates ---
+# Only sales of the NBHD before the row's SALEDT count (see nbhd_history.py), so no row sees
+# future or same-day sales. At inference time the latest values come from lookups
+# (context['nbhd_asof_median_size'] / ['nbhd_trailing_median_price']: NBHD -> value).
+
+ASOF_FEATURES = ['NBHD_AsOf_Median_Size', 'NBHD_Trailing_Median_Price', 'Size_vs_NBHD_AsOf']
+
+def _nbhd_asof(df, context):
+    # One pass over the sales computes both as-of aggregates
+    if '_nbhd_asof' not in context:
+        sales = df if 'PRICE' in df.columns else df.assign(PRICE=np.nan)
+        context['_nbhd_asof'], _ = asof_aggregates(sales)
+    return context['_nbhd_asof']
+
+def _asof_lookup(df, context, name, lookup):
+    values = context.get(lookup)
+    if values is None:
+        return _nbhd_asof(df, context)[name].astype('float32')
+    return map_codes(df['NBHD'], values, dtype='float32')
+
+@feature('NBHD_AsOf_Median_Size', inputs=['NBHD', 'SFLA', 'SALEDT'], aggregate=True)
+def _nbhd_asof_median_size(df, context):
+    return _asof_lookup(df, context, 'NBHD_AsOf_Median_Size', 'nbhd_asof_median_size')
+
+@feature('NBHD_Trailing_Median_Price', inputs=['NBHD', 'PRICE', 'SALEDT'], aggregate=True)
+def _nbhd_trailing_median_price(df, context):
+    return _asof_lookup(df, context, 'NBHD_Trailing_Median_Price', 'nbhd_trailing_median_price')
+
+# Inference rows have no sale history of their own: lookup only
+@feature('NBHD_AsOf_Median_Size', inputs=['NBHD'], aggregate=True)
+def _nbhd_asof_median_size_lookup(df, context):
+    return map_codes(df['NBHD'], context.get('nbhd_asof_median_size', {}), dtype='float32')
+
+@feature('NBHD_Trailing_Median_Price', inputs=['NBHD'], aggregate=True)
+def _nbhd_trailing_median_price_lookup(df, context):
+    return map_codes(df['NBHD'], context.get('nbhd_trailing_median_price', {}), dtype='float32')
+
+@feature('Size_vs_NBHD_AsOf', inputs=['SFLA', 'NBHD_AsOf_Median_Size'])
+def _size_vs_nbhd_asof(df, context):
+    return df['SFLA'] - df['NBHD_AsOf_Median_Size']
+
+def _resolve(name, is_available, plan, visiting):
+    """Adds `name` (and its dependencies) to plan. Returns False if it can't be computed."""
+    if name in plan:
+        return True
+    if name in visiting:
+        raise ValueError(f"Circular feature dependency at {name}")
+    visiting.add(name)
+    try:
+        for candidate in REGISTRY.get(name, []):
+            sub_plan = dict(plan)
+            if all(is_available(inp) or _resolve(inp, is_available, sub_plan, visiting) for inp in candidate.inputs):
+                plan.update(sub_plan)
+                plan[name] = candidate
+                return True
+        return False
+    finally:
+        visiting.discard(name)
+
+def resolve(requested, available_columns=None):
+    """
+    Returns the ordered list of Feature definitions needed to compute `requested`
+    from `available_columns` (None: assume every raw column is available).
+    Requested registered features are always recomputed; their dependencies are
+    reused if already present. Unregistered names are raw columns and are skipped.
+    """
+    if available_columns is None:
+        is_available = lambda col: col not in REGISTRY
+    else:
+        available = set(available_columns)
+        is_available = lambda col: col in available
+
+    plan = {}  # name -> Feature, insertion order is a valid computation order
+    for name in requested:
+        if name in REGISTRY and not _resolve(name, is_available, plan, set()):
+            print(f"Warning: cannot compute {name} from the available columns, skipping.")
+    return list(plan.values())
+
+def required_inputs(requested):
+    """Raw (non-registered) columns needed to compute `requested` from scratch."""
+    raw = []
+    for feat in resolve(requested):
+        raw.extend(inp for inp in feat.inputs if inp not in REGISTRY)
+    raw.extend(name for name in requested if name not in REGISTRY)
+    return list(dict.fromkeys(raw))
+
+def load_plan(requested, file_columns):
+    """
+    Columns to read from an intermediate file so `requested` can be served:
+    features stored in the file are read as-is, missing ones are computed from
+    the raw inputs they declare.
+    """
+    stored = [name for name in requested if name in file_columns]
+    missing = [name for name in requested if name not in file_columns]
+    return list(dict.fromkeys(stored + [c for c in required_inputs(missing) if c in file_columns]))
+
+def compute_features(df, requested, context=None):
+    """
+    Adds the `requested` registered features (plus the intermediate features they
+    depend on) to df in place. Each step is a vectorized column operation, profiled as
+    step 'feature:<name>' when a profiling.Profiler is active.
+    `context` carries lookups for aggregate features, e.g. {'nbhd_median_size': {...}}.
+    Returns df.
+    """
+    context = dict(context or {})
+    for feat in resolve(requested, df.columns):
+        with profiling.step(f"feature:{feat.name}", rows=len(df)):
+            df[feat.name] = feat.compute(df, context)
+    return df
+
+def row_features(requested=None):
+    """Registered features in `requested` that depend only on the row itself (no aggregates)."""
+    names = requested if requested is not None else list(REGISTRY)
+
+    def depends_on_aggregate(name):
+        return any(f.aggregate or any(depends_on_aggregate(i) for i in f.inputs if i in REGISTRY)
+                   for f in REGISTRY.get(name, []))
+
+    return [name for name in names if name in REGISTRY and not depends_on_aggregate(name)]
+
+ALL_FEATURES = list(REGISTRY)
@@ -1,10 +1,8 @@
 import pandas as pd
 import os
+from data_loader import DATA_DIR, BLDG_FILE, PARCEL_FILE
 
-BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-DATA_DIR = os.path.join(BASE_DIR, 'data')
-
-files_to_check = ['VCPA_CAMA_RES_BLDG.csv', 'VCPA_CAMA_PARCEL.csv']
+files_to_check = [BLDG_FILE, PARCEL_FILE]
 
 for fname in files_to_check:
     path = os.path.join(DATA_DIR, fname)
@@ -0,0 +1,156 @@
+import numpy as np
+import pandas as pd
+
+# As-of neighborhood statistics: for a sale, aggregates over the sales of its NBHD strictly
+# before its SALEDT (no same-day, future or own-row information):
+#   - median SFLA of all earlier sales
+#   - median PRICE of the earlier sales within the trailing TRAILING_DAYS
+#
+# Sales are sorted by (NBHD, SALEDT) once. "Sales of NBHD n before day d" (or in a trailing
+# window) is then a contiguous range of that order, found with a binary search, and a median
+# is two order statistics of a range. Range order statistics are answered for all rows at
+# once by a wavelet matrix (one stable partition per bit of the value ranks), so the whole
+# pass is a handful of vectorized NumPy operations per bit instead of a loop over rows.
+# The same structure answers inference-time queries (latest values, or as of any date).
+
+TRAILING_DAYS = 365
+
+def _day_numbers(dates):
+    """Whole days since the epoch (float64, NaN for missing/unparseable dates)."""
+    dates = pd.to_datetime(pd.Series(dates).reset_index(drop=True), errors='coerce')
+    days = dates.to_numpy(dtype='datetime64[D]').astype('int64').astype('float64')
+    days[dates.isna().to_numpy()] = np.nan
+    return days
+
+class RangeQuantiles:
+    """
+    Wavelet matrix over a sequence of values: the k-th smallest value of any positional
+    range [lo, hi), for arrays of ranges at once, in O(bits) vectorized steps.
+    """
+    def __init__(self, values):
+        values = np.asarray(values, dtype='float64')
+        self.sorted_values, ranks = np.unique(values, return_inverse=True)
+        self.n_bits = max(1, int(len(self.sorted_values) - 1).bit_length())
+        # Per level (most significant bit first): prefix count of 0 bits, and total zeros
+        self.zero_prefix = []
+        self.n_zeros = []
+        # int32 positions and ranks: half the memory traffic of int64 in the per-bit passes
+        ranks = ranks.astype('int32')
+        for bit in range(self.n_bits - 1, -1, -1):
+            is_zero = (ranks >> bit) & 1 == 0
+            self.zero_prefix.append(np.concatenate(([0], np.cumsum(is_zero, dtype='int32'))))
+            self.n_zeros.append(int(self.zero_prefix[-1][-1]))
+            ranks = np.concatenate((ranks[is_zero], ranks[~is_zero]))
+
+    def kth(self, lo, hi, k):
+        """k-th smallest (0-based) value in each range [lo, hi); ranges must hold more than k values."""
+        lo, hi, k = (np.array(a, dtype='int32') for a in (lo, hi, k))
+        rank = np.zeros(len(lo), dtype='int32')
+        for level, bit in enumerate(range(self.n_bits - 1, -1, -1)):
+            # Descend into the 0 half if it holds more than k of the range's values, else the 1 half
+            zeros_lo = self.zero_prefix[level][lo]
+            zeros_hi = self.zero_prefix[level][hi]
+            zeros = zeros_hi - zeros_lo
+            one = k >= zeros
+            k -= zeros * one
+            offset = one * np.int32(self.n_zeros[level])
+            lo = np.where(one, lo - zeros_lo, zeros_lo) + offset
+            hi = np.where(one, hi - zeros_hi, zeros_hi) + offset
+            rank |= one.astype('int32') << bit
+        return self.sorted_values[rank]
+
+    def median(self, lo, hi):
+        """Median of each range [lo, hi); NaN for empty ranges."""
+        lo, hi = np.asarray(lo), np.asarray(hi)
+        n = hi - lo
+        result = np.full(len(n), np.nan)
+        has = np.flatnonzero(n > 0)
+        if len(has):
+            lower = self.kth(lo[has], hi[has], (n[has] - 1) // 2)
+            # Odd counts have a single middle value; even ones average it with the next
+            even = n[has] % 2 == 0
+            upper = lower.copy()
+            upper[even] = self.kth(lo[has][even], hi[has][even], n[has][even] // 2)
+            result[has] = (lower + upper) / 2
+        return result
+
+class SortedSales:
+    """One value column of the sales, ordered by (NBHD, day), with its range-quantile index."""
+    def __init__(self, codes, days, values, first_day, n_days):
+        # (NBHD, day) packed into one sortable integer: code * n_days + day offset
+        self.first_day = first_day
+        self.n_days = n_days
+        keep = (codes >= 0) & ~np.isnan(days) & ~np.isnan(values)
+        keys = self._keys(codes[keep], days[keep])
+        order = np.argsort(keys, kind='stable')
+        self.keys = keys[order]
+        self.quantiles = RangeQuantiles(values[keep][order])
+
+    def _keys(self, codes, days):
+        # Days outside the stored span are clipped to its ends, which keeps them inside their NBHD block
+        offsets = np.clip(days - self.first_day, -1, self.n_days - 2) + 1
+        return codes.astype('int64') * self.n_days + offsets.astype('int64')
+
+    def median_before(self, codes, days, window_days=None):
+        """Median value of the sales of each NBHD before `days` (within the last window_days, if set)."""
+        hi = np.searchsorted(self.keys, self._keys(codes, days), side='left')
+        lo = (np.searchsorted(self.keys, codes.astype('int64') * self.n_days, side='left') if window_days is None
+              else np.searchsorted(self.keys, self._keys(codes, days - window_days), side='right'))
+        return self.quantiles.median(lo, hi)
+
+class NbhdHistory:
+    """
+    As-of neighborhood aggregates over a set of sales. query() answers any (NBHD, date)
+    pairs from the sales strictly before the date; latest() gives per-NBHD values for a
+    sale after all of them (what inference serves).
+    """
+    def __init__(self, nbhd, dates, sizes, prices, trailing_days=TRAILING_DAYS):
+        self.trailing_days = trailing_days
+        self.categories = pd.Index(pd.unique(pd.Series(nbhd).dropna()))
+        codes = self._codes(nbhd)
+        days = _day_numbers(dates)
+        has_day = ~np.isnan(days)
+        first_day = days[has_day].min() if has_day.any() else 0.0
+        self.last_day = days[has_day].max() if has_day.any() else np.nan
+        # Day offsets 1..span; 0 and span+1 hold queries before/after the stored sales
+        n_days = int((self.last_day - first_day) if has_day.any() else 0) + 3
+        self.sizes = SortedSales(codes, days, np.asarray(sizes, dtype='float64'), first_day, n_days)
+        self.prices = SortedSales(codes, days, np.asarray(prices, dtype='float64'), first_day, n_days)
+
+    def _codes(self, nbhd):
+        return self.categories.get_indexer(pd.Series(nbhd).reset_index(drop=True))
+
+    def _query_codes(self, codes, days):
+        # NaN for rows without a known NBHD or a date. Valid queries are answered in (NBHD, day)
+        # order: their searches and index lookups then walk memory mostly forward.
+        valid = np.flatnonzero((codes >= 0) & ~np.isnan(days))
+        valid = valid[np.lexsort((days[valid], codes[valid]))]
+        median_size = np.full(len(codes), np.nan)
+        trailing_price = np.full(len(codes), np.nan)
+        if len(valid):
+            median_size[valid] = self.sizes.median_before(codes[valid], days[valid])
+            trailing_price[valid] = self.prices.median_before(codes[valid], days[valid], self.trailing_days)
+        return pd.DataFrame({'NBHD_AsOf_Median_Size': median_size, 'NBHD_Trailing_Median_Price': trailing_price})
+
+    def query(self, nbhd, dates):
+        """DataFrame (NBHD_AsOf_Median_Size, NBHD_Trailing_Median_Price), one row per (nbhd, date)."""
+        return self._query_codes(self._codes(nbhd), _day_numbers(dates))
+
+    def latest(self, as_of=None):
+        """Per-NBHD values for a sale on `as_of` (default: the day after the last sale), indexed by NBHD."""
+        day = self.last_day + 1 if as_of is None else _day_numbers([as_of])[0]
+        latest = self._query_codes(np.arange(len(self.categories)), np.full(len(self.categories), day))
+        latest.index = self.categories.rename('NBHD')
+        return latest
+
+def asof_aggregates(df, trailing_days=TRAILING_DAYS):
+    """
+    (as-of features of every row of df, aligned with df; the NbhdHistory of df's sales).
+    Needs NBHD, SALEDT, SFLA and PRICE.
+    """
+    # Parsed once: the history and the per-row queries use the same dates
+    dates = pd.to_datetime(df['SALEDT'], errors='coerce')
+    history = NbhdHistory(df['NBHD'], dates, df['SFLA'], df['PRICE'], trailing_days)
+    values = history.query(df['NBHD'], dates)
+    values.index = df.index
+    return values, history
@@ -0,0 +1,43 @@
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# CPU budget shared between concurrent tasks (CV folds, trials) and the XGBoost
+# threads inside each task. Defaults to every core; override with HPP_CPU_BUDGET.
+CPU_BUDGET = int(os.environ.get('HPP_CPU_BUDGET', os.cpu_count() or 1))
+
+def split_cpu_budget(n_tasks, cpu_budget=CPU_BUDGET, max_workers=None):
+    """
+    Returns (workers, threads_per_worker) with workers * threads_per_worker <= cpu_budget,
+    so concurrent tasks never oversubscribe the cores. More workers than tasks is pointless.
+    """
+    cpu_budget = max(1, int(cpu_budget))
+    workers = max(1, min(n_tasks, cpu_budget, max_workers or cpu_budget))
+    return workers, max(1, cpu_budget // workers)
+
+def run_tasks(func, tasks, workers, initializer=None, initargs=(), on_result=None):
+    """
+    Calls func(*task) for every task tuple and returns the results in task order.
+    With workers > 1 the tasks run in a process pool; `initializer(*initargs)` runs once
+    per process, which is how large shared inputs (e.g. the feature matrix) are handed
+    over once instead of once per task. With workers == 1 everything runs in-process.
+    `on_result(result)` is called as results arrive (e.g. for progress output).
+    """
+    tasks = list(tasks)
+    if workers <= 1:
+        if initializer is not None:
+            initializer(*initargs)
+        results = []
+        for task in tasks:
+            results.append(func(*task))
+            if on_result is not None:
+                on_result(results[-1])
+        return results
+
+    results = [None] * len(tasks)
+    with ProcessPoolExecutor(max_workers=workers, initializer=initializer, initargs=initargs) as pool:
+        futures = {pool.submit(func, *task): i for i, task in enumerate(tasks)}
+        for future in as_completed(futures):
+            results[futures[future]] = future.result()
+            if on_result is not None:
+                on_result(results[futures[future]])
+    return results
@@ -0,0 +1,231 @@
+import os
+import sys
+import json
+import shlex
+import time
+import argparse
+import importlib
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import cache
+from storage import PROCESSED_FILE, ENGINEERED_FILE
+from data_loader import DATA_DIR, SALES_FILE, BLDG_FILE, PARCEL_FILE
+from parallel import CPU_BUDGET
+
+# Runs 01 -> 04 as a DAG of stages with declared inputs and outputs:
+#
+#   preprocess -> features -> train   (CV, experiments.csv)
+#                          \-> export  (model bundle)
+#
+# A stage's key hashes its input files (cache.file_fingerprint), its code (the script and
+# every local module it imports, see cache.local_modules) and its config (extra
+# arguments). A stage whose key matches the last successful run and whose outputs exist
+# is skipped. Keys are computed when a stage becomes ready, after its upstream stages ran,
+# so a re-run upstream stage that rewrote its output with new contents makes its
+# downstream stages stale, while one that wrote identical bytes doesn't.
+# Stages whose dependencies are done run concurrently (train and export), each with its
+# share of the CPU budget; their output is prefixed with the stage name.
+#
+# Outputs are only checked for existence: a hand-edited output isn't detected (use --force).
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+STATE_FILE = os.path.join(cache.CACHE_DIR, 'pipeline', 'state.json')
+DEFAULT_JOBS = 2
+
+class Stage:
+    def __init__(self, name, script, inputs, outputs, deps=(), args=()):
+        self.name = name
+        self.script = script
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.deps = list(deps)
+        self.args = list(args)
+
+    def __repr__(self):
+        return f"Stage({self.name!r}, {self.script!r})"
+
+def _stage_paths():
+    # Output paths are the scripts' own constants (imported lazily: 03/04 import XGBoost)
+    features = importlib.import_module('02_feature_engineering')
+    train = importlib.import_module('03_train_model')
+    export = importlib.import_module('04_export_model')
+    return features.NBHD_SIZE_COUNTS_FILE, train.EXPERIMENTS_FILE, export.BUNDLE_PATH
+
+def build_stages(stage_args=None):
+    """The pipeline's stages in topological order; stage_args: {stage name: [extra CLI args]}."""
+    size_counts_file, experiments_file, bundle_path = _stage_paths()
+    raw_files = [os.path.join(DATA_DIR, name) for name in (SALES_FILE, BLDG_FILE, PARCEL_FILE)]
+    stages = [
+        Stage('preprocess', '01_preprocess_data.py', raw_files, [PROCESSED_FILE]),
+        Stage('features', '02_feature_engineering.py', [PROCESSED_FILE], [ENGINEERED_FILE, size_counts_file], ['preprocess']),
+        Stage('train', '03_train_model.py', [ENGINEERED_FILE], [experiments_file], ['features']),
+        Stage('export', '04_export_model.py', [ENGINEERED_FILE], [bundle_path], ['features']),
+    ]
+    for stage in stages:
+        stage.args = list((stage_args or {}).get(stage.name, []))
+    return stages
+
+def _fingerprint(path):
+    if os.path.isdir(path):
+        # Directories (e.g. the model bundle) by their files' fingerprints
+        files = sorted(os.path.join(root, name) for root, _, names in os.walk(path) for name in names)
+        return cache.make_key(*[(os.path.relpath(p, path), cache.file_fingerprint(p)) for p in files])
+    return cache.file_fingerprint(path) if os.path.exists(path) else None
+
+def stage_key(stage):
+    """Hash of the stage's input files, code and config."""
+    code = {name: cache.file_fingerprint(os.path.join(BASE_DIR, name))['content_hash']
+            for name in sorted(cache.local_modules(stage.script))}
+    inputs = {path: _fingerprint(path) for path in stage.inputs}
+    return cache.make_key(stage.name, inputs, code, stage.args)
+
+def load_state():
+    if not os.path.exists(STATE_FILE):
+        return {}
+    try:
+        with open(STATE_FILE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+_STATE_LOCK = threading.Lock()
+
+def record_run(stage, key, seconds):
+    with _STATE_LOCK:
+        state = load_state()
+        state[stage.name] = {'key': key, 'seconds': round(seconds, 2), 'finished': time.strftime("%Y-%m-%d %H:%M:%S")}
+        os.makedirs(os.path.dirname(STATE_FILE), exist_ok=True)
+        tmp_path = f"{STATE_FILE}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f, indent=2)
+        os.replace(tmp_path, STATE_FILE)
+
+def is_up_to_date(stage, key, state):
+    return state.get(stage.name, {}).get('key') == key and all(os.path.exists(p) for p in stage.outputs)
+
+def select_stages(stages, start=None, until=None):
+    """Stages downstream of `start` (inclusive) and upstream of `until` (inclusive), in order."""
+    by_name = {s.name: s for s in stages}
+    for name in (start, until):
+        if name is not None and name not in by_name:
+            raise ValueError(f"Unknown stage {name!r}; stages: {list(by_name)}")
+
+    def closure(name, edges):
+        found = {name}
+        for other in edges(name):
+            found |= closure(other, edges)
+        return found
+
+    selected = set(by_name)
+    if start is not None:
+        selected &= closure(start, lambda n: [s.name for s in stages if n in s.deps])
+    if until is not None:
+        selected &= closure(until, lambda n: by_name[n].deps)
+    return [s for s in stages if s.name in selected]
+
+def run_stage(stage, cpu_budget):
+    """Runs a stage's script in a subprocess, its output prefixed with the stage name. Returns the exit code."""
+    env = dict(os.environ, HPP_CPU_BUDGET=str(cpu_budget), OMP_NUM_THREADS=str(cpu_budget), PYTHONUNBUFFERED='1')
+    # Same working directory as the pipeline, as when the scripts are run by hand
+    process = subprocess.Popen([sys.executable, os.path.join(BASE_DIR, stage.script)] + stage.args, env=env,
+                               stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    for line in process.stdout:
+        print(f"[{stage.name}] {line}", end='', flush=True)
+    return process.wait()
+
+def run_pipeline(start=None, until=None, force=False, dry_run=False, jobs=DEFAULT_JOBS, cpu_budget=CPU_BUDGET,
+                 stage_args=None):
+    """
+    Runs the selected stages (see select_stages), skipping up-to-date ones unless force.
+    Stages outside the selection are not run; their outputs must exist. Returns
+    {stage name: 'ran' | 'skipped' | 'failed' | 'blocked' | 'stale' (dry run)}.
+    """
+    stages = build_stages(stage_args)
+    selected = select_stages(stages, start, until)
+    selected_names = {s.name for s in selected}
+    state = load_state()
+    status = {}
+
+    for stage in selected:
+        # Inputs produced outside the selection must already be there
+        for dep in stage.deps:
+            if dep not in selected_names:
+                missing = [p for s in stages if s.name == dep for p in s.outputs if not os.path.exists(p)]
+                if missing:
+                    raise FileNotFoundError(f"{stage.name} needs {missing} from stage {dep!r}, which isn't selected")
+
+    if dry_run:
+        for stage in selected:
+            # A stage after a stale one may become stale once that one ran: shown as 'stale'
+            upstream_stale = any(status.get(dep) == 'stale' for dep in stage.deps)
+            fresh = not force and not upstream_stale and is_up_to_date(stage, stage_key(stage), state)
+            status[stage.name] = 'skipped' if fresh else 'stale'
+            print(f"{stage.name:<12} {status[stage.name]:<8} {stage.script} {' '.join(stage.args)}")
+        return status
+
+    threads = max(1, cpu_budget // max(1, jobs))
+    pending = list(selected)
+    running = {}
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        while pending or running:
+            for stage in list(pending):
+                deps = [d for d in stage.deps if d in selected_names]
+                if any(status.get(d) in ('failed', 'blocked') for d in deps):
+                    status[stage.name] = 'blocked'
+                    pending.remove(stage)
+                    continue
+                if not all(status.get(d) in ('ran', 'skipped') for d in deps) or len(running) >= jobs:
+                    continue
+                pending.remove(stage)
+                key = stage_key(stage)
+                if not force and is_up_to_date(stage, key, state):
+                    status[stage.name] = 'skipped'
+                    print(f"{stage.name}: up to date, skipped")
+                    continue
+                print(f"{stage.name}: running {stage.script} {' '.join(stage.args)}".rstrip())
+                running[pool.submit(run_stage, stage, threads)] = (stage, key, time.perf_counter())
+            if not running:
+                # Stages are in topological order, so one pass settles every stage whose
+                # dependencies were skipped: with nothing running, nothing is left to wait for
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage, key, stage_start = running.pop(future)
+                seconds = time.perf_counter() - stage_start
+                if future.result() == 0:
+                    status[stage.name] = 'ran'
+                    record_run(stage, key, seconds)
+                    print(f"{stage.name}: done in {seconds:.1f}s")
+                else:
+                    status[stage.name] = 'failed'
+                    print(f"{stage.name}: FAILED (exit code {future.result()}) after {seconds:.1f}s")
+
+    print(f"\nPipeline finished in {time.perf_counter() - start_time:.1f}s: "
+          + ", ".join(f"{name} {result}" for name, result in status.items()))
+    return status
+
+def _parse_stage_args(pairs):
+    stage_args = {}
+    for name, args in pairs or []:
+        stage_args.setdefault(name, []).extend(shlex.split(args))
+    return stage_args
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the 01 -> 04 pipeline, skipping stages whose inputs, code and config haven't changed.")
+    parser.add_argument('--from', dest='start', default=None, help="First stage to consider (and everything downstream of it).")
+    parser.add_argument('--until', default=None, help="Last stage to consider (and everything upstream of it).")
+    parser.add_argument('--force', action='store_true', help="Run the selected stages even if they are up to date.")
+    parser.add_argument('--dry-run', action='store_true', help="Only show which stages would run.")
+    parser.add_argument('--jobs', type=int, default=DEFAULT_JOBS, help="Stages run at once (independent branches).")
+    parser.add_argument('--cpu-budget', type=int, default=CPU_BUDGET, help="Cores shared by the concurrently running stages.")
+    parser.add_argument('--stage-args', nargs=2, action='append', metavar=('STAGE', 'ARGS'),
+                        help="Extra arguments for a stage's script, e.g. --stage-args train '--early-stopping 50'.")
+    args = parser.parse_args()
+    try:
+        status = run_pipeline(args.start, args.until, args.force, args.dry_run, args.jobs, args.cpu_budget,
+                              _parse_stage_args(args.stage_args))
+    except (ValueError, FileNotFoundError) as e:
+        parser.error(str(e))
+    sys.exit(1 if any(result in ('failed', 'blocked') for result in status.values()) else 0)
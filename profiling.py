@@ -0,0 +1,242 @@
+import os
+import sys
+import json
+import time
+import fnmatch
+import resource
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+from cache import CACHE_DIR
+
+# Per-step resource records for the pipeline scripts: wall time, CPU time, peak RSS and
+# rows/s of every `with step(name, rows=...)` block run while a Profiler is active.
+#   - CPU time is the whole process's (all threads, incl. XGBoost/OpenMP) for steps on the
+#     main thread, and the thread's own for steps in worker threads (e.g. concurrent table loads).
+#   - Peak RSS is the step's own peak on Linux: while a Profiler is active, the kernel's
+#     high-water mark is reset when a main-thread step starts (/proc/self/clear_refs) and
+#     enclosing steps keep the max of their children. Elsewhere it is the process peak so far.
+# Nested steps are named by their path, e.g. 'fold_1/stage1_fit'. Records are appended as
+# JSON lines to PROFILE_FILE (next to data_stats.md); Profiler.markdown() gives a table.
+#
+# Sampling profiler hook: HPP_PROFILE_STEP=<step name or glob> (e.g. 'feature:*'; matched
+# against the step's path in the process running it, e.g. 'fold_1/stage2_fit') samples
+# the stack of the thread running a matching step every SAMPLE_INTERVAL_S and writes the
+# collapsed stacks (flame graph input) to PROFILES_DIR; the hottest frames are printed.
+
+PROFILE_FILE = 'data_stats.jsonl'
+PROFILE_STEP_ENV = 'HPP_PROFILE_STEP'
+SAMPLE_INTERVAL_S = 0.005
+PROFILES_DIR = os.path.join(CACHE_DIR, 'profiles')
+
+_ACTIVE = None
+_LOCAL = threading.local()
+_CAN_RESET_PEAK = os.path.exists('/proc/self/clear_refs')
+
+def _stack():
+    if not hasattr(_LOCAL, 'steps'):
+        _LOCAL.steps = []
+    return _LOCAL.steps
+
+def rss_peak_mb():
+    """Peak RSS (MB) since the last reset (Linux) or since the process started."""
+    if _CAN_RESET_PEAK:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def _reset_peak():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+def reset_peak():
+    """
+    Resets the peak RSS counter so rss_peak_mb() covers only what follows (main thread,
+    Linux); the enclosing step keeps its peak so far. False if it can't be reset.
+    """
+    if threading.current_thread() is not threading.main_thread():
+        return False
+    stack = _stack()
+    if stack:
+        stack[-1]['_peak'] = max(stack[-1].get('_peak', 0), rss_peak_mb())
+    return _reset_peak()
+
+class Profiler:
+    """Collects the step records of one script run; active (receiving records) inside `with`."""
+    def __init__(self, stage, path=PROFILE_FILE):
+        self.stage = stage
+        self.path = path
+        self.run_id = f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{os.getpid()}"
+        self.records = []
+        self.lock = threading.Lock()
+        # Epoch seconds (comparable across processes): records' offset_s are relative to it
+        self.started = time.time()
+
+    def __enter__(self):
+        global _ACTIVE
+        self._previous = _ACTIVE
+        _ACTIVE = self
+        # Steps start a fresh path: a profiler nested in another one's step (e.g. a CV fold
+        # run in-process) names its steps as it would in a worker process
+        self._outer_steps = _stack()
+        _LOCAL.steps = []
+        return self
+
+    def __exit__(self, *exc):
+        global _ACTIVE
+        _ACTIVE = self._previous
+        _LOCAL.steps = self._outer_steps
+        if self._outer_steps and self.records:
+            outer = self._outer_steps[-1]
+            outer['_peak'] = max(outer.get('_peak', 0), max(r['peak_rss_mb'] for r in self.records))
+        return False
+
+    def add(self, record):
+        with self.lock:
+            self.records.append({**record, 'run_id': self.run_id, 'stage': self.stage})
+
+    def extend(self, records, prefix=None, started=None):
+        """
+        Adds records measured by another Profiler (e.g. in a worker process), optionally under
+        `prefix`/. `started` is that Profiler's start, to rebase the records' offsets on this one.
+        """
+        for record in records:
+            record = dict(record)
+            if prefix:
+                record['step'] = f"{prefix}/{record['step']}"
+            if started is not None and record.get('offset_s') is not None:
+                record['offset_s'] = round(record['offset_s'] + started - self.started, 4)
+            self.add(record)
+
+    def write(self):
+        """Appends the records to the JSON lines file."""
+        with open(self.path, 'a') as f:
+            for record in self.records:
+                f.write(json.dumps(record) + '\n')
+
+    def total(self, pattern, field='wall_s'):
+        return total(self.records, pattern, field)
+
+    def markdown(self, title="Profile"):
+        text = f"**{title}** (run {self.run_id})\n\n| Step | Wall s | CPU s | Peak RSS MB | Rows | Rows/s |\n|---|---|---|---|---|---|\n"
+        # Records are added when steps end (children first): list them by start
+        for r in sorted(self.records, key=lambda r: r.get('offset_s') or 0):
+            rows = f"{r['rows']:,}" if r.get('rows') is not None else ''
+            rate = f"{r['rows_per_s']:,.0f}" if r.get('rows_per_s') is not None else ''
+            text += f"| {r['step']} | {r['wall_s']:.3f} | {r['cpu_s']:.3f} | {r['peak_rss_mb']:,.0f} | {rows} | {rate} |\n"
+        return text
+
+def total(records, pattern, field='wall_s'):
+    """Sum of `field` over the records whose step matches the glob `pattern`."""
+    return sum(r[field] or 0 for r in records if fnmatch.fnmatchcase(r['step'], pattern))
+
+def peak(records, pattern='*'):
+    """Largest peak RSS (MB) of the records whose step matches `pattern` (None if there are none)."""
+    peaks = [r['peak_rss_mb'] for r in records if fnmatch.fnmatchcase(r['step'], pattern)]
+    return max(peaks) if peaks else None
+
+class StackSampler:
+    """Samples one thread's Python stack on a timer thread; counts collapsed stacks."""
+    def __init__(self, thread_id, interval=SAMPLE_INTERVAL_S):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            if stack:
+                self.samples[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def save(self, name):
+        """Writes the collapsed stacks (one 'frame;frame;... count' per line). Returns the path."""
+        os.makedirs(PROFILES_DIR, exist_ok=True)
+        safe = ''.join(c if c.isalnum() or c in '-_.' else '_' for c in name)
+        path = os.path.join(PROFILES_DIR, f"{safe}-{datetime.now().strftime('%Y%m%d-%H%M%S')}-{os.getpid()}.folded")
+        with open(path, 'w') as f:
+            for stack, count in self.samples.most_common():
+                f.write(f"{stack} {count}\n")
+        return path
+
+    def top(self, n=10):
+        """(frame, share of samples) of the innermost frames seen most often."""
+        leaves = Counter()
+        for stack, count in self.samples.items():
+            leaves[stack.rsplit(';', 1)[-1]] += count
+        total = sum(leaves.values()) or 1
+        return [(frame, count / total) for frame, count in leaves.most_common(n)]
+
+def _sampled(path):
+    pattern = os.environ.get(PROFILE_STEP_ENV)
+    return bool(pattern) and fnmatch.fnmatchcase(path, pattern)
+
+@contextmanager
+def step(name, rows=None):
+    """
+    Measures the enclosed block as step `name` of the active Profiler (only sampled, if
+    requested, when none is active). Yields the record dict; set record['rows'] inside if
+    it is only known later.
+    """
+    if _ACTIVE is None and not os.environ.get(PROFILE_STEP_ENV):
+        # Not profiling (e.g. features computed at inference time): nearly free
+        yield {'step': name, 'rows': rows}
+        return
+    stack = _stack()
+    main_thread = threading.current_thread() is threading.main_thread()
+    record = {'step': f"{stack[-1]['step']}/{name}" if stack else name, 'rows': rows}
+    # Peak of the enclosing step so far, before the counter is reset for this one
+    if stack and main_thread:
+        stack[-1]['_peak'] = max(stack[-1].get('_peak', 0), rss_peak_mb())
+    profiler = _ACTIVE
+    # Only while profiling: other readers of the process peak (e.g. external_memory) see it reset
+    reset = main_thread and profiler is not None and _reset_peak()
+    stack.append(record)
+    sampler = StackSampler(threading.get_ident()).start() if _sampled(record['step']) else None
+    cpu_clock = time.process_time if main_thread else time.thread_time
+    start_time, start_wall, start_cpu = time.time(), time.perf_counter(), cpu_clock()
+    try:
+        yield record
+    finally:
+        wall = time.perf_counter() - start_wall
+        cpu = cpu_clock() - start_cpu
+        stack.pop()
+        peak = max(rss_peak_mb(), record.pop('_peak', 0))
+        if stack and reset:
+            # The enclosing step's peak includes this one's
+            stack[-1]['_peak'] = max(stack[-1].get('_peak', 0), peak)
+        record.update({
+            'offset_s': round(start_time - profiler.started, 4) if profiler is not None else None,
+            'wall_s': round(wall, 4), 'cpu_s': round(cpu, 4), 'peak_rss_mb': round(peak, 1),
+            'rows_per_s': round(record['rows'] / wall, 1) if record.get('rows') and wall > 0 else None,
+            'timestamp': datetime.now().strftime("%Y-%m-%d %H:%M:%S"), 'pid': os.getpid(),
+        })
+        if sampler is not None:
+            sampler.stop()
+            path = sampler.save(record['step'])
+            print(f"Sampled {sum(sampler.samples.values())} stacks of step {record['step']} -> {path}")
+            for frame, share in sampler.top():
+                print(f"  {share:6.1%}  {frame}")
+        if profiler is not None:
+            profiler.add(record)
@@ -0,0 +1,141 @@
+import json
+import time
+import argparse
+import importlib
+from datetime import datetime
+import pandas as pd
+from parallel import CPU_BUDGET
+
+# The numbered pipeline scripts can't be imported with a plain import statement
+train = importlib.import_module('03_train_model')
+
+# Batch ablations: many feature sets x periods evaluated from one data load.
+# Rows are loaded and filtered once (union of all columns, union of all periods); runs
+# on the same period share the fold splits and the fold NBHD target encodings, and all
+# folds of all runs are fanned out in one process pool within the CPU budget.
+RESULTS_FILE = 'ablations.md'
+
+# Default ablations (mirroring the hand-run ones in experiments.csv); the first set of
+# each period is the baseline the others are compared against
+DEFAULT_FEATURE_SETS = {
+    'baseline': train.DEFAULT_FEATURES,
+    'with_efficiency_ratio': train.DEFAULT_FEATURES + ['Efficiency_Ratio'],
+    'no_nbhd_aggregates': [f for f in train.DEFAULT_FEATURES if f not in ('NBHD_Median_Size', 'Size_vs_NBHD')],
+    'asof_nbhd_aggregates': [f for f in train.DEFAULT_FEATURES if f not in ('NBHD_Median_Size', 'Size_vs_NBHD')]
+                            + ['NBHD_AsOf_Median_Size', 'Size_vs_NBHD_AsOf', 'NBHD_Trailing_Median_Price'],
+    'core': ['SFLA', 'RMBED', 'YRBLT', 'NBHD', 'LUC', 'HouseAge_Squared', 'Bed_Bath_Ratio'],
+}
+DEFAULT_PERIODS = [(train.DEFAULT_START_YEAR, train.DEFAULT_END_YEAR)]
+
+def load_config(path):
+    """
+    Reads an ablation config:
+    {"periods": [[2015, 2019], ...], "feature_sets": {"name": [features...], ...}, "params": {...}}
+    Missing keys fall back to the defaults.
+    """
+    with open(path) as f:
+        config = json.load(f)
+    periods = [tuple(p) for p in config.get('periods', DEFAULT_PERIODS)]
+    return config.get('feature_sets', DEFAULT_FEATURE_SETS), periods, {**train.DEFAULT_PARAMS, **config.get('params', {})}
+
+def write_comparison(table):
+    """Appends the comparison table to RESULTS_FILE (markdown, newest last)."""
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    with open(RESULTS_FILE, 'a') as f:
+        f.write(f"\n### Ablation Run: {timestamp}\n")
+        f.write("| " + " | ".join(table.columns) + " |\n")
+        f.write("|" + " --- |" * len(table.columns) + "\n")
+        for row in table.itertuples(index=False):
+            f.write("| " + " | ".join(f"{v:.4f}" if isinstance(v, float) else str(v) for v in row) + " |\n")
+    print(f"Comparison table appended to {RESULTS_FILE}")
+
+def run_ablations(feature_sets=DEFAULT_FEATURE_SETS, periods=DEFAULT_PERIODS, params=train.DEFAULT_PARAMS,
+                  cpu_budget=CPU_BUDGET, force=False):
+    """
+    Evaluates every (period, feature set) pair with the 2-stage CV of 03_train_model.py.
+    Each run is logged to experiments.csv and cached like run_experiment(); cached runs are
+    not re-trained unless force=True. Returns the comparison table.
+    """
+    print(f"\n--- Ablations: {len(feature_sets)} feature set(s) x {len(periods)} period(s) ---")
+    pending = []
+    rows = {}
+    for start_year, end_year in periods:
+        for name, features in feature_sets.items():
+            key = train.experiment_key(start_year, end_year, features, params)
+            _, cached = (None, None) if force else train.cache.get_frame(train.EXPERIMENT_CACHE_NAMESPACE, key)
+            if cached is not None:
+                print(f"{start_year}-{end_year} {name}: cached (run {cached['timestamp']})")
+                rows[(start_year, end_year, name)] = cached['metrics']
+            else:
+                pending.append((start_year, end_year, name, features, key))
+
+    if pending:
+        # One load for every pending run: union of the columns, union of the periods
+        all_features = list(dict.fromkeys(f for *_, features, _ in pending for f in features))
+        first_year = min(p[0] for p in pending)
+        last_year = max(p[1] for p in pending)
+        df, period_col = train.load_period_frame(first_year, last_year, all_features)
+
+        runs = []
+        shared = {}  # (start, end) -> (rows, splits, encodings) shared by the feature sets of a period
+        for start_year, end_year, name, features, key in pending:
+            if (start_year, end_year) not in shared:
+                in_period = df[(df[period_col] >= start_year) & (df[period_col] <= end_year)].reset_index(drop=True)
+                shared[(start_year, end_year)] = (in_period, None, None)
+            in_period, splits, encodings = shared[(start_year, end_year)]
+            if len(in_period) == 0:
+                print(f"{start_year}-{end_year}: no data found for this period.")
+                continue
+            print(f"{start_year}-{end_year} {name} ({len(features)} features)")
+            data = train.build_experiment_data(in_period, features, splits=splits, encodings=encodings)
+            shared[(start_year, end_year)] = (in_period, data['splits'], data['encodings'])
+            runs.append(((start_year, end_year, name, key), data))
+        del df, shared
+
+        cv_start = time.perf_counter()
+        results = train.cross_validate_runs([(data, params) for _, data in runs], cpu_budget)
+        cv_seconds = round(time.perf_counter() - cv_start, 2)
+
+        for ((start_year, end_year, name, key), data), fold_results in zip(runs, results):
+            metrics, oof = train.summarize_folds(fold_results, params)
+            metrics['cv_seconds'] = cv_seconds
+            metrics['experiment_key'] = key
+            metrics['search'] = f"ablation {name}"
+            train.log_experiment(start_year, end_year, data['features'], params, metrics)
+            train.store_experiment(key, metrics, oof)
+            rows[(start_year, end_year, name)] = metrics
+
+    table = []
+    for start_year, end_year in periods:
+        baseline = None
+        for name, features in feature_sets.items():
+            metrics = rows.get((start_year, end_year, name))
+            if metrics is None:
+                continue
+            if baseline is None:
+                baseline = metrics['r2_mean']
+            table.append({
+                'Period': f"{start_year}-{end_year}",
+                'Feature_Set': name,
+                'N_Features': len(features),
+                'R2_Mean': metrics['r2_mean'],
+                'R2_Std': metrics['r2_std'],
+                'RMSE_Mean': round(metrics['rmse_mean']),
+                'Delta_R2': metrics['r2_mean'] - baseline,
+            })
+    table = pd.DataFrame(table)
+    print("\n" + table.to_string(index=False))
+    write_comparison(table)
+    return table
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run many feature-set/period ablations from a single data load.")
+    parser.add_argument('--config', help="JSON file with 'periods', 'feature_sets' and optional 'params' (default: built-in ablations).")
+    parser.add_argument('--cpu-budget', type=int, default=CPU_BUDGET, help="Cores shared by concurrent folds and XGBoost threads (default: all).")
+    parser.add_argument('--force', action='store_true', help="Re-run ablations that are already cached.")
+    args = parser.parse_args()
+    if args.config:
+        feature_sets, periods, params = load_config(args.config)
+        run_ablations(feature_sets, periods, params, cpu_budget=args.cpu_budget, force=args.force)
+    else:
+        run_ablations(cpu_budget=args.cpu_budget, force=args.force)
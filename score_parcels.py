@@ -0,0 +1,157 @@
+import os
+import time
+import pickle
+import argparse
+from datetime import date
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from artifacts import load_bundle
+from data_loader import DATA_DIR, PARCEL_FILE, PARCEL_SCHEMA, CHUNK_SIZE, iter_table_chunks, load_buildings
+from dtypes import to_model_matrix
+from features import compute_features
+from target_encoding import EncodingTable
+from tree_arrays import TreeEnsemble
+
+# Batch valuation of every parcel with a residential building, using the exported model.
+# The model is loaded once; the parcel table is streamed in chunks, joined with the
+# (largest) building per parcel, run through the same features and NBHD encoding as
+# 04_export_model.py, scored, and appended to a Parquet file chunk by chunk.
+MODEL_PATH = os.path.join('..', 'volusia_property_app', 'model_bundle')
+OUTPUT_FILE = 'parcel_valuations.parquet'
+
+def load_scoring_model(path=MODEL_PATH):
+    """
+    Loads an exported model: a bundle directory (artifacts.py) or a legacy model_artifacts.pkl.
+    Returns {'booster', 'features', 'context', 'nbhd_encoding', 'version', 'ensemble', 'bundle'};
+    'ensemble' is the bundle's flattened trees (tree_arrays.TreeEnsemble) and 'bundle' the
+    artifacts.ModelBundle, both None for a pickle.
+    """
+    if os.path.isdir(path):
+        bundle = load_bundle(path)
+        prior = bundle.meta['global_mean_price']
+        prices = bundle.tables['nbhd_price_map']
+        return {
+            'booster': bundle.booster,
+            'features': bundle.features,
+            'context': bundle.context(),
+            'nbhd_encoding': lambda nbhd: prices.lookup(nbhd, default=prior),
+            'version': bundle.content_hash,
+            'ensemble': TreeEnsemble(bundle.arrays) if 'roots' in bundle.arrays else None,
+            'bundle': bundle,
+        }
+
+    with open(path, 'rb') as f:
+        artifacts = pickle.load(f)
+    if 'nbhd_encoding' in artifacts:
+        table = EncodingTable.from_arrays(artifacts['nbhd_encoding'])
+    else:
+        table = EncodingTable(list(artifacts['nbhd_price_map']), list(artifacts['nbhd_price_map'].values()),
+                              artifacts['global_mean_price'])
+    context = {'nbhd_median_size': artifacts['nbhd_size_map']}
+    for key in ['nbhd_asof_median_size', 'nbhd_trailing_median_price']:
+        if key in artifacts:
+            context[key] = artifacts[key]
+    return {
+        'booster': artifacts['model'].get_booster(),
+        'features': artifacts['features'],
+        'context': context,
+        'nbhd_encoding': table.lookup,
+        'version': os.path.basename(path),
+        'ensemble': None,
+        'bundle': None,
+    }
+
+def prepare_chunk(chunk, model, as_of=None):
+    """
+    Model matrix (float32) of a chunk of parcel + building rows: missing numeric inputs are
+    filled with 0 as in 01_preprocess_data.clean_data, the sale date is the valuation date
+    `as_of` (if given), features come from features.compute_features and NBHD_Encoded from
+    the exported encoding.
+    """
+    numeric_cols = chunk.select_dtypes(include=[np.number]).columns
+    chunk[numeric_cols] = chunk[numeric_cols].fillna(0)
+    if as_of is not None:
+        chunk['SALEDT'] = as_of
+    registered = [f for f in model['features'] if f != 'NBHD_Encoded']
+    chunk = compute_features(chunk, registered, context=model['context'])
+    chunk['NBHD_Encoded'] = model['nbhd_encoding'](chunk['NBHD'])
+    return to_model_matrix(chunk[model['features']]).to_numpy()
+
+def score_parcels(model_path=MODEL_PATH, output_file=OUTPUT_FILE, data_dir=DATA_DIR, as_of=None,
+                  chunksize=CHUNK_SIZE, use_cache=True):
+    """
+    Values every parcel with a residential building as of `as_of` (default: today) and
+    writes (PARID, PREDICTED_PRICE) to `output_file`. Returns the number of rows scored.
+    """
+    as_of = as_of or date.today().isoformat()
+    start = time.perf_counter()
+    model = load_scoring_model(model_path)
+    print(f"Model {model['version']} loaded ({len(model['features'])} features) in {time.perf_counter() - start:.2f}s")
+
+    buildings, _ = load_buildings(data_dir, use_cache=use_cache)
+    buildings = buildings.set_index('PARID')
+    print(f"Buildings: {len(buildings):,} parcels")
+
+    timings = {'read_join': 0.0, 'features': 0.0, 'predict': 0.0, 'write': 0.0}
+    seen = set()  # A parcel listed in two chunks is only scored once
+    rows_read = rows_scored = 0
+    writer = None
+    score_start = time.perf_counter()
+    step = time.perf_counter()
+    try:
+        for chunk in iter_table_chunks(os.path.join(data_dir, PARCEL_FILE), PARCEL_SCHEMA, chunksize):
+            rows_read += len(chunk)
+            chunk = chunk.drop_duplicates('PARID')
+            chunk = chunk[~chunk['PARID'].isin(seen)]
+            seen.update(chunk['PARID'])
+            chunk = chunk.join(buildings, on='PARID', how='inner').reset_index(drop=True)
+            now = time.perf_counter()
+            timings['read_join'] += now - step
+            step = now
+            if chunk.empty:
+                continue
+
+            X = prepare_chunk(chunk, model, as_of)
+            now = time.perf_counter()
+            timings['features'] += now - step
+            step = now
+
+            preds = model['booster'].inplace_predict(X)
+            now = time.perf_counter()
+            timings['predict'] += now - step
+            step = now
+
+            table = pa.table({'PARID': chunk['PARID'].astype(str).to_numpy(),
+                              'PREDICTED_PRICE': np.asarray(preds, dtype=np.float32)})
+            if writer is None:
+                schema = table.schema.with_metadata({'model_version': model['version'], 'as_of': as_of})
+                writer = pq.ParquetWriter(output_file, schema)
+            writer.write_table(table.cast(writer.schema))
+            rows_scored += len(table)
+            now = time.perf_counter()
+            timings['write'] += now - step
+            step = now
+            print(f"  {rows_scored:,} parcels scored ({rows_read:,} read)")
+    finally:
+        if writer is not None:
+            writer.close()
+
+    seconds = time.perf_counter() - score_start
+    print(f"\nScored {rows_scored:,} parcels (of {rows_read:,} parcel rows) as of {as_of} in {seconds:.2f}s: "
+          f"{rows_scored / max(seconds, 1e-9):,.0f} rows/s")
+    print("Time per step: " + ", ".join(f"{name} {value:.2f}s" for name, value in timings.items()))
+    if rows_scored:
+        print(f"Predictions written to {output_file}")
+    return rows_scored
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Value every parcel with a residential building using the exported model.")
+    parser.add_argument('--model', default=MODEL_PATH, help="Model bundle directory or legacy model_artifacts.pkl.")
+    parser.add_argument('--output', default=OUTPUT_FILE, help="Parquet file for (PARID, PREDICTED_PRICE).")
+    parser.add_argument('--data-dir', default=DATA_DIR, help="Directory with the raw CAMA tables.")
+    parser.add_argument('--as-of', default=None, help="Valuation date (YYYY-MM-DD) used as the sale date (default: today).")
+    parser.add_argument('--chunksize', type=int, default=CHUNK_SIZE, help="Parcel rows per chunk.")
+    parser.add_argument('--no-cache', action='store_true', help="Don't use the parsed raw table cache for buildings.")
+    args = parser.parse_args()
+    score_parcels(args.model, args.output, args.data_dir, args.as_of, args.chunksize, use_cache=not args.no_cache)
@@ -0,0 +1,122 @@
+import math
+import time
+import random
+import argparse
+import itertools
+import importlib
+from parallel import CPU_BUDGET
+
+# The numbered pipeline scripts can't be imported with a plain import statement
+train = importlib.import_module('03_train_model')
+
+# Hyperparameter search with successive halving on top of 03_train_model's CV loop.
+# Every sampled configuration is first evaluated cheaply (one fold, a fraction of its
+# boosting rounds); only the best 1/ETA of each rung is promoted to more folds and rounds,
+# and the last rung is a full 5-fold experiment with the configuration's own params.
+
+# Values tried per param; configurations are sampled from their product
+SEARCH_SPACE = {
+    'max_depth': [4, 6, 8, 10],
+    'learning_rate': [0.02, 0.05, 0.1, 0.2],
+    'n_estimators': [300, 1000, 2000],
+    'stage1_bins': [20, 50, 100, 200],
+}
+DEFAULT_TRIALS = 27
+ETA = 3
+N_RUNGS = 3
+# Cheap rungs never train fewer rounds than this
+MIN_ROUNDS = 100
+SEARCH_SEED = 42
+
+def sample_configs(space, n_trials, seed=SEARCH_SEED):
+    """Up to n_trials distinct param combinations from the space, in a reproducible order."""
+    names = list(space)
+    grid = list(itertools.product(*(space[name] for name in names)))
+    picks = random.Random(seed).sample(grid, min(n_trials, len(grid)))
+    return [dict(zip(names, values)) for values in picks]
+
+def rung_schedule(n_rungs=N_RUNGS, eta=ETA):
+    """
+    (folds, share of n_estimators) per rung: each rung has eta times the budget of the
+    previous one, and the last rung is the full experiment (every fold, every round).
+    """
+    schedule = []
+    for rung in range(n_rungs):
+        share = 1 / eta ** (n_rungs - 1 - rung)
+        schedule.append((max(1, math.ceil(train.N_FOLDS * share)), share))
+    return schedule
+
+def rung_params(params, share):
+    """Params of a trial at a rung: n_estimators cut to the rung's share (at least MIN_ROUNDS)."""
+    n_estimators = params.get('n_estimators', 100)
+    return {**params, 'n_estimators': min(n_estimators, max(MIN_ROUNDS, math.ceil(n_estimators * share)))}
+
+def successive_halving(start_year=train.DEFAULT_START_YEAR, end_year=train.DEFAULT_END_YEAR, features=train.DEFAULT_FEATURES,
+                       space=SEARCH_SPACE, n_trials=DEFAULT_TRIALS, eta=ETA, n_rungs=N_RUNGS,
+                       base_params=train.DEFAULT_PARAMS, cpu_budget=CPU_BUDGET, seed=SEARCH_SEED):
+    """
+    Searches `space` by successive halving. The data is loaded once; all trials of a rung
+    run concurrently within the CPU budget. Every trial is logged through log_experiment
+    with the metrics of the last rung it reached (Search column: id, rung, folds, rounds).
+    Returns the finished trials, best first.
+    """
+    search_id = f"sh-{time.strftime('%Y%m%d-%H%M%S')}"
+    configs = [{**base_params, **config} for config in sample_configs(space, n_trials, seed)]
+    schedule = rung_schedule(n_rungs, eta)
+    print(f"\n--- Successive halving {search_id}: {len(configs)} configurations, eta={eta} ---")
+    print("Rungs (folds, share of rounds): " + ", ".join(f"({folds}, {share:.2f})" for folds, share in schedule))
+
+    data = train.load_experiment_data(start_year, end_year, features)
+    if data is None:
+        return []
+
+    search_start = time.perf_counter()
+    finished = []
+    survivors = configs
+    for rung, (n_folds, share) in enumerate(schedule, start=1):
+        trials = [rung_params(config, share) for config in survivors]
+        print(f"\nRung {rung}/{len(schedule)}: {len(trials)} trial(s) x {n_folds} fold(s)")
+        rung_start = time.perf_counter()
+        results = train.cross_validate(data, trials, cpu_budget, n_folds=n_folds)
+        rung_seconds = round(time.perf_counter() - rung_start, 2)
+
+        scored = []
+        for config, params, fold_results in zip(survivors, trials, results):
+            metrics, oof = train.summarize_folds(fold_results, params)
+            metrics['cv_seconds'] = rung_seconds
+            metrics['search'] = f"{search_id} rung {rung}/{len(schedule)} ({n_folds} folds, {params['n_estimators']} rounds)"
+            scored.append((metrics['r2_mean'], config, params, metrics, oof))
+        scored.sort(key=lambda s: s[0], reverse=True)
+
+        last_rung = rung == len(schedule)
+        n_keep = len(scored) if last_rung else max(1, math.ceil(len(scored) / eta))
+        for rank, (r2, config, params, metrics, oof) in enumerate(scored):
+            promoted = rank < n_keep and not last_rung
+            print(f"  R2 = {r2:.4f} {'->' if promoted else '  '} "
+                  + ", ".join(f"{name}={config[name]}" for name in space))
+            if promoted:
+                continue
+            if last_rung:
+                # A full experiment: cache it so run_experiment() with these params is a hit
+                metrics['experiment_key'] = train.experiment_key(start_year, end_year, features, params)
+                train.store_experiment(metrics['experiment_key'], metrics, oof)
+            train.log_experiment(start_year, end_year, data['features'], params, metrics)
+            finished.append({'rung': rung, 'r2_mean': r2, 'params': params, 'metrics': metrics})
+        survivors = [config for _, config, _, _, _ in scored[:n_keep]]
+
+    finished.sort(key=lambda t: (t['rung'], t['r2_mean']), reverse=True)
+    best = finished[0]
+    print(f"\nSearch complete in {time.perf_counter() - search_start:.1f}s "
+          f"({len(configs)} configurations, {sum(len(t['metrics']['fold_r2']) for t in finished)} fold evaluations)")
+    print(f"Best: R2 = {best['r2_mean']:.4f} with {best['params']}")
+    return finished
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Hyperparameter search (successive halving) over the 2-stage CV experiment.")
+    parser.add_argument('--trials', type=int, default=DEFAULT_TRIALS, help="Configurations sampled from the search space.")
+    parser.add_argument('--eta', type=int, default=ETA, help="Keep the best 1/ETA of each rung; rungs grow by ETA.")
+    parser.add_argument('--rungs', type=int, default=N_RUNGS, help="Number of rungs (the last one is a full experiment).")
+    parser.add_argument('--cpu-budget', type=int, default=CPU_BUDGET, help="Cores shared by concurrent trials and XGBoost threads (default: all).")
+    parser.add_argument('--seed', type=int, default=SEARCH_SEED, help="Seed for sampling configurations.")
+    args = parser.parse_args()
+    successive_halving(n_trials=args.trials, eta=args.eta, n_rungs=args.rungs, cpu_budget=args.cpu_budget, seed=args.seed)
@@ -0,0 +1,331 @@
+import json
+import time
+import queue
+import argparse
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from datetime import date
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import numpy as np
+import pandas as pd
+from explain import contributions, top_contributions, load_importance, precompute_importance
+from features import required_inputs
+from score_parcels import MODEL_PATH, load_scoring_model, prepare_chunk
+
+# Local prediction service around the exported model (bundle or legacy pickle).
+#   POST /predict  {"rows": [{"SFLA": 2000, "NBHD": 1000, ...}, ...]}  (or a single row object)
+#               -> {"predictions": [...], "model_version": "..."}
+#   POST /explain  same input -> {"explanations": [{"prediction", "base_value", "contributions"}, ...]}
+#   GET  /importance[?nbhd=N]  precomputed per-NBHD mean |SHAP| per feature (explain.py)
+#   GET  /stats    request/row counts, p50/p99 latency, cache hit rate, mean batch size
+#   GET  /health
+# Concurrent requests are grouped into micro-batches: the batcher waits up to
+# BATCH_WAIT_MS after the first queued request (or until MAX_BATCH_ROWS rows), then
+# computes features for the whole batch and scores the rows missing from the LRU cache
+# in one booster call. The cache is keyed on the row's float32 model feature vector,
+# so inputs that normalize to the same features (e.g. resent slider values) are hits.
+# Explanations (SHAP contributions, explain.py) go through their own micro-batcher and
+# cache: one TreeSHAP call per batch, and each feature vector is explained once.
+# A lone cache miss is scored by the bundle's flattened trees (tree_arrays.py), which skip
+# the booster's per-call setup; larger batches go to the booster.
+HOST = '127.0.0.1'
+PORT = 8000
+BATCH_WAIT_MS = 5
+MAX_BATCH_ROWS = 1024
+CACHE_SIZE = 100_000
+# Latencies kept for the percentiles
+LATENCY_WINDOW = 10_000
+# Pending connections the socket accepts (the http.server default of 5 resets bursts of clients)
+LISTEN_BACKLOG = 128
+
+class LRUCache:
+    """Bounded feature-vector -> result (prediction or explanation) cache with hit/miss counters (thread-safe)."""
+    def __init__(self, max_size=CACHE_SIZE):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'size': len(self.entries), 'max_size': self.max_size, 'hits': self.hits,
+                    'misses': self.misses, 'hit_rate': self.hits / lookups if lookups else None}
+
+class LatencyStats:
+    """Request counters and a rolling window of latencies for p50/p99."""
+    def __init__(self, window=LATENCY_WINDOW):
+        self.latencies = deque(maxlen=window)
+        self.requests = 0
+        self.rows = 0
+        self.errors = 0
+        self.batches = 0
+        self.batch_rows = 0
+        self.lock = threading.Lock()
+
+    def record_request(self, seconds, rows, error=False):
+        with self.lock:
+            self.latencies.append(seconds)
+            self.requests += 1
+            self.rows += rows
+            self.errors += error
+
+    def record_batch(self, rows):
+        with self.lock:
+            self.batches += 1
+            self.batch_rows += rows
+
+    def stats(self):
+        with self.lock:
+            latencies = np.array(self.latencies)
+            p50, p99 = np.percentile(latencies, [50, 99]) * 1000 if len(latencies) else (None, None)
+            return {'requests': self.requests, 'rows': self.rows, 'errors': self.errors,
+                    'latency_ms_p50': p50, 'latency_ms_p99': p99,
+                    'batches': self.batches,
+                    'mean_batch_rows': self.batch_rows / self.batches if self.batches else None}
+
+class MicroBatcher:
+    """
+    Collects submitted requests (lists of rows) for up to max_wait_ms or max_rows rows and
+    hands them to predict_batch(rows) -> predictions in one call, on a background thread.
+    """
+    def __init__(self, predict_batch, max_wait_ms=BATCH_WAIT_MS, max_rows=MAX_BATCH_ROWS, on_batch=None):
+        self.predict_batch = predict_batch
+        self.max_wait = max_wait_ms / 1000
+        self.max_rows = max_rows
+        self.on_batch = on_batch
+        self.queue = queue.Queue()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def submit(self, rows):
+        """Future of the predictions of `rows` (a list of input dicts)."""
+        future = Future()
+        self.queue.put((rows, future))
+        return future
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            n_rows = len(batch[0][0])
+            deadline = time.perf_counter() + self.max_wait
+            while n_rows < self.max_rows:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                batch.append(item)
+                n_rows += len(item[0])
+            self._score(batch, n_rows)
+
+    def _score(self, batch, n_rows):
+        try:
+            preds = self.predict_batch([row for rows, _ in batch for row in rows])
+        except Exception as e:
+            if len(batch) == 1:
+                batch[0][1].set_exception(e)
+            else:
+                # One bad request shouldn't fail the others: score them one by one
+                for item in batch:
+                    self._score([item], len(item[0]))
+            return
+        if self.on_batch is not None:
+            self.on_batch(n_rows)
+        start = 0
+        for rows, future in batch:
+            future.set_result(preds[start:start + len(rows)])
+            start += len(rows)
+
+class PredictionService:
+    """The model, the micro-batcher, the result cache and the counters behind the HTTP handler."""
+    def __init__(self, model_path=MODEL_PATH, max_wait_ms=BATCH_WAIT_MS, max_rows=MAX_BATCH_ROWS, cache_size=CACHE_SIZE,
+                 precompute=False):
+        self.model_path = model_path
+        self.model = load_scoring_model(model_path)
+        self.cache = LRUCache(cache_size)
+        self.explain_cache = LRUCache(cache_size)
+        self.latency = LatencyStats()
+        self.batcher = MicroBatcher(self.predict_rows, max_wait_ms, max_rows, on_batch=self.latency.record_batch)
+        self.explainer = MicroBatcher(self.explain_rows, max_wait_ms, max_rows)
+        bundle = self.model['bundle']
+        self.importance = load_importance(bundle) if bundle is not None else None
+        if precompute and bundle is not None and self.importance is None:
+            threading.Thread(target=self._precompute_importance, daemon=True).start()
+
+    def _precompute_importance(self):
+        # Background job: the summary is written into the bundle, then served from memory
+        self.importance = precompute_importance(self.model_path)
+
+    def _model_matrix(self, rows):
+        """
+        float32 model matrix of a list of input dicts, and the cache key of every row.
+        Raises ValueError naming the input fields the features need but no row has.
+        """
+        df = pd.DataFrame(rows)
+        if 'SALEDT' not in df.columns:
+            df['SALEDT'] = date.today().isoformat()
+        df['SALEDT'] = df['SALEDT'].fillna(date.today().isoformat())
+        columns = list(df.columns)
+        try:
+            X = np.ascontiguousarray(prepare_chunk(df, self.model), dtype=np.float32)
+        except KeyError as e:
+            needed = [f for f in self.model['features'] if f != 'NBHD_Encoded'] + ['NBHD']
+            missing = [c for c in required_inputs(needed) if c not in columns] or [str(e.args[0])]
+            raise ValueError(f"missing field{'s' if len(missing) > 1 else ''} {', '.join(missing)}") from e
+        return X, [X[i].tobytes() for i in range(len(X))]
+
+    def predict_rows(self, rows):
+        """Predictions for a list of input dicts: features for all rows, booster only for cache misses."""
+        X, keys = self._model_matrix(rows)
+        preds = np.empty(len(X), dtype=np.float64)
+        missing = []
+        for i, key in enumerate(keys):
+            cached = self.cache.get(key)
+            if cached is None:
+                missing.append(i)
+            else:
+                preds[i] = cached
+        if len(missing) == 1 and self.model['ensemble'] is not None:
+            preds[missing[0]] = self.model['ensemble'].predict_row(X[missing[0]])
+        elif missing:
+            preds[missing] = self.model['booster'].inplace_predict(X[missing])
+        # Both paths fill the cache: a repeated input is served the value it got first
+        for i in missing:
+            self.cache.put(keys[i], float(preds[i]))
+        return preds.tolist()
+
+    def explain_rows(self, rows):
+        """SHAP explanations for a list of input dicts: one TreeSHAP call for the uncached rows."""
+        X, keys = self._model_matrix(rows)
+        explained = [self.explain_cache.get(key) for key in keys]
+        missing = [i for i, item in enumerate(explained) if item is None]
+        if missing:
+            contribs, base = contributions(self.model['booster'], X[missing], self.model['features'])
+            for j, i in enumerate(missing):
+                explained[i] = (contribs[j], float(base[j]))
+                self.explain_cache.put(keys[i], explained[i])
+        return [{'prediction': base + float(contribs.sum(dtype=np.float64)), 'base_value': base,
+                 'contributions': top_contributions(contribs, self.model['features'])}
+                for contribs, base in explained]
+
+    def predict(self, rows):
+        # An empty request has nothing to batch (and would count as a 0-row batch)
+        return self.batcher.submit(rows).result() if rows else []
+
+    def explain(self, rows):
+        return self.explainer.submit(rows).result() if rows else []
+
+    def nbhd_importance(self, nbhd=None):
+        """{NBHD: {feature: mean |SHAP|, n_rows}} (one NBHD if given), or None before the summary exists."""
+        importance = self.importance
+        if importance is None:
+            return None
+        if nbhd is not None:
+            importance = importance[importance.index.astype(str) == str(nbhd)]
+        return {str(k): {f: float(v) for f, v in row.items()} for k, row in importance.iterrows()}
+
+    def stats(self):
+        return {'model_version': self.model['version'], **self.latency.stats(), 'cache': self.cache.stats(),
+                'explain_cache': self.explain_cache.stats()}
+
+class PredictionServer(ThreadingHTTPServer):
+    request_queue_size = LISTEN_BACKLOG
+
+def make_handler(service):
+    class Handler(BaseHTTPRequestHandler):
+        def _send(self, status, payload):
+            body = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path == '/importance':
+                importance = service.nbhd_importance(parse_qs(url.query).get('nbhd', [None])[0])
+                if importance is None:
+                    self._send(404, {'error': "no NBHD importance summary in the bundle (run explain.py)"})
+                else:
+                    self._send(200, {'importance': importance, 'model_version': service.model['version']})
+            elif self.path == '/stats':
+                self._send(200, service.stats())
+            elif self.path == '/health':
+                self._send(200, {'status': 'ok', 'model_version': service.model['version']})
+            else:
+                self._send(404, {'error': f"unknown path {self.path}"})
+
+        def do_POST(self):
+            routes = {'/predict': (service.predict, 'predictions'), '/explain': (service.explain, 'explanations')}
+            if self.path not in routes:
+                self._send(404, {'error': f"unknown path {self.path}"})
+                return
+            handle, key = routes[self.path]
+            start = time.perf_counter()
+            rows = []
+            try:
+                payload = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+                rows = payload['rows'] if 'rows' in payload else [payload]
+                results = handle(rows)
+            except Exception as e:
+                service.latency.record_request(time.perf_counter() - start, len(rows), error=True)
+                self._send(400, {'error': str(e)})
+                return
+            service.latency.record_request(time.perf_counter() - start, len(rows))
+            self._send(200, {key: results, 'model_version': service.model['version']})
+
+        def log_message(self, format, *args):
+            # Per-request access logs would dominate the output; /stats has the counters
+            pass
+
+    return Handler
+
+def serve(model_path=MODEL_PATH, host=HOST, port=PORT, max_wait_ms=BATCH_WAIT_MS, max_rows=MAX_BATCH_ROWS, cache_size=CACHE_SIZE,
+          precompute=False):
+    service = PredictionService(model_path, max_wait_ms, max_rows, cache_size, precompute)
+    server = PredictionServer((host, port), make_handler(service))
+    print(f"Serving model {service.model['version']} on http://{host}:{port} "
+          f"(batches: {max_wait_ms} ms / {max_rows} rows, cache: {cache_size:,} entries)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(json.dumps(service.stats(), indent=2))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local HTTP prediction service with micro-batching and an LRU result cache.")
+    parser.add_argument('--model', default=MODEL_PATH, help="Model bundle directory or legacy model_artifacts.pkl.")
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--batch-wait-ms', type=float, default=BATCH_WAIT_MS, help="Max wait for more requests after the first one of a batch.")
+    parser.add_argument('--max-batch', type=int, default=MAX_BATCH_ROWS, help="Max rows per batch.")
+    parser.add_argument('--cache-size', type=int, default=CACHE_SIZE, help="Max cached predictions and explanations (LRU, each).")
+    parser.add_argument('--precompute-importance', action='store_true',
+                        help="Compute the per-NBHD importance summary in the background if the bundle has none.")
+    args = parser.parse_args()
+    serve(args.model, args.host, args.port, args.batch_wait_ms, args.max_batch, args.cache_size, args.precompute_importance)
@@ -0,0 +1,110 @@
+import os
+import pandas as pd
+import pyarrow.parquet as pq
+from dtypes import restore_categoricals
+
+# Intermediate files between pipeline stages are stored as Parquet:
+# typed, columnar and compressed, so readers can load only the columns they need.
+# CSV copies are only written when explicitly requested (e.g. for inspection in Excel).
+PROCESSED_FILE = 'processed_data.parquet'
+ENGINEERED_FILE = 'engineered_features.parquet'
+# Rows per Parquet row group: the unit a streaming reader (iter_frame) has to decode at once
+ROW_GROUP_ROWS = 100_000
+
+def csv_path_for(path):
+    """Returns the CSV export path next to a Parquet intermediate."""
+    return os.path.splitext(path)[0] + '.csv'
+
+def _normalize_object_columns(df):
+    """
+    Parquet needs one type per column. Raw CAMA columns sometimes mix numbers and
+    strings (e.g. instrument numbers), so those are stored as strings.
+    """
+    mixed = [c for c in df.select_dtypes(include=['object']).columns
+             if pd.api.types.infer_dtype(df[c], skipna=True).startswith('mixed')]
+    if mixed:
+        df = df.copy()
+        for col in mixed:
+            df[col] = df[col].astype(str).where(df[col].notna())
+    return df
+
+def save_frame(df, path, export_csv=False):
+    """Writes an intermediate DataFrame as Parquet (and optionally a CSV copy)."""
+    _normalize_object_columns(df).to_parquet(path, index=False, engine='pyarrow', row_group_size=ROW_GROUP_ROWS)
+    if export_csv:
+        csv_path = csv_path_for(path)
+        print(f"Exporting CSV copy to {csv_path}...")
+        df.to_csv(csv_path, index=False)
+
+def frame_exists(path):
+    return os.path.exists(path) or os.path.exists(csv_path_for(path))
+
+def frame_columns(path):
+    """Returns the column names of an intermediate file without reading its data."""
+    if os.path.exists(path):
+        return pq.read_schema(path).names
+    return pd.read_csv(csv_path_for(path), nrows=0).columns.tolist()
+
+def _apply_filters(df, filters):
+    """In-memory equivalent of pyarrow's [(column, op, value), ...] row filters."""
+    ops = {
+        '==': lambda s, v: s == v, '!=': lambda s, v: s != v,
+        '<': lambda s, v: s < v, '<=': lambda s, v: s <= v,
+        '>': lambda s, v: s > v, '>=': lambda s, v: s >= v,
+        'in': lambda s, v: s.isin(v),
+    }
+    mask = pd.Series(True, index=df.index)
+    for col, op, value in filters:
+        mask &= ops[op](df[col], value)
+    return df[mask].reset_index(drop=True)
+
+def load_frame(path, columns=None, filters=None):
+    """
+    Loads an intermediate file written by save_frame.
+    If `columns` is given, only those columns are read (missing ones are skipped).
+    `filters` is a list of (column, op, value) tuples, e.g. [('SaleYear', '>=', 2015)];
+    rows are filtered while reading, before conversion to pandas.
+    Falls back to the legacy CSV file if the Parquet file does not exist yet.
+    """
+    if columns is not None:
+        columns = list(dict.fromkeys(columns))  # De-duplicate, keep order
+
+    if not os.path.exists(path):
+        csv_path = csv_path_for(path)
+        print(f"{path} not found, falling back to {csv_path}...")
+        usecols = (lambda c: c in columns) if columns is not None else None
+        df = pd.read_csv(csv_path, usecols=usecols, low_memory=False)
+        return restore_categoricals(_apply_filters(df, filters) if filters else df)
+
+    if columns is not None:
+        available = set(frame_columns(path))
+        columns = [c for c in columns if c in available]
+    df = pd.read_parquet(path, columns=columns, filters=filters, engine='pyarrow')
+    return restore_categoricals(df)
+
+def iter_frame(path, columns=None, filters=None, batch_rows=ROW_GROUP_ROWS):
+    """
+    Streams an intermediate file as DataFrames of at most `batch_rows` rows, with the same
+    `columns` / `filters` handling as load_frame, so the whole file is never in memory.
+    Categorical columns are restored per batch (their categories can differ between batches).
+    """
+    if columns is not None:
+        columns = list(dict.fromkeys(columns))
+    if not os.path.exists(path):
+        csv_path = csv_path_for(path)
+        usecols = (lambda c: c in columns) if columns is not None else None
+        for chunk in pd.read_csv(csv_path, usecols=usecols, chunksize=batch_rows, low_memory=False):
+            yield restore_categoricals(_apply_filters(chunk, filters) if filters else chunk)
+        return
+
+    if columns is not None:
+        available = set(frame_columns(path))
+        columns = [c for c in columns if c in available]
+    # One row group is decoded at a time (a dataset scanner reads ahead several), and
+    # filters are applied per batch
+    for batch in pq.ParquetFile(path).iter_batches(batch_size=batch_rows, columns=columns):
+        chunk = batch.to_pandas()
+        if filters:
+            chunk = _apply_filters(chunk, filters)
+        if len(chunk):
+            yield restore_categoricals(chunk)
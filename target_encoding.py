@@ -0,0 +1,123 @@
+import numpy as np
+import pandas as pd
+
+# Target encoding of categorical codes (NBHD, LUC, ...) from per-category sums and counts.
+# Cross-validation needs, for every fold, the encoding learned on that fold's TRAIN rows.
+# Instead of a groupby per fold, the sums and counts of the whole dataset are computed
+# once and each fold's own (validation) contribution is subtracted.
+#
+# Encodings can be smoothed toward the prior (the mean price):
+#   (sum + smoothing * prior) / (count + smoothing)
+# so rare categories don't get extreme values; smoothing=0 is the plain category mean.
+
+def category_codes(s):
+    """(integer codes, categories) of a column; code -1 marks a missing value."""
+    if not isinstance(s.dtype, pd.CategoricalDtype):
+        s = s.astype('category')
+    return s.cat.codes.to_numpy(), s.cat.categories.to_numpy()
+
+def _sums_counts(codes, y, n_categories):
+    valid = codes >= 0
+    sums = np.bincount(codes[valid], weights=y[valid], minlength=n_categories)
+    counts = np.bincount(codes[valid], minlength=n_categories)
+    return sums, counts
+
+def smoothed_means(sums, counts, prior, smoothing=0.0):
+    """Per-category encodings; categories without rows get the prior."""
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = (sums + smoothing * prior) / (counts + smoothing)
+    return np.where(counts > 0, means, prior)
+
+def fold_encodings(s, y, splits, smoothing=0.0):
+    """
+    (n_folds, n_rows) float32 array: row k holds every row's encoding learned on fold k's
+    TRAIN rows (missing/unseen categories get that fold's TRAIN mean). `splits` are the
+    (train_index, val_index) pairs of a K-fold split, i.e. the validation sets partition the rows.
+    """
+    codes, categories = category_codes(s)
+    y = np.asarray(y, dtype='float64')
+    total_sums, total_counts = _sums_counts(codes, y, len(categories))
+    total_y = y.sum()
+
+    encodings = np.empty((len(splits), len(y)), dtype=np.float32)
+    for k, (_, val_index) in enumerate(splits):
+        val_sums, val_counts = _sums_counts(codes[val_index], y[val_index], len(categories))
+        prior = (total_y - y[val_index].sum()) / (len(y) - len(val_index))
+        means = smoothed_means(total_sums - val_sums, total_counts - val_counts, prior, smoothing)
+        # The appended prior is what code -1 (missing) indexes
+        encodings[k] = np.append(means, prior)[codes]
+    return encodings
+
+def out_of_fold(encodings, splits):
+    """Per row, the encoding of the fold it is validated in, so no row sees its own target."""
+    oof = np.empty(encodings.shape[1], dtype=encodings.dtype)
+    for k, (_, val_index) in enumerate(splits):
+        oof[val_index] = encodings[k, val_index]
+    return oof
+
+class EncodingTable:
+    """
+    Array-backed category -> encoding lookup for inference: sorted category values plus
+    their encodings, looked up with a binary search. Unknown categories get the prior.
+    """
+    def __init__(self, categories, values, prior):
+        categories = np.asarray(categories)
+        order = np.argsort(categories, kind='stable')
+        self.categories = categories[order]
+        self.values = np.asarray(values, dtype='float64')[order]
+        self.prior = float(prior)
+
+    def lookup(self, keys):
+        keys = np.asarray(keys)
+        if len(self.categories) == 0:
+            return np.full(keys.shape, self.prior)
+        pos = np.searchsorted(self.categories, keys).clip(0, len(self.categories) - 1)
+        found = self.categories[pos] == keys
+        return np.where(found, self.values[pos], self.prior)
+
+    def to_dict(self):
+        return dict(zip(self.categories.tolist(), self.values.tolist()))
+
+    def to_arrays(self):
+        """Plain NumPy/float payload (e.g. for a model bundle) that from_arrays() restores."""
+        return {'categories': self.categories, 'values': self.values, 'prior': self.prior}
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        return cls(arrays['categories'], arrays['values'], arrays['prior'])
+
+    def __len__(self):
+        return len(self.categories)
+
+class EncodingAccumulator:
+    """
+    Per-category sums and counts accumulated over chunks of rows, for data that doesn't fit
+    in memory at once; table() gives the same EncodingTable as fit_table on all the rows.
+    """
+    def __init__(self):
+        self.sums = pd.Series(dtype='float64')
+        self.counts = pd.Series(dtype='float64')
+        self.total = 0.0
+        self.n = 0
+
+    def update(self, s, y):
+        y = pd.Series(np.asarray(y, dtype='float64'), index=s.index)
+        grouped = y.groupby(np.asarray(s), sort=False)
+        self.sums = self.sums.add(grouped.sum(), fill_value=0)
+        self.counts = self.counts.add(grouped.count(), fill_value=0)
+        self.total += y.sum()
+        self.n += len(y)
+
+    def table(self, smoothing=0.0, prior=None):
+        prior = self.total / self.n if prior is None else prior
+        means = smoothed_means(self.sums.to_numpy(), self.counts.to_numpy(), prior, smoothing)
+        return EncodingTable(self.sums.index.to_numpy(), means, prior)
+
+def fit_table(s, y, smoothing=0.0, prior=None):
+    """EncodingTable of `y` by the categories of `s` over all rows (prior: mean of y)."""
+    codes, categories = category_codes(s)
+    y = np.asarray(y, dtype='float64')
+    prior = y.mean() if prior is None else prior
+    sums, counts = _sums_counts(codes, y, len(categories))
+    seen = counts > 0
+    return EncodingTable(categories[seen], smoothed_means(sums, counts, prior, smoothing)[seen], prior)
@@ -0,0 +1,66 @@
+import os
+import importlib
+import numpy as np
+import pandas as pd
+from data_loader import SALES_FILE, BLDG_FILE, PARCEL_FILE
+from storage import load_frame
+from profiling import PROFILE_FILE
+
+preprocess = importlib.import_module('01_preprocess_data')
+
+N_PARCELS = 40
+
+def _parid(i):
+    return f"{i:010d}"
+
+def _write_property_tables(data_dir):
+    rng = np.random.default_rng(1)
+    # Parcels 0-29 have a building: sales of the others are dropped by the join
+    pd.DataFrame({
+        'PARID': [_parid(i) for i in range(30)], 'YRBLT': rng.integers(1950, 2020, 30),
+        'RMBED': rng.integers(1, 6, 30), 'FIXBATH': rng.integers(1, 4, 30),
+        'SFLA': rng.uniform(800, 4000, 30).round(), 'TOTAL_AREA': rng.uniform(900, 4500, 30).round(),
+        'STORIES': 1.0, 'EXTWALL_DESC': 'Brick', 'ROOF_COVER_DESC': 'Shingle',
+    }).to_csv(os.path.join(data_dir, BLDG_FILE), index=False)
+    pd.DataFrame({
+        'PARID': [_parid(i) for i in range(N_PARCELS)], 'NBHD': rng.integers(1000, 1004, N_PARCELS),
+        'NBHD_DESC': 'Hood', 'LUC': 101, 'LUC_DESC': 'L101',
+    }).to_csv(os.path.join(data_dir, PARCEL_FILE), index=False)
+
+def _write_sales(data_dir, n, seed):
+    rng = np.random.default_rng(seed)
+    sales = pd.DataFrame({
+        'PARID': [_parid(i) for i in rng.integers(0, N_PARCELS, n)], 'TAXYR': 2026,
+        'SALEDT': pd.to_datetime('2015-01-01') + pd.to_timedelta(rng.integers(0, 3000, n), unit='D'),
+        'INSTRTYP': 'WD', 'INSTRTYP_DESC': 'Warranty', 'PRICE': rng.uniform(5e4, 6e5, n).round(),
+        'SALETYPE': 'Q', 'STEB': 'S', 'STEB_DESC': 'desc',
+    })
+    path = os.path.join(data_dir, SALES_FILE)
+    sales.to_csv(path, index=False, mode='a' if os.path.exists(path) else 'w', header=not os.path.exists(path))
+
+def _sorted(df):
+    return df.sort_values(preprocess.SALE_KEY).reset_index(drop=True)
+
+def _mtimes(paths):
+    return {path: os.stat(path).st_mtime_ns for path in paths}
+
+def test_incremental_matches_full_rebuild_and_noop_writes_nothing(tmp_path, monkeypatch):
+    data_dir = tmp_path / 'data'
+    data_dir.mkdir()
+    monkeypatch.chdir(tmp_path)
+    _write_property_tables(data_dir)
+    _write_sales(data_dir, 200, seed=2)
+    preprocess.main(use_cache=False, data_dir=str(data_dir))
+
+    _write_sales(data_dir, 50, seed=3)
+    preprocess.main_incremental(use_cache=False, data_dir=str(data_dir))
+    incremental = _sorted(load_frame(preprocess.OUTPUT_FILE))
+
+    outputs = [preprocess.OUTPUT_FILE, preprocess.PROCESSED_KEYS_FILE, preprocess.STATS_FILE, PROFILE_FILE]
+    before = _mtimes(outputs)
+    preprocess.main_incremental(use_cache=False, data_dir=str(data_dir))
+    assert _mtimes(outputs) == before
+
+    preprocess.main(use_cache=False, data_dir=str(data_dir))
+    full = _sorted(load_frame(preprocess.OUTPUT_FILE))
+    pd.testing.assert_frame_equal(incremental, full, check_dtype=False, check_categorical=False)
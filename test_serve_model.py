@@ -0,0 +1,48 @@
+import pytest
+import numpy as np
+import pandas as pd
+import xgboost as xgb
+from artifacts import save_bundle
+from tree_arrays import flatten_booster
+from serve_model import PredictionService
+
+FEATURES = ['SFLA', 'YRBLT', 'NBHD_Encoded']
+
+def _bundle(path):
+    rng = np.random.default_rng(0)
+    X = np.column_stack([rng.uniform(800, 4000, 500), rng.integers(1950, 2020, 500), rng.uniform(1e5, 5e5, 500)])
+    y = X[:, 0] * 100 + X[:, 2] * 0.5 + rng.normal(0, 1e4, 500)
+    booster = xgb.train({'max_depth': 3, 'nthread': 1}, xgb.DMatrix(X, label=y, feature_names=FEATURES), num_boost_round=20)
+    save_bundle(path, booster, FEATURES, tables={'nbhd_price_map': pd.Series({1: 2e5, 2: 3e5})},
+                meta={'global_mean_price': 2.5e5}, arrays=flatten_booster(booster))
+    return path
+
+def test_single_row_prediction_is_cached(tmp_path):
+    service = PredictionService(_bundle(str(tmp_path / 'bundle')))
+    assert service.model['ensemble'] is not None
+    row = {'SFLA': 2000, 'YRBLT': 1995, 'NBHD': 1}
+
+    first = service.predict_rows([row])
+    second = service.predict_rows([row])
+
+    assert first == second
+    stats = service.cache.stats()
+    assert (stats['hits'], stats['misses'], stats['size']) == (1, 1, 1)
+
+def test_single_row_path_matches_batch_path(tmp_path):
+    service = PredictionService(_bundle(str(tmp_path / 'bundle')))
+    rows = [{'SFLA': 1500 + 100 * i, 'YRBLT': 1990, 'NBHD': 2} for i in range(3)]
+
+    batch = service.predict_rows(rows)
+    service.cache.entries.clear()
+    single = [service.predict_rows([row])[0] for row in rows]
+
+    np.testing.assert_allclose(single, batch, rtol=1e-6)
+
+def test_empty_batch_and_missing_field(tmp_path):
+    service = PredictionService(_bundle(str(tmp_path / 'bundle')))
+
+    assert service.predict([]) == []
+    assert service.explain([]) == []
+    with pytest.raises(ValueError, match="missing field NBHD"):
+        service.predict([{'SFLA': 2000, 'YRBLT': 1995}])
@@ -0,0 +1,30 @@
+import numpy as np
+import xgboost as xgb
+from tree_arrays import LEAF, TreeEnsemble, flatten_booster
+
+def _booster():
+    rng = np.random.default_rng(0)
+    X = rng.normal(size=(2000, 4)).astype(np.float32)
+    y = X[:, 0] * 3 + X[:, 1]
+    return xgb.train({'max_depth': 4, 'nthread': 1}, xgb.DMatrix(X, label=y), num_boost_round=30), X
+
+def test_infinite_feature_0_does_not_leave_leaves():
+    booster, X = _booster()
+    rows = X[:50].copy()
+    rows[:, 0] = np.inf
+    rows[5, 1] = np.nan
+    ensemble = TreeEnsemble.from_booster(booster)
+    native = booster.inplace_predict(rows)
+
+    np.testing.assert_allclose(ensemble.predict(rows), native, rtol=1e-5)
+    np.testing.assert_allclose([ensemble.predict_row(row) for row in rows], native, rtol=1e-5)
+
+def test_arrays_without_leaf_flags():
+    # Arrays written before leaves were flagged had feature 0 on leaves
+    booster, X = _booster()
+    arrays = flatten_booster(booster)
+    arrays['feature'] = np.where(arrays['feature'] == LEAF, 0, arrays['feature']).astype(np.int32)
+    rows = X[:50].copy()
+    rows[:, 0] = np.inf
+
+    np.testing.assert_allclose(TreeEnsemble(arrays).predict(rows), booster.inplace_predict(rows), rtol=1e-5)
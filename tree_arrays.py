@@ -0,0 +1,193 @@
+import json
+import time
+import argparse
+import numpy as np
+
+# Array-backed evaluator for the exported tree ensemble. The booster's trees are flattened
+# into contiguous node arrays (all trees back to back, children of a node adjacent):
+#   feature    split feature index (int32); LEAF (-1) marks a leaf
+#   threshold  split value (float32): x < threshold goes left, as in XGBoost (0 for leaves)
+#   left       global index of the left child (int32); the right child is left + 1.
+#              Leaves point to themselves, so a finished tree stays on its leaf.
+#   default_left  direction of missing (NaN) values
+#   value      leaf value (0 for split nodes)
+# plus the root node of every tree and the base score. Evaluation walks all trees of all
+# rows at once, one level per step, so a prediction is max_depth rounds of NumPy indexing
+# with no DMatrix construction or per-call XGBoost setup.
+
+# Rows evaluated at once by predict(): keeps the (rows x trees) node index array cache-sized
+PREDICT_CHUNK_ROWS = 256
+# `feature` of a leaf node
+LEAF = -1
+
+def _base_score(learner):
+    # Stored as a string, e.g. '5E-1' or (XGBoost >= 3) '[3.582869E5]'
+    return float(learner['learner_model_param']['base_score'].strip('[]'))
+
+def _breadth_first(left, right):
+    """Node order in which the two children of every split node are adjacent (left, right)."""
+    order = [0]
+    for node in order:
+        if left[node] != -1:
+            order.extend((left[node], right[node]))
+    return np.array(order, dtype=np.int32)
+
+def flatten_booster(booster):
+    """Node arrays of an XGBoost regression booster (gbtree, numerical splits). Returns a dict of arrays."""
+    learner = json.loads(booster.save_raw('json'))['learner']
+    objective = learner['objective']['name']
+    if objective != 'reg:squarederror':
+        raise ValueError(f"Only reg:squarederror models can be flattened (got {objective})")
+    if learner['gradient_booster']['name'] != 'gbtree':
+        raise ValueError(f"Only gbtree models can be flattened (got {learner['gradient_booster']['name']})")
+
+    parts = {name: [] for name in ['feature', 'threshold', 'left', 'default_left', 'value']}
+    roots = []
+    n_nodes = 0
+    max_depth = 0
+    for tree in learner['gradient_booster']['model']['trees']:
+        if any(tree['split_type']):
+            raise ValueError("Categorical splits are not supported")
+        left = np.asarray(tree['left_children'], dtype=np.int32)
+        right = np.asarray(tree['right_children'], dtype=np.int32)
+        order = _breadth_first(left, right)
+        # Old node id -> position in the flattened arrays
+        position = np.empty(len(left), dtype=np.int32)
+        position[order] = n_nodes + np.arange(len(order), dtype=np.int32)
+
+        left, conditions = left[order], np.asarray(tree['split_conditions'], dtype=np.float32)[order]
+        is_leaf = left == -1
+        parts['feature'].append(np.where(is_leaf, LEAF, np.asarray(tree['split_indices'])[order]).astype(np.int32))
+        parts['threshold'].append(np.where(is_leaf, 0, conditions).astype(np.float32))
+        parts['left'].append(np.where(is_leaf, position[order], position[left.clip(0)]))
+        parts['default_left'].append(np.where(is_leaf, True, np.asarray(tree['default_left'], dtype=bool)[order]))
+        parts['value'].append(np.where(is_leaf, conditions, 0).astype(np.float32))
+        roots.append(n_nodes)
+        n_nodes += len(order)
+        max_depth = max(max_depth, _tree_depth(np.asarray(tree['left_children']), np.asarray(tree['right_children'])))
+
+    arrays = {name: np.concatenate(values) for name, values in parts.items()}
+    arrays['roots'] = np.array(roots, dtype=np.int32)
+    arrays['params'] = np.array([_base_score(learner), max_depth,
+                                 int(learner['learner_model_param']['num_feature'])], dtype=np.float64)
+    return arrays
+
+def _tree_depth(left, right):
+    depth = np.zeros(len(left), dtype=np.int32)
+    for node in _breadth_first(left, right):
+        if left[node] != -1:
+            depth[left[node]] = depth[right[node]] = depth[node] + 1
+    return int(depth.max())
+
+class TreeEnsemble:
+    """Predictions from flattened node arrays (see flatten_booster); arrays may be memory-mapped."""
+    def __init__(self, arrays):
+        self.feature = arrays['feature']
+        if not (self.feature == LEAF).any():
+            # Bundles written before leaves were flagged: a leaf is a node that points to itself
+            self.feature = np.where(arrays['left'] == np.arange(len(arrays['left'])), LEAF, self.feature).astype(np.int32)
+        self.threshold = arrays['threshold']
+        self.left = arrays['left']
+        self.default_left = arrays['default_left']
+        self.value = arrays['value']
+        self.roots = arrays['roots']
+        base_score, max_depth, n_features = arrays['params']
+        self.base_score = float(base_score)
+        self.max_depth = int(max_depth)
+        self.n_features = int(n_features)
+
+    @classmethod
+    def from_booster(cls, booster):
+        return cls(flatten_booster(booster))
+
+    def _walk(self, x, nodes, offsets=0):
+        # One level per step for every (row, tree): x is a flat float32 feature array and
+        # offsets the start of each node's row in it. The right child is left + 1, and leaves
+        # (feature LEAF, left = self) stay put whatever the row's values.
+        has_missing = np.isnan(x).any()
+        for _ in range(self.max_depth):
+            feature = self.feature[nodes]
+            is_split = feature != LEAF
+            # Leaves read some other value of the flat array; their comparison is masked out
+            values = x[offsets + feature]
+            go_right = values >= self.threshold[nodes]
+            if has_missing:
+                # NaN fails every comparison: it takes the node's default direction instead
+                go_right |= np.isnan(values) & ~self.default_left[nodes]
+            nodes = self.left[nodes] + (go_right & is_split)
+        return nodes
+
+    def predict_row(self, x):
+        """Prediction for one row (1-D feature array): the fast path for interactive calls."""
+        x = np.asarray(x, dtype=np.float32)
+        # Rounded to float32 like XGBoost's own predictions, so both paths give the same values
+        return float(np.float32(self.value[self._walk(x, self.roots)].sum(dtype=np.float64) + self.base_score))
+
+    def predict(self, X, chunk_rows=PREDICT_CHUNK_ROWS):
+        """Predictions for a 2-D feature matrix, evaluated chunk_rows rows at a time."""
+        X = np.asarray(X, dtype=np.float32)
+        if X.ndim == 1:
+            return np.array([self.predict_row(X)])
+        preds = np.empty(len(X), dtype=np.float32)
+        n_features = X.shape[1]
+        for start in range(0, len(X), chunk_rows):
+            chunk = np.ascontiguousarray(X[start:start + chunk_rows]).ravel()
+            n_rows = len(chunk) // n_features
+            offsets = (np.arange(n_rows, dtype=np.int32) * n_features)[:, None]
+            nodes = self._walk(chunk, np.broadcast_to(self.roots, (n_rows, len(self.roots))), offsets)
+            preds[start:start + n_rows] = self.value[nodes].sum(axis=1, dtype=np.float64) + self.base_score
+        return preds
+
+def _timeit(func, repeat):
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def benchmark(model_path, batch_sizes=(1, 100, 100_000), seed=42):
+    """
+    Times XGBoost's predict (DMatrix, as XGBRegressor.predict on a frame), inplace_predict
+    and the array evaluator on rows of the engineered data, and checks they agree.
+    """
+    import pandas as pd
+    import xgboost as xgb
+    from storage import ENGINEERED_FILE, load_frame
+    from score_parcels import load_scoring_model, prepare_chunk
+
+    model = load_scoring_model(model_path)
+    booster = model['booster']
+    start = time.perf_counter()
+    ensemble = TreeEnsemble.from_booster(booster)
+    print(f"Flattened {len(ensemble.roots)} trees ({len(ensemble.feature):,} nodes, depth {ensemble.max_depth}) "
+          f"in {time.perf_counter() - start:.2f}s")
+
+    data = prepare_chunk(load_frame(ENGINEERED_FILE), model)
+    rng = np.random.default_rng(seed)
+    results = []
+    for batch_size in batch_sizes:
+        X = np.ascontiguousarray(data[rng.integers(0, len(data), batch_size)], dtype=np.float32)
+        repeat = 20 if batch_size <= 100 else 2
+        native = booster.predict(xgb.DMatrix(X, feature_names=model['features']))
+        arrays = ensemble.predict_row(X[0]) if batch_size == 1 else ensemble.predict(X)
+        max_diff = float(np.max(np.abs(np.asarray(arrays) - native) / np.maximum(np.abs(native), 1)))
+        row = {
+            'batch_size': batch_size,
+            'dmatrix_predict_ms': _timeit(lambda: booster.predict(xgb.DMatrix(X, feature_names=model['features'])), repeat) * 1000,
+            'inplace_predict_ms': _timeit(lambda: booster.inplace_predict(X), repeat) * 1000,
+            'arrays_ms': _timeit((lambda: ensemble.predict_row(X[0])) if batch_size == 1 else (lambda: ensemble.predict(X)), repeat) * 1000,
+            'max_rel_diff': max_diff,
+        }
+        results.append(row)
+    table = pd.DataFrame(results)
+    print(table.to_string(index=False, float_format=lambda v: f"{v:.4g}"))
+    return table
+
+if __name__ == "__main__":
+    from score_parcels import MODEL_PATH
+    parser = argparse.ArgumentParser(description="Benchmark the array tree evaluator against XGBoost's predict.")
+    parser.add_argument('--model', default=MODEL_PATH, help="Model bundle directory or legacy model_artifacts.pkl.")
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 100, 100_000])
+    args = parser.parse_args()
+    benchmark(args.model, args.batch_sizes)